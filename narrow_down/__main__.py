@@ -0,0 +1,7 @@
+"""Entry point for ``python -m narrow_down``."""
+import sys
+
+from narrow_down.cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
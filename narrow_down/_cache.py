@@ -0,0 +1,264 @@
+"""Caches for query results and fingerprints with LRU and TTL eviction."""
+import collections
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Generic, Hashable, Iterable, List, Optional, Set, Tuple, TypeVar
+
+from .hash import xxhash_64bit
+from .storage import Fingerprint, StoredDocument
+
+BucketKey = Tuple[int, int]
+"""Bucket ID and document hash of an LSH bucket."""
+
+
+@dataclass(frozen=True)
+class CacheStats:
+    """Counters of a cache."""
+
+    hits: int
+    """Number of queries answered from the cache."""
+
+    misses: int
+    """Number of queries which had to be computed."""
+
+    evictions: int
+    """Number of entries dropped because the cache was full or the entry expired."""
+
+    invalidations: int
+    """Number of entries dropped because a document was inserted into or removed from one of
+    their buckets."""
+
+    size: int
+    """Current number of entries."""
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LruCache(Generic[K, V]):
+    """Generic size-bounded LRU cache with optional time-to-live."""
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+        on_drop: Optional[Callable[[K, V], None]] = None,
+    ):
+        """Create a new LruCache.
+
+        Args:
+            max_size: Maximum number of entries.
+            ttl: Optional time-to-live of an entry in seconds.
+            clock: Function returning the current time in seconds.
+            on_drop: Optional function called with key and value of every entry which is evicted,
+                expires, is invalidated or replaced. It is not called by :meth:`clear`.
+
+        Raises:
+            ValueError: If max_size is not positive.
+        """
+        if max_size < 1:
+            raise ValueError("The cache size must be positive.")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._clock = clock
+        self._on_drop = on_drop
+        self._entries: "collections.OrderedDict[K, Tuple[V, Optional[float]]]" = (
+            collections.OrderedDict()
+        )
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._invalidations = 0
+
+    @property
+    def generation(self) -> int:
+        """Counter which changes with every invalidation.
+
+        Take it before computing a value and pass it to :meth:`put`, so that a value which was
+        computed while the underlying data changed is not cached.
+        """
+        return self._generation
+
+    def get(self, key: K) -> Optional[V]:
+        """Look up a value and count a hit or miss."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= self._clock():
+            self._drop(key)
+            self._evictions += 1
+            entry = None
+        if entry is None:
+            self._misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry[0]
+
+    def put(self, key: K, value: V, generation: int) -> bool:
+        """Store a value unless an invalidation happened since generation was taken.
+
+        Returns:
+            Whether the value was stored.
+        """
+        if generation != self._generation:
+            return False
+        if key in self._entries:
+            self._drop(key)
+        expires = self._clock() + self._ttl if self._ttl is not None else None
+        self._entries[key] = (value, expires)
+        while len(self._entries) > self._max_size:
+            self._drop(next(iter(self._entries)))
+            self._evictions += 1
+        return True
+
+    def invalidate(self, key: K) -> None:
+        """Drop the entry for the given key if it exists."""
+        self.invalidate_many((key,))
+
+    def invalidate_many(self, keys: Iterable[K]) -> None:
+        """Drop the entries for the given keys if they exist."""
+        self._generation += 1
+        for key in keys:
+            if key in self._entries:
+                self._drop(key)
+                self._invalidations += 1
+
+    def clear(self) -> None:
+        """Drop all entries. The counters are kept."""
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        """Return the current counters."""
+        return CacheStats(
+            hits=self._hits,
+            misses=self._misses,
+            evictions=self._evictions,
+            invalidations=self._invalidations,
+            size=len(self._entries),
+        )
+
+    def _drop(self, key: K) -> None:
+        value, _ = self._entries.pop(key)
+        if self._on_drop is not None:
+            self._on_drop(key, value)
+
+
+_QueryEntry = Tuple[Tuple[StoredDocument, ...], List[BucketKey]]
+
+
+class QueryCache:
+    """Size-bounded LRU cache for query results with optional time-to-live.
+
+    Each entry remembers the LSH buckets its query looked at. Inserting or removing a document
+    only invalidates the entries which share a bucket with it, because other results cannot be
+    affected.
+
+    Changes made through other SimilarityStore objects, e.g. in other processes with a shared
+    database, are not noticed. Use a time-to-live to bound the staleness in this case.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """Create a new QueryCache.
+
+        Args:
+            max_size: Maximum number of entries.
+            ttl: Optional time-to-live of an entry in seconds.
+            clock: Function returning the current time in seconds.
+
+        Raises:
+            ValueError: If max_size is not positive.
+        """
+        self._lru: LruCache[Hashable, _QueryEntry] = LruCache(
+            max_size, ttl, clock, on_drop=self._unindex
+        )
+        self._keys_by_bucket: Dict[BucketKey, Set[Hashable]] = collections.defaultdict(set)
+
+    @property
+    def generation(self) -> int:
+        """Counter which changes with every invalidation. See :attr:`LruCache.generation`."""
+        return self._lru.generation
+
+    def get(self, key: Hashable) -> Optional[List[StoredDocument]]:
+        """Look up the results for a query key and count a hit or miss."""
+        entry = self._lru.get(key)
+        return list(entry[0]) if entry is not None else None
+
+    def put(
+        self,
+        key: Hashable,
+        results: Iterable[StoredDocument],
+        bucket_keys: List[BucketKey],
+        generation: int,
+    ) -> None:
+        """Store the results of a query unless the index changed since generation was taken."""
+        if self._lru.put(key, (tuple(results), bucket_keys), generation):
+            for bucket_key in bucket_keys:
+                self._keys_by_bucket[bucket_key].add(key)
+
+    def invalidate(self, bucket_keys: Iterable[BucketKey]) -> None:
+        """Drop all entries which looked at one of the given buckets."""
+        self._lru.invalidate_many(
+            key for bucket_key in bucket_keys for key in self._keys_by_bucket.pop(bucket_key, ())
+        )
+
+    def clear(self) -> None:
+        """Drop all entries. The counters are kept."""
+        self._lru.clear()
+        self._keys_by_bucket.clear()
+
+    def stats(self) -> CacheStats:
+        """Return the current counters."""
+        return self._lru.stats()
+
+    def _unindex(self, key: Hashable, entry: _QueryEntry) -> None:
+        """Remove a dropped entry from the bucket index."""
+        for bucket_key in entry[1]:
+            keys = self._keys_by_bucket.get(bucket_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_bucket[bucket_key]
+
+
+class FingerprintCache:
+    """Size-bounded LRU cache mapping document texts to their fingerprints.
+
+    The texts are not stored, but only their 64 bit xxhash together with their length.
+    """
+
+    def __init__(self, max_size: int):
+        """Create a new FingerprintCache.
+
+        Args:
+            max_size: Maximum number of entries.
+
+        Raises:
+            ValueError: If max_size is not positive.
+        """
+        self._lru: LruCache[Tuple[int, int], Fingerprint] = LruCache(max_size)
+
+    @staticmethod
+    def _key(document: str) -> Tuple[int, int]:
+        encoded = document.encode("utf-8")
+        return xxhash_64bit(encoded), len(encoded)
+
+    def get(self, document: str) -> Optional[Fingerprint]:
+        """Look up the fingerprint of a document and count a hit or miss."""
+        return self._lru.get(self._key(document))
+
+    def put(self, document: str, fingerprint: Fingerprint) -> None:
+        """Store the fingerprint of a document. The array is made read-only."""
+        fingerprint.flags.writeable = False
+        self._lru.put(self._key(document), fingerprint, self._lru.generation)
+
+    def stats(self) -> CacheStats:
+        """Return the current counters."""
+        return self._lru.stats()
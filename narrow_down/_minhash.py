@@ -5,12 +5,31 @@ Source: Leskovec, Rajaraman and Ullman, “Mining of Massive Datasets.”, Chapt
 import asyncio
 import collections
 import collections.abc
+import contextlib
 import dataclasses
+import enum
+import functools
+import itertools
 import json
+import math
+import random
 import typing
 import warnings
 from dataclasses import dataclass
-from typing import Collection, Optional
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Collection,
+    Iterable,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
 import numpy as np
 import numpy.typing as npt
@@ -21,6 +40,62 @@ from .storage import Fingerprint, StorageBackend, StorageLevel, StoredDocument,
 
 _MERSENNE_PRIME = np.uint32((1 << 32) - 1)
 
+T = TypeVar("T")
+
+
+FINGERPRINT_ENGINES = ("minhash", "one_permutation", "weighted_minhash", "simhash")
+"""Names of the available fingerprint algorithms.
+
+- ``"minhash"``: Classic minhash with one hash permutation per fingerprint entry
+  (:class:`MinHasher`).
+- ``"one_permutation"``: One permutation hashing with optimal densification
+  (:class:`OnePermutationHasher`), much faster for long fingerprints.
+- ``"weighted_minhash"``: Weighted minhash with consistent weighted sampling
+  (:class:`WeightedMinHasher`), which takes into account how often a token occurs.
+- ``"simhash"``: 64 bit SimHash with random hyperplanes (:class:`SimHasher`), very cheap to
+  calculate and store, but less accurate. Suited for short texts.
+"""
+
+
+MAX_PROBE_ROWS = 2
+"""Maximum number of rows of a band which a multi-probe query replaces at once."""
+
+PROBE_ENGINES = ("minhash", "simhash")
+"""Names of the fingerprint algorithms which support multi-probe queries.
+
+For minhash the neighbouring buckets use the second smallest hash value of a row, which is the
+most likely value of a similar document lacking the shingle with the smallest value. For SimHash
+they use the flipped bit.
+"""
+
+
+FOREST_DEPTHS = (1, 2, 3, 4, 5, 6, 8, 10, 12, 16)
+"""Prefix lengths indexed per tree of an LSH forest.
+
+Each document is stored in one bucket per tree and prefix length. A query for a threshold reads
+the buckets of one prefix length, longer prefixes for higher thresholds.
+"""
+
+
+CONTAINMENT_PARTITIONS = 16
+"""Number of set size partitions of a containment index.
+
+Partition p holds the documents with 2^p up to 2^(p+1) - 1 distinct tokens, the last one all
+larger documents.
+"""
+
+
+FULL_FINGERPRINT_BITS = 32
+"""Number of bits of a fingerprint value, stored if no b-bit fingerprints are configured."""
+
+FINGERPRINT_BITS = (1, 2, 4, 8, FULL_FINGERPRINT_BITS)
+"""Possible numbers of bits to store per fingerprint value.
+
+With less than 32 bits only the lowest bits of each value are stored ("b-bit minhash"). This
+shrinks the stored fingerprints by a factor of 32 / bits, but documents can no longer be removed,
+because their LSH buckets cannot be calculated from the remaining bits.
+"""
+
 
 @dataclass(frozen=True)
 class MinhashLshConfig:
@@ -35,6 +110,40 @@ class MinhashLshConfig:
     rows_per_band: int
     """Number of rows per band for the LSH part."""
 
+    engine: str = "minhash"
+    """Algorithm to calculate the fingerprints, one of :data:`FINGERPRINT_ENGINES`."""
+
+    fingerprint_bits: int = FULL_FINGERPRINT_BITS
+    """Number of bits stored per fingerprint value, one of :data:`FINGERPRINT_BITS`."""
+
+    probe_rows: int = 0
+    """Maximum number of rows in which a probed bucket may differ from a band of the query.
+
+    With 1 or 2 queries also read the neighbouring buckets of each band ("multi-probe LSH"), so
+    fewer bands are needed for the same recall. Only engines in :data:`PROBE_ENGINES` support it.
+    """
+
+    forest_depths: Tuple[int, ...] = ()
+    """Prefix lengths indexed per tree if this is an LSH forest, otherwise empty.
+
+    In an LSH forest the bands are the trees and rows_per_band is the longest prefix. Queries can
+    then use any similarity threshold.
+    """
+
+    max_false_negative_proba: float = 0.05
+    """Target used by an LSH forest to choose the prefix length for a query threshold."""
+
+    size_partitions: int = 0
+    """Number of set size partitions for containment search, 0 for Jaccard similarity search.
+
+    A containment index is an LSH forest per partition ("LSH Ensemble"), see
+    :data:`CONTAINMENT_PARTITIONS`.
+    """
+
+    def __post_init__(self):
+        """Turn the forest depths into a tuple, e.g. after reading them from json."""
+        object.__setattr__(self, "forest_depths", tuple(self.forest_depths))
+
     def to_json(self) -> str:
         """Serialize to a json string."""
         return json.dumps(dataclasses.asdict(self))
@@ -45,6 +154,110 @@ class MinhashLshConfig:
         return cls(**json.loads(json_str))
 
 
+class OversizedBucketPolicy(enum.Enum):
+    """What to do with a bucket which holds more documents than the configured cap."""
+
+    Skip = "skip"
+    """Ignore the bucket completely."""
+    Sample = "sample"
+    """Take a random sample of the size of the cap from the bucket."""
+    Truncate = "truncate"
+    """Take the first document IDs up to the size of the cap from the bucket."""
+
+
+@dataclass(frozen=True)
+class BucketCap:
+    """Protection against LSH buckets with very many documents.
+
+    Boilerplate text like cookie banners or signatures can put thousands of documents into the
+    same buckets. Fetching all of them as candidates makes queries slow. Capping the buckets
+    makes queries fast again, but similar documents in the capped buckets may not be found.
+    """
+
+    max_size: int
+    """Maximum number of candidates taken from one bucket."""
+
+    policy: OversizedBucketPolicy = OversizedBucketPolicy.Truncate
+    """How to reduce the candidates of a bucket with more than max_size documents."""
+
+    stop_list_threshold: Optional[int] = None
+    """Bucket size from which on a bucket is put on the stop-list. Queries don't read buckets
+    on the stop-list at all. Removing a document from a bucket takes it off the stop-list again.
+    Per default no stop-list is kept."""
+
+    stop_list_max_size: int = 10000
+    """Maximum number of buckets on the stop-list. The oldest entries are dropped first."""
+
+    def __post_init__(self):
+        """Validate the settings."""
+        if self.max_size < 1:
+            raise ValueError("The bucket cap must be positive.")
+        if self.stop_list_threshold is not None and self.stop_list_threshold < 1:
+            raise ValueError("The stop-list threshold must be positive.")
+
+
+@dataclass(frozen=True)
+class BucketCapStats:
+    """Counters of the bucket cap."""
+
+    capped: int
+    """Number of bucket reads which returned more documents than the cap."""
+
+    stop_list_hits: int
+    """Number of bucket reads which were skipped because the bucket is on the stop-list."""
+
+    stop_list_size: int
+    """Current number of buckets on the stop-list."""
+
+
+class CandidateIds(NamedTuple):
+    """IDs of candidate documents of a query, most likely candidates first."""
+
+    ids: npt.NDArray[np.uint64]
+    """Document IDs."""
+
+    band_hits: npt.NDArray[np.uint32]
+    """Number of LSH bands in which each document shares the bucket with the query."""
+
+
+class InsertResult(NamedTuple):
+    """Outcome of an insert which only happens if no similar document is stored yet."""
+
+    document_id: int
+    """ID of the inserted document, or of the similar document which prevented the insert."""
+
+    inserted: bool
+    """Whether the document was inserted."""
+
+
+class _KeyLocks:
+    """Asyncio locks per bucket key, which only exist while somebody holds or awaits them."""
+
+    def __init__(self):
+        self._locks: typing.Dict[Tuple[int, int], Tuple[asyncio.Lock, int]] = {}
+
+    @contextlib.asynccontextmanager
+    async def hold(self, keys: Iterable[Tuple[int, int]]):
+        """Acquire the locks of all keys, always in the same order to avoid deadlocks."""
+        keys = sorted(set(keys))
+        for key in keys:
+            # Registered without awaiting in between, so the lock isn't dropped while waited for
+            lock, users = self._locks.get(key) or (asyncio.Lock(), 0)
+            self._locks[key] = (lock, users + 1)
+        try:
+            async with contextlib.AsyncExitStack() as stack:
+                for key in keys:
+                    await stack.enter_async_context(self._locks[key][0])
+                yield
+        finally:
+            for key in keys:
+                lock, users = self._locks[key]
+                if users == 1:
+                    del self._locks[key]
+                else:
+                    self._locks[key] = (lock, users - 1)
+
+
 class MinHasher:
     """Classic Minhash algorithm."""
 
@@ -89,6 +302,250 @@ class MinHasher:
             )
         )
 
+    def minhash_with_probes(self, shingles: Collection[str]) -> Tuple[Fingerprint, Fingerprint]:
+        """Calculate the minhashes together with the values to probe neighbouring buckets.
+
+        Args:
+            shingles: The parts of the document to hash as list of strings
+
+        Returns:
+            The minhashes like :meth:`minhash` and the second smallest hash value of each
+            permutation.
+        """
+        minhashes, runners_up = _rust.minhash_with_runner_up(list(shingles), self.a, self.b)
+        return (
+            Fingerprint(np.array(minhashes, np.uint32)),
+            Fingerprint(np.array(runners_up, np.uint32)),
+        )
+
+
+class OnePermutationHasher:
+    """Minhash variant with one permutation hashing and optimal densification.
+
+    All entries of the fingerprint are computed in a single pass over the shingles, so the cost
+    grows with n_shingles + n_hashes instead of n_shingles * n_hashes.
+
+    Source: Shrivastava, "Optimal Densification for Fast and Accurate Minwise Hashing", 2017.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(
+        self,
+        n_hashes: int = 100,
+        random_seed: Optional[int] = 42,
+    ) -> None:
+        """Prepare a OnePermutationHasher object.
+
+        Args:
+            n_hashes: The number of entries in the fingerprint.
+            random_seed: The random seed for the hash permutation and the densification.
+                Pass None to achieve true randomness.
+        """
+        gen = np.random.RandomState(random_seed)
+        self.n_hashes = n_hashes
+        self.a = int(gen.randint(1, _MERSENNE_PRIME, dtype="uint32"))
+        self.b = int(gen.randint(0, _MERSENNE_PRIME, dtype="uint32"))
+        self.seed = int(gen.randint(0, _MERSENNE_PRIME, dtype="uint32"))
+
+    def minhash(self, shingles: Collection[str]) -> Fingerprint:
+        """Calculate the fingerprint for a list of strings.
+
+        Args:
+            shingles: The parts of the document to hash as list of strings
+
+        Returns:
+            A 1xN-dimensional (where N = n_hashes) numpy array of integers.
+        """
+        return Fingerprint(
+            np.array(
+                _rust.one_permutation_minhash(
+                    list(shingles), self.n_hashes, self.a, self.b, self.seed
+                ),
+                np.uint32,
+            )
+        )
+
+
+class WeightedMinHasher:
+    """Weighted minhash with Improved Consistent Weighted Sampling (ICWS).
+
+    Instead of a set of shingles the document is given as mapping from shingles to weights, e.g.
+    the number of occurrences. Two fingerprints agree in a position with the probability of the
+    weighted Jaccard similarity ``sum(min(w1, w2)) / sum(max(w1, w2))``. So long documents with
+    repeated phrases are compared accurately with the same number of hashes as plain minhash.
+
+    Source: Ioffe, "Improved Consistent Sampling, Weighted Minhash and L1 Sketching", 2010.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(
+        self,
+        n_hashes: int = 100,
+        random_seed: Optional[int] = 42,
+    ) -> None:
+        """Prepare a WeightedMinHasher object.
+
+        Args:
+            n_hashes: The number of entries in the fingerprint.
+            random_seed: The random seed for the sampling.
+                Pass None to achieve true randomness.
+        """
+        gen = np.random.RandomState(random_seed)
+        self.n_hashes = n_hashes
+        self.seed = int(gen.randint(0, _MERSENNE_PRIME, dtype="uint32"))
+
+    def minhash(self, shingles: Union[Mapping[str, float], Collection[str]]) -> Fingerprint:
+        """Calculate the fingerprint for weighted strings.
+
+        Args:
+            shingles: The parts of the document to hash, as mapping from string to weight. For
+                other collections each occurrence of a string counts with weight 1.
+
+        Returns:
+            A 1xN-dimensional (where N = n_hashes) numpy array of integers.
+
+        Raises:
+            ValueError: If a weight is negative or not finite.
+        """
+        if not isinstance(shingles, collections.abc.Mapping):
+            shingles = collections.Counter(shingles)
+        return Fingerprint(
+            np.array(
+                _rust.weighted_minhash(
+                    {s: float(w) for s, w in shingles.items()}, self.n_hashes, self.seed
+                ),
+                np.uint32,
+            )
+        )
+
+
+class SimHasher:
+    """64 bit SimHash, an alternative to minhash for short texts.
+
+    The fingerprint is returned as array of 64 bits with the values 0 and 1, so that the LSH bands
+    are blocks of bits. Two fingerprints agree in a bit with the probability ``1 - angle / pi``,
+    where angle is the angle between the shingle vectors of the documents, see
+    :func:`simhash_similarity`. A pair of documents is found if one of the blocks has no
+    differing bits, like with the permuted tables of Manku et al., "Detecting Near-Duplicates for
+    Web Crawling", 2007. As the bits are independent, no permutation is needed.
+
+    Source: Charikar, "Similarity Estimation Techniques from Rounding Algorithms", 2002.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    n_hashes = 64
+    """Number of bits of the fingerprint."""
+
+    def __init__(self, random_seed: Optional[int] = 42) -> None:
+        """Prepare a SimHasher object.
+
+        Args:
+            random_seed: The random seed for the hyperplanes. Pass None to achieve true randomness.
+        """
+        gen = np.random.RandomState(random_seed)
+        self.seed = int(gen.randint(0, _MERSENNE_PRIME, dtype="uint32"))
+
+    def minhash(self, shingles: Collection[str]) -> Fingerprint:
+        """Calculate the fingerprint for a list of strings.
+
+        Args:
+            shingles: The parts of the document to hash as list of strings
+
+        Returns:
+            A numpy array with the 64 bits of the SimHash, lowest bit first.
+        """
+        value = _rust.simhash(list(shingles), self.seed)
+        bits = np.unpackbits(np.array([value], dtype="<u8").view(np.uint8), bitorder="little")
+        return Fingerprint(bits.astype(np.uint32))
+
+    def minhash_with_probes(self, shingles: Collection[str]) -> Tuple[Fingerprint, Fingerprint]:
+        """Calculate the fingerprint together with the values to probe neighbouring buckets.
+
+        Args:
+            shingles: The parts of the document to hash as list of strings
+
+        Returns:
+            The fingerprint like :meth:`minhash` and its flipped bits.
+        """
+        fingerprint = self.minhash(shingles)
+        return fingerprint, Fingerprint((1 - fingerprint).astype(np.uint32))
+
+
+def simhash_similarity(jaccard_similarity: float) -> float:
+    """Probability that the SimHash fingerprints of two documents agree in a bit.
+
+    Two documents with similar numbers of distinct shingles and the given Jaccard similarity have
+    the cosine similarity ``2 * J / (1 + J)``. The bits then agree with the probability
+    ``1 - arccos(cosine) / pi``.
+
+    Args:
+        jaccard_similarity: Jaccard similarity of the documents.
+
+    Returns:
+        The probability for a bit to agree.
+    """
+    cosine = 2 * jaccard_similarity / (1 + jaccard_similarity)
+    return 1 - float(np.arccos(min(cosine, 1.0))) / np.pi
+
+
+def estimate_similarity(
+    fingerprint1: npt.NDArray,
+    fingerprint2: npt.NDArray,
+    fingerprint_bits: int = FULL_FINGERPRINT_BITS,
+) -> float:
+    """Estimate the Jaccard similarity of two documents from their fingerprints.
+
+    Only the lowest fingerprint_bits bits of the values are compared. Values which agree only by
+    chance in these bits are corrected for as described in Li and König, "b-Bit Minwise Hashing",
+    2010, assuming the documents are small compared to the hash range.
+
+    Args:
+        fingerprint1: Fingerprint of the first document.
+        fingerprint2: Fingerprint of the second document, with the same length.
+        fingerprint_bits: Number of bits per value to compare.
+
+    Returns:
+        The estimated Jaccard similarity between 0 and 1.
+    """
+    mask = np.uint32((1 << fingerprint_bits) - 1)
+    matches = float(
+        np.mean((fingerprint1.astype(np.uint32) & mask) == (fingerprint2.astype(np.uint32) & mask))
+    )
+    if fingerprint_bits >= FULL_FINGERPRINT_BITS:
+        return matches
+    chance = 2.0**-fingerprint_bits
+    return max(0.0, (matches - chance) / (1.0 - chance))
+
+
+def create_hasher(
+    lsh_config: MinhashLshConfig,
+) -> Union[MinHasher, OnePermutationHasher, WeightedMinHasher, SimHasher]:
+    """Create the fingerprint algorithm configured in lsh_config.
+
+    Args:
+        lsh_config: Configuration with the number of hashes and the name of the engine.
+
+    Returns:
+        A hasher object with a method minhash() to calculate fingerprints.
+
+    Raises:
+        ValueError: If the engine is unknown.
+    """
+    if lsh_config.engine == "minhash":
+        return MinHasher(n_hashes=lsh_config.n_hashes)
+    if lsh_config.engine == "one_permutation":
+        return OnePermutationHasher(n_hashes=lsh_config.n_hashes)
+    if lsh_config.engine == "weighted_minhash":
+        return WeightedMinHasher(n_hashes=lsh_config.n_hashes)
+    if lsh_config.engine == "simhash":
+        return SimHasher()
+    raise ValueError(
+        f"Unknown fingerprint engine: {lsh_config.engine}. Options: {FINGERPRINT_ENGINES}"
+    )
+
 
 class LSH:
     """Locality sensitive hash structure to store minhashes efficiently."""
@@ -97,12 +554,49 @@ class LSH:
         self,
         lsh_config: MinhashLshConfig,
         storage: StorageBackend,
+        compressor: Optional[_rust.Compressor] = None,
+        bucket_cap: Optional[BucketCap] = None,
+        max_concurrency: Optional[int] = None,
     ):
-        """Create a new LSH object."""
+        """Create a new LSH object.
+
+        Args:
+            lsh_config: The configuration of bands and rows.
+            storage: The storage backend for documents and buckets.
+            compressor: Optional compressor for the serialized documents.
+            bucket_cap: Optional limit for the number of candidates taken from one bucket.
+            max_concurrency: Optional limit for the number of storage calls which are in flight
+                at the same time, shared by all operations on this object. A further call is
+                only created when one of the running calls is finished, so operations gathered
+                over many documents don't pile up pending calls for all their buckets.
+
+        Raises:
+            ValueError: If max_concurrency is not positive.
+        """
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be positive.")
         self._storage = storage
+        self._max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._compressor = compressor
+        self._bucket_cap = bucket_cap
+        self._stop_list: "collections.OrderedDict[Tuple[int, int], None]" = (
+            collections.OrderedDict()
+        )
+        self._random = random.Random(42)
+        self._capped = 0
+        self._stop_list_hits = 0
+        self._key_locks = _KeyLocks()
         self.n_hashes = lsh_config.n_hashes
         self.n_bands = lsh_config.n_bands
         self.rows_per_band = lsh_config.rows_per_band
+        self.fingerprint_bits = lsh_config.fingerprint_bits
+        self._engine = lsh_config.engine
+        self.probe_rows = lsh_config.probe_rows
+        self.forest_depths = lsh_config.forest_depths
+        self._max_false_negative_proba = lsh_config.max_false_negative_proba
+        self.size_partitions = lsh_config.size_partitions
         self._hashfunc = hash_.murmur3_32bit
 
     def _hash(self, arr: npt.NDArray, exact_part: Optional[str] = None) -> int:
@@ -114,132 +608,866 @@ class LSH:
             return self._hashfunc(arr.tobytes(order="C") + b"-" + exact_part.encode("utf-8"))
         return self._hashfunc(arr.tobytes(order="C"))
 
+    def bucket_keys(
+        self,
+        fingerprint: Fingerprint,
+        exact_part: Optional[str] = None,
+        n_tokens: Optional[int] = None,
+    ) -> List[Tuple[int, int]]:
+        """Calculate the buckets of a fingerprint as pairs of bucket ID and document hash.
+
+        Args:
+            fingerprint: Fingerprint of the document.
+            exact_part: Part that should be exactly matched.
+            n_tokens: Number of distinct tokens of the document, which selects the size
+                partition of a containment index. Without it the buckets of all partitions are
+                returned.
+
+        Returns:
+            Pairs of bucket ID and document hash.
+        """
+        if self.forest_depths:
+            if not self.size_partitions:
+                partitions: Iterable[int] = [0]
+            elif n_tokens is None:
+                partitions = range(self.size_partitions)
+            else:
+                partitions = [self.size_partition(n_tokens)]
+            return [
+                key
+                for partition in partitions
+                for depth in self.forest_depths
+                for key in self._prefix_keys(fingerprint, depth, exact_part, partition)
+            ]
+        keys = []
+        for band_number in range(self.n_bands):
+            start_index = band_number * self.rows_per_band
+            h = self._hash(fingerprint[start_index : start_index + self.rows_per_band], exact_part)
+            keys.append((band_number, h))
+        return keys
+
+    def _prefix_keys(
+        self, fingerprint: Fingerprint, depth: int, exact_part: Optional[str], partition: int = 0
+    ) -> List[Tuple[int, int]]:
+        """Calculate the LSH forest buckets of the prefixes with the given length."""
+        level = self.forest_depths.index(depth)
+        keys = []
+        for tree in range(self.n_bands):
+            start_index = tree * self.rows_per_band
+            h = self._hash(fingerprint[start_index : start_index + depth], exact_part)
+            bucket_id = (partition * self.n_bands + tree) * len(self.forest_depths) + level
+            keys.append((bucket_id, h))
+        return keys
+
+    def size_partition(self, n_tokens: int) -> int:
+        """Get the size partition of a containment index for a number of distinct tokens."""
+        return min(max(n_tokens, 1).bit_length() - 1, self.size_partitions - 1)
+
+    def _containment_keys(
+        self, fingerprint: Fingerprint, exact_part: Optional[str], threshold: float, n_tokens: int
+    ) -> List[Tuple[int, int]]:
+        """Calculate the buckets to read for a containment query, like in LSH Ensemble.
+
+        A document of size x contains the fraction t of a query of size q if their Jaccard
+        similarity is t * q / (q + x - t * q). Each partition is queried with the Jaccard
+        threshold for its largest size, so that none of its documents is missed. Partitions
+        with documents too small to contain the fraction t of the query are skipped. The last
+        partition has no largest size, so its shortest prefixes are read.
+
+        Source: Zhu et al., "LSH Ensemble: Internet-Scale Domain Search", 2016.
+        """
+        keys = []
+        overlap = threshold * n_tokens
+        for partition in range(self.size_partitions):
+            if partition == self.size_partitions - 1:
+                depth = self.forest_depths[0]
+            else:
+                max_size = (1 << (partition + 1)) - 1
+                if max_size < overlap:
+                    continue
+                jaccard = overlap / (n_tokens + max_size - overlap) if n_tokens else 0.0
+                depth = self.forest_depth(jaccard)
+            keys.extend(self._prefix_keys(fingerprint, depth, exact_part, partition))
+        return keys
+
+    def forest_depth(self, threshold: float) -> int:
+        """Choose the prefix length for a query of an LSH forest.
+
+        Args:
+            threshold: Jaccard similarity from which on documents should be found.
+
+        Returns:
+            The longest prefix which still finds documents above the threshold with the
+            configured false negative probability.
+        """
+        depth = self.forest_depths[0]
+        for candidate in self.forest_depths:
+            fn = _rust.false_negative_probability(threshold, self.n_bands, candidate)
+            if fn <= self._max_false_negative_proba:
+                depth = candidate
+        return depth
+
+    def query_keys(
+        self,
+        fingerprint: Fingerprint,
+        exact_part: Optional[str] = None,
+        probes: Optional[Fingerprint] = None,
+        threshold: Optional[float] = None,
+        n_tokens: Optional[int] = None,
+    ) -> List[Tuple[int, int]]:
+        """Calculate the buckets a query reads, including the probed neighbouring buckets.
+
+        The neighbouring buckets of a band replace one or up to ``probe_rows`` rows of the band
+        with the values in probes. Buckets which differ in fewer rows are more likely to hold
+        similar documents and come first.
+
+        Args:
+            fingerprint: Fingerprint of the document to search for.
+            exact_part: Part that should be exactly matched.
+            probes: Alternative value for each row of the fingerprint, see
+                :meth:`MinHasher.minhash_with_probes`. Without probes or with ``probe_rows=0``
+                only the buckets of the fingerprint are read.
+            threshold: Similarity threshold of the query. Only used by an LSH forest, which
+                reads the buckets of the prefix length for this threshold, or all buckets of the
+                fingerprint if it is None. For a containment index it is the containment
+                threshold.
+            n_tokens: Number of distinct tokens of the query, needed by a containment index.
+
+        Returns:
+            Pairs of bucket ID and document hash.
+
+        Raises:
+            ValueError: If a containment index is queried with threshold but without n_tokens.
+        """
+        if self.size_partitions and threshold is not None:
+            if n_tokens is None:
+                raise ValueError("A containment query needs the number of tokens of the query.")
+            return self._containment_keys(fingerprint, exact_part, threshold, n_tokens)
+        if self.forest_depths and threshold is not None:
+            return self._prefix_keys(fingerprint, self.forest_depth(threshold), exact_part)
+        return self.bucket_keys(fingerprint, exact_part) + self._probe_keys(
+            fingerprint, exact_part, probes
+        )
+
+    def _probe_keys(
+        self, fingerprint: Fingerprint, exact_part: Optional[str], probes: Optional[Fingerprint]
+    ) -> List[Tuple[int, int]]:
+        """Calculate the neighbouring buckets of a classic index, see :meth:`query_keys`."""
+        keys: List[Tuple[int, int]] = []
+        if probes is None or not self.probe_rows:
+            return keys
+        for n_rows in range(1, self.probe_rows + 1):
+            for band_number in range(self.n_bands):
+                start_index = band_number * self.rows_per_band
+                rows = [
+                    i
+                    for i in range(start_index, start_index + self.rows_per_band)
+                    if probes[i] != fingerprint[i] and probes[i] != _MERSENNE_PRIME
+                ]
+                for probed_rows in itertools.combinations(rows, n_rows):
+                    band = fingerprint[start_index : start_index + self.rows_per_band].copy()
+                    band[[i - start_index for i in probed_rows]] = probes[list(probed_rows)]
+                    keys.append((band_number, self._hash(band, exact_part)))
+        return keys
+
     async def insert(
-        self, document: StoredDocument, storage_level: StorageLevel = StorageLevel.Full
+        self,
+        document: StoredDocument,
+        storage_level: StorageLevel = StorageLevel.Full,
+        n_tokens: Optional[int] = None,
     ) -> int:
-        """Index a new document."""
+        """Index a new document.
+
+        Args:
+            document: The document to index. It needs a fingerprint.
+            storage_level: Which parts of the document to store.
+            n_tokens: Number of distinct tokens of the document, needed by a containment index.
+
+        Returns:
+            The ID of the document.
+
+        Raises:
+            ValueError: If the fingerprint or the number of tokens is missing.
+        """
         if document.fingerprint is None:
             raise ValueError("Cannot index document without fingerprint!")
-        doc_index = await self._storage.insert_document(
-            document.serialize(storage_level), document_id=document.id_
+        if self.size_partitions and n_tokens is None:
+            raise ValueError("A containment index needs the number of tokens of the document.")
+        return await self._insert(
+            document,
+            storage_level,
+            self.bucket_keys(document.fingerprint, document.exact_part, n_tokens),
+            n_tokens,
         )
-        tasks = []
-        for band_number in range(self.n_bands):
-            start_index = band_number * self.rows_per_band
-            h = self._hash(
-                document.fingerprint[start_index : start_index + self.rows_per_band],
-                document.exact_part,
+
+    async def insert_if_not_similar(
+        self,
+        document: StoredDocument,
+        *,
+        storage_level: StorageLevel = StorageLevel.Full,
+        probes: Optional[Fingerprint] = None,
+        threshold: Optional[float] = None,
+        n_tokens: Optional[int] = None,
+        is_similar: Optional[Callable[[StoredDocument], bool]] = None,
+        keys: Optional[List[Tuple[int, int]]] = None,
+    ) -> InsertResult:
+        """Index a new document, but only if no similar document is stored yet.
+
+        The bucket hashes are calculated once for both the lookup and the insert. Lookup and
+        insert hold a lock on every bucket they touch, so concurrent calls of this method on the
+        same object can't both insert two similar documents. Inserts with :meth:`insert` don't
+        take the locks.
+
+        Args:
+            document: The document to index. It needs a fingerprint.
+            storage_level: Which parts of the document to store.
+            probes: Optional values to probe neighbouring buckets, see :meth:`query_keys`.
+            threshold: Similarity threshold for an LSH forest, see :meth:`query_keys`.
+            n_tokens: Number of distinct tokens of the document, needed by a containment index.
+            is_similar: Optional check whether a candidate is really similar. Candidates are
+                fetched and checked in the order of :meth:`query_ids`. Without it the candidate
+                with the most band hits counts as similar.
+            keys: The :meth:`bucket_keys` of the document, if they are already calculated.
+
+        Returns:
+            The ID of the new document or of the similar one, and whether it was inserted.
+
+        Raises:
+            ValueError: If the fingerprint or the number of tokens is missing.
+        """
+        if document.fingerprint is None:
+            raise ValueError("Cannot index document without fingerprint!")
+        if self.size_partitions and n_tokens is None:
+            raise ValueError("A containment index needs the number of tokens of the document.")
+        if keys is None:
+            keys = self.bucket_keys(document.fingerprint, document.exact_part, n_tokens)
+        lookup_keys = self._lookup_keys(
+            document.fingerprint, document.exact_part, probes, threshold, n_tokens, keys
+        )
+        async with self._key_locks.hold(itertools.chain(keys, lookup_keys)):
+            buckets = await self._query_buckets(lookup_keys)
+            all_ids = np.fromiter(itertools.chain.from_iterable(buckets), dtype=np.uint64)
+            ids, counts = np.unique(all_ids, return_counts=True)
+            candidates = ids[np.argsort(-counts, kind="stable")].tolist()
+            if is_similar is None and candidates:
+                return InsertResult(candidates[0], False)
+            if is_similar is not None:
+                for start in range(0, len(candidates), 10):
+                    for doc in await self._query_documents(candidates[start : start + 10]):
+                        if is_similar(doc):
+                            return InsertResult(doc.id_, False)
+            return InsertResult(await self._insert(document, storage_level, keys, n_tokens), True)
+
+    def _lookup_keys(
+        self,
+        fingerprint: Fingerprint,
+        exact_part: Optional[str],
+        probes: Optional[Fingerprint],
+        threshold: Optional[float],
+        n_tokens: Optional[int],
+        keys: List[Tuple[int, int]],
+    ) -> List[Tuple[int, int]]:
+        """Calculate the :meth:`query_keys`, reusing the given bucket keys of the fingerprint."""
+        if self.size_partitions:
+            return self.query_keys(fingerprint, exact_part, probes, threshold, n_tokens)
+        if self.forest_depths:
+            if threshold is None:
+                return keys
+            # The bucket keys hold the prefixes of all trees, one prefix length after the other
+            level = self.forest_depths.index(self.forest_depth(threshold))
+            return keys[level * self.n_bands : (level + 1) * self.n_bands]
+        return keys + self._probe_keys(fingerprint, exact_part, probes)
+
+    async def _insert(
+        self,
+        document: StoredDocument,
+        storage_level: StorageLevel,
+        keys: List[Tuple[int, int]],
+        n_tokens: Optional[int],
+    ) -> int:
+        """Store a document and add it to the given buckets."""
+        if self.size_partitions:
+            # Keep the size partition, so that the document can be removed from its buckets
+            document = dataclasses.replace(document, n_tokens=n_tokens)
+        doc_index = await self._limited(
+            functools.partial(
+                self._storage.insert_document,
+                document.serialize(storage_level, self._compressor, self.fingerprint_bits),
+                document_id=document.id_,
             )
-            tasks.append(
-                self._storage.add_document_to_bucket(
-                    bucket_id=band_number, document_hash=h, document_id=doc_index
-                )
+        )
+        await self._gather_limited(
+            functools.partial(
+                self._storage.add_document_to_bucket,
+                bucket_id=bucket_id,
+                document_hash=h,
+                document_id=doc_index,
             )
-        await asyncio.gather(*tasks)
+            for bucket_id, h in keys
+        )
         return doc_index
 
-    async def remove_by_id(self, document_id: int, check_if_exists: bool = False) -> None:
+    async def remove_by_id(
+        self, document_id: int, check_if_exists: bool = False
+    ) -> Optional[StoredDocument]:
         """Remove the document with the given ID from the internal data structures.
 
         Args:
             document_id: ID of the document to remove.
             check_if_exists: Raise a KeyError if the document does not exist.
 
+        Returns:
+            The removed document or None if it did not exist.
+
         Raises:
             KeyError: If no document with the given ID is stored.
             TooLowStorageLevel: If the fingerprints needed to find the document in the
-                LSH structure are not available.
+                LSH structure are not available or only stored as b-bit fingerprints.
         """
+        if self.fingerprint_bits < FULL_FINGERPRINT_BITS and self._engine != "simhash":
+            raise TooLowStorageLevel(
+                "Documents cannot be removed with b-bit fingerprints, because the LSH buckets "
+                "cannot be calculated from them."
+            )
         try:
             doc = StoredDocument.deserialize(
-                await self._storage.query_document(document_id), document_id
+                await self._limited(functools.partial(self._storage.query_document, document_id)),
+                document_id,
+                self._compressor,
             )
         except KeyError:
             if check_if_exists:
                 raise
-            return
+            return None
         if doc.fingerprint is None:
             raise TooLowStorageLevel("Fingerprint needed to remove a document from the LSH!")
-        tasks = []
-        for band_number in range(self.n_bands):
-            start_index = band_number * self.rows_per_band
-            h = self._hash(
-                doc.fingerprint[start_index : start_index + self.rows_per_band], doc.exact_part
+        # Without the number of tokens the buckets of all size partitions are cleaned up
+        keys = self.bucket_keys(doc.fingerprint, doc.exact_part, doc.n_tokens)
+        await self._gather_limited(
+            functools.partial(
+                self._storage.remove_id_from_bucket,
+                bucket_id=bucket_id,
+                document_hash=h,
+                document_id=document_id,
             )
-            tasks.append(
-                self._storage.remove_id_from_bucket(
-                    bucket_id=band_number, document_hash=h, document_id=document_id
-                )
-            )
-        await asyncio.gather(*tasks)
-        await self._storage.remove_document(document_id=document_id)
+            for bucket_id, h in keys
+        )
+        await self._limited(
+            functools.partial(self._storage.remove_document, document_id=document_id)
+        )
+        for key in keys:
+            self._stop_list.pop(key, None)
+        return doc
 
     async def query(
-        self, fingerprint: Fingerprint, *, exact_part: Optional[str] = None
+        self,
+        fingerprint: Fingerprint,
+        *,
+        exact_part: Optional[str] = None,
+        probes: Optional[Fingerprint] = None,
+        threshold: Optional[float] = None,
+        n_tokens: Optional[int] = None,
     ) -> Collection[StoredDocument]:
-        """Find all similar documents."""
-        tasks = []
-        for band_number in range(self.n_bands):
-            start_index = band_number * self.rows_per_band
-            h = self._hash(fingerprint[start_index : start_index + self.rows_per_band], exact_part)
-            tasks.append(
-                self._storage.query_ids_from_bucket(bucket_id=band_number, document_hash=h)
-            )
+        """Find all similar documents.
+
+        Args:
+            fingerprint: Fingerprint of the document to search for.
+            exact_part: Part that should be exactly matched.
+            probes: Optional values to probe neighbouring buckets, see :meth:`query_keys`.
+            threshold: Similarity threshold for an LSH forest, see :meth:`query_keys`.
+            n_tokens: Number of distinct tokens of the query, see :meth:`query_keys`.
+
+        Returns:
+            The candidate documents.
+        """
         candidates = set()
-        for new_candidates in await asyncio.gather(*tasks):
+        keys = self.query_keys(fingerprint, exact_part, probes, threshold, n_tokens)
+        for new_candidates in await self._query_buckets(keys):
             candidates.update(new_candidates)
         return await self._query_documents(list(candidates))
 
     async def query_top_n(
-        self, n, fingerprint: Fingerprint, *, exact_part: Optional[str] = None
+        self,
+        n,
+        fingerprint: Fingerprint,
+        *,
+        exact_part: Optional[str] = None,
+        probes: Optional[Fingerprint] = None,
+        threshold: Optional[float] = None,
+        n_tokens: Optional[int] = None,
     ) -> Collection[StoredDocument]:
-        """Find n most similar documents."""
-        tasks = []
-        for band_number in range(self.n_bands):
-            start_index = band_number * self.rows_per_band
-            h = self._hash(fingerprint[start_index : start_index + self.rows_per_band], exact_part)
-            tasks.append(
-                self._storage.query_ids_from_bucket(bucket_id=band_number, document_hash=h)
+        """Find n most similar documents.
+
+        Args:
+            n: Maximum number of documents to return.
+            fingerprint: Fingerprint of the document to search for.
+            exact_part: Part that should be exactly matched.
+            probes: Optional values to probe neighbouring buckets, see :meth:`query_keys`.
+            threshold: Similarity threshold, see :meth:`query_ids`.
+            n_tokens: Number of distinct tokens of the query, see :meth:`query_keys`.
+
+        Returns:
+            The candidate documents sharing the most buckets with the fingerprint.
+        """
+        candidates = await self.query_ids(
+            fingerprint,
+            exact_part=exact_part,
+            n=n,
+            probes=probes,
+            threshold=threshold,
+            n_tokens=n_tokens,
+        )
+        return await self._query_documents(candidates.ids.tolist())
+
+    async def query_ids(
+        self,
+        fingerprint: Fingerprint,
+        *,
+        exact_part: Optional[str] = None,
+        n: Optional[int] = None,
+        probes: Optional[Fingerprint] = None,
+        threshold: Optional[float] = None,
+        n_tokens: Optional[int] = None,
+    ) -> CandidateIds:
+        """Find the IDs of similar documents without fetching the documents.
+
+        The IDs are ordered by the number of buckets they share with the fingerprint, so the most
+        likely candidates come first. Ties are ordered by ID.
+
+        An LSH forest without threshold but with n descends from the longest prefixes to the
+        shortest until n candidates are found. The IDs are then ordered by the longest prefix
+        they share with the fingerprint first.
+
+        Args:
+            fingerprint: Fingerprint of the document to search for.
+            exact_part: Part that should be exactly matched.
+            n: Optional maximum number of IDs to return.
+            probes: Optional values to probe neighbouring buckets, see :meth:`query_keys`. Hits
+                in probed buckets count like band hits.
+            threshold: Similarity threshold for an LSH forest, see :meth:`query_keys`.
+            n_tokens: Number of distinct tokens of the query, see :meth:`query_keys`.
+
+        Returns:
+            The IDs and their number of band hits.
+        """
+        if self.forest_depths and not self.size_partitions and threshold is None and n is not None:
+            return await self._forest_top_ids(fingerprint, exact_part, n)
+        buckets = await self._query_buckets(
+            self.query_keys(fingerprint, exact_part, probes, threshold, n_tokens)
+        )
+        all_ids = np.fromiter(itertools.chain.from_iterable(buckets), dtype=np.uint64)
+        ids, counts = np.unique(all_ids, return_counts=True)
+        order = np.argsort(-counts, kind="stable")[:n]
+        return CandidateIds(ids[order], counts[order].astype(np.uint32))
+
+    async def iter_query(
+        self,
+        fingerprint: Fingerprint,
+        *,
+        exact_part: Optional[str] = None,
+        batch_size: int = 100,
+        probes: Optional[Fingerprint] = None,
+        threshold: Optional[float] = None,
+        n_tokens: Optional[int] = None,
+    ) -> AsyncIterator[StoredDocument]:
+        """Find all similar documents and fetch them lazily in batches.
+
+        The candidates are yielded in the order of :meth:`query_ids`. The next batch of documents
+        is only fetched from the storage when the previous one is consumed.
+        """
+        doc_ids = (
+            await self.query_ids(
+                fingerprint,
+                exact_part=exact_part,
+                probes=probes,
+                threshold=threshold,
+                n_tokens=n_tokens,
             )
-        candidates: typing.Counter[int] = collections.Counter()
-        for new_candidates in await asyncio.gather(*tasks):
-            candidates.update(new_candidates)
-        return await self._query_documents([c for c, _ in candidates.most_common(n)])
+        ).ids.tolist()
+        for start in range(0, len(doc_ids), batch_size):
+            for doc in await self._query_documents(doc_ids[start : start + batch_size]):
+                yield doc
+
+    async def iter_candidate_pairs(
+        self, threshold: Optional[float] = None
+    ) -> AsyncIterator[Tuple[int, int]]:
+        """Iterate over all pairs of documents which share at least one bucket.
+
+        Instead of querying the buckets of every document, the bucket tables are scanned once
+        with :meth:`~narrow_down.storage.StorageBackend.iter_buckets`. Each pair is yielded with
+        the smaller ID first, once per bucket it shares. Pairs are not deduplicated across
+        buckets, so that the memory stays bounded by the largest bucket instead of growing with
+        the number of pairs. Neighbouring buckets are not probed and the bucket cap applies like
+        for queries.
+
+        Args:
+            threshold: Similarity threshold of an LSH forest, which selects the prefix length of
+                the buckets to scan. A classic index ignores it.
+
+        Yields:
+            Pairs of document IDs.
+
+        Raises:
+            ValueError: For a containment index or an LSH forest without threshold.
+        """
+        level = None
+        if self.size_partitions:
+            raise ValueError("Candidate pairs are not supported for containment search.")
+        if self.forest_depths:
+            if threshold is None:
+                raise ValueError("A threshold is needed for the candidate pairs of an LSH forest.")
+            level = self.forest_depths.index(self.forest_depth(threshold))
+        async for bucket_id, document_hash, ids in self._storage.iter_buckets(min_size=2):
+            if level is not None and bucket_id % len(self.forest_depths) != level:
+                continue
+            capped_ids = (
+                ids
+                if self._bucket_cap is None
+                else self._cap_bucket((bucket_id, document_hash), ids)
+            )
+            for pair in itertools.combinations(sorted(set(capped_ids)), 2):
+                yield pair
+
+    def bucket_cap_stats(self) -> Optional[BucketCapStats]:
+        """Get the counters of the bucket cap or None if no cap is configured."""
+        if self._bucket_cap is None:
+            return None
+        return BucketCapStats(
+            capped=self._capped,
+            stop_list_hits=self._stop_list_hits,
+            stop_list_size=len(self._stop_list),
+        )
+
+    def _get_semaphore(self) -> Optional[asyncio.Semaphore]:
+        """Get the semaphore for max_concurrency of the running event loop, if there is a limit."""
+        if self._max_concurrency is None:
+            return None
+        loop = asyncio.get_event_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            # Semaphores are bound to an event loop in Python < 3.10
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _limited(self, call: Callable[[], Awaitable[T]]) -> T:
+        """Make a storage call as soon as max_concurrency allows it."""
+        semaphore = self._get_semaphore()
+        if semaphore is None:
+            return await call()
+        async with semaphore:
+            return await call()
+
+    async def _gather_limited(self, calls: Iterable[Callable[[], Awaitable[T]]]) -> List[T]:
+        """Make storage calls concurrently, each one as soon as max_concurrency allows it.
+
+        The next call is only created when a slot is free, so the number of pending calls stays
+        within max_concurrency no matter how many calls are requested.
+        """
+        semaphore = self._get_semaphore()
+        if semaphore is None:
+            return await asyncio.gather(*(call() for call in calls))
+        tasks: List[asyncio.Future] = []
+        for call in calls:
+            await semaphore.acquire()
+            try:
+                task = asyncio.ensure_future(call())
+            except BaseException:
+                semaphore.release()
+                raise
+            task.add_done_callback(lambda _: semaphore.release())
+            tasks.append(task)
+        return await asyncio.gather(*tasks)
+
+    async def _forest_top_ids(
+        self, fingerprint: Fingerprint, exact_part: Optional[str], n: int
+    ) -> CandidateIds:
+        """Collect candidates from the longest prefixes down to the shortest until n are found."""
+        hits_by_id: typing.Dict[int, int] = {}
+        for depth in reversed(self.forest_depths):
+            buckets = await self._query_buckets(self._prefix_keys(fingerprint, depth, exact_part))
+            counts = collections.Counter(itertools.chain.from_iterable(buckets))
+            for doc_id, hits in sorted(counts.items(), key=lambda t: (-t[1], t[0])):
+                hits_by_id.setdefault(doc_id, hits)
+            if len(hits_by_id) >= n:
+                break
+        ids = list(hits_by_id)[:n]
+        return CandidateIds(
+            np.array(ids, dtype=np.uint64),
+            np.array([hits_by_id[i] for i in ids], dtype=np.uint32),
+        )
+
+    async def _query_buckets(self, keys: List[Tuple[int, int]]) -> List[Iterable[int]]:
+        """Fetch the document IDs of the given buckets, limited by the bucket cap."""
+        if self._stop_list:
+            self._stop_list_hits += sum(key in self._stop_list for key in keys)
+            keys = [key for key in keys if key not in self._stop_list]
+        buckets = await self._gather_limited(
+            functools.partial(
+                self._storage.query_ids_from_bucket, bucket_id=bucket_id, document_hash=h
+            )
+            for bucket_id, h in keys
+        )
+        if self._bucket_cap is None:
+            return buckets
+        return [self._cap_bucket(key, ids) for key, ids in zip(keys, buckets)]  # noqa=B905
+
+    def _cap_bucket(self, key: Tuple[int, int], ids: Iterable[int]) -> List[int]:
+        """Apply the bucket cap to the document IDs of one bucket."""
+        cap = typing.cast(BucketCap, self._bucket_cap)
+        ids = list(ids)
+        if cap.stop_list_threshold is not None and len(ids) >= cap.stop_list_threshold:
+            self._stop_list[key] = None
+            while len(self._stop_list) > cap.stop_list_max_size:
+                self._stop_list.popitem(last=False)
+        if len(ids) <= cap.max_size:
+            return ids
+        self._capped += 1
+        if cap.policy is OversizedBucketPolicy.Skip:
+            return []
+        if cap.policy is OversizedBucketPolicy.Sample:
+            return self._random.sample(ids, cap.max_size)
+        return ids[: cap.max_size]
+
+    async def query_documents(self, doc_ids: typing.List[int]) -> typing.List[StoredDocument]:
+        """Fetch stored documents by their IDs.
+
+        Args:
+            doc_ids: IDs of the documents.
+
+        Returns:
+            The deserialized documents in the order of the IDs.
+        """
+        return await self._query_documents(doc_ids)
 
     async def _query_documents(self, doc_ids: typing.List[int]):
-        """Fetch a document from the storage and deserialize it."""
-        docs = await self._storage.query_documents(doc_ids)
-        return [
-            StoredDocument.deserialize(doc, doc_id)
-            for doc, doc_id in zip(docs, doc_ids)  # noqa=B905
-        ]
+        """Fetch documents from the storage and deserialize them."""
+        docs = await self._limited(functools.partial(self._storage.query_documents, doc_ids))
+        return StoredDocument.deserialize_many(docs, doc_ids, self._compressor)
 
 
 def find_optimal_config(
-    jaccard_threshold: float, max_false_negative_proba: float, max_false_positive_proba: float
+    jaccard_threshold: float,
+    max_false_negative_proba: float,
+    max_false_positive_proba: float,
+    engine: str = "minhash",
+    fingerprint_bits: int = FULL_FINGERPRINT_BITS,
+    max_probe_rows: int = 0,
+    forest_trees: Optional[int] = None,
+    containment: bool = False,
+) -> MinhashLshConfig:
+    """Find the optimal configuration given the provided target parameters.
+
+    With the ``"simhash"`` engine the fingerprint has always 64 bits which are stored with one
+    bit per value, so only the split into bands is optimized.
+
+    With max_probe_rows > 0 also configurations with multi-probe queries are considered. Of all
+    configurations which reach the error thresholds the one with the fewest bands is taken,
+    because each band is a stored bucket entry per document.
+
+    With forest_trees an LSH forest with this number of trees and the prefix lengths in
+    :data:`FOREST_DEPTHS` is configured instead. The thresholds are then only used as defaults.
+    With containment an LSH forest per set size partition is configured, with 8 trees if
+    forest_trees is not given.
+
+    Raises:
+        ValueError: If max_probe_rows is not between 0 and MAX_PROBE_ROWS or the engine does not
+            support probing, or if an LSH forest is requested together with probing or SimHash.
+    """
+    if containment:
+        return _find_forest_config(
+            forest_trees or 8,
+            max_false_negative_proba,
+            engine,
+            fingerprint_bits,
+            max_probe_rows,
+            CONTAINMENT_PARTITIONS,
+        )
+    if forest_trees is not None:
+        return _find_forest_config(
+            forest_trees, max_false_negative_proba, engine, fingerprint_bits, max_probe_rows
+        )
+    if not 0 <= max_probe_rows <= MAX_PROBE_ROWS:
+        raise ValueError(f"max_probe_rows must be between 0 and {MAX_PROBE_ROWS}.")
+    if max_probe_rows and engine not in PROBE_ENGINES:
+        raise ValueError(
+            f"The fingerprint engine {engine} does not support probing. Options: {PROBE_ENGINES}"
+        )
+    candidates = []
+    for probe_rows in range(max_probe_rows + 1):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            if engine == "simhash":
+                config = _find_simhash_config(
+                    jaccard_threshold,
+                    max_false_negative_proba,
+                    max_false_positive_proba,
+                    probe_rows,
+                )
+            else:
+                config = _find_minhash_config(
+                    jaccard_threshold,
+                    max_false_negative_proba,
+                    max_false_positive_proba,
+                    engine,
+                    fingerprint_bits,
+                    probe_rows,
+                )
+        candidates.append((config, caught))
+    reached = [(config, caught) for config, caught in candidates if not caught] or candidates[:1]
+    config, caught = min(
+        reached, key=lambda c: (c[0].n_bands, c[0].n_hashes, c[0].probe_rows)  # type: ignore
+    )
+    for warning in caught:
+        warnings.warn(warning.message, warning.category, stacklevel=2)
+    return config
+
+
+def _find_forest_config(
+    forest_trees: int,
+    max_false_negative_proba: float,
+    engine: str,
+    fingerprint_bits: int,
+    max_probe_rows: int,
+    size_partitions: int = 0,
+) -> MinhashLshConfig:
+    if forest_trees < 1:
+        raise ValueError("An LSH forest needs at least one tree.")
+    if max_probe_rows or engine == "simhash":
+        raise ValueError("An LSH forest cannot be combined with probing or SimHash.")
+    max_depth = FOREST_DEPTHS[-1]
+    return MinhashLshConfig(
+        n_hashes=forest_trees * max_depth,
+        n_bands=forest_trees,
+        rows_per_band=max_depth,
+        engine=engine,
+        fingerprint_bits=fingerprint_bits,
+        forest_depths=FOREST_DEPTHS,
+        max_false_negative_proba=max_false_negative_proba,
+        size_partitions=size_partitions,
+    )
+
+
+def _find_minhash_config(
+    jaccard_threshold: float,
+    max_false_negative_proba: float,
+    max_false_positive_proba: float,
+    engine: str,
+    fingerprint_bits: int,
+    probe_rows: int,
 ) -> MinhashLshConfig:
-    """Find the optimal configuration given the provided target parameters."""
     num_perm = 16
     max_num_permutations = 16384
-    b, r = _params_given_false_negative_proba(jaccard_threshold, num_perm, max_false_negative_proba)
-    while _rust.false_positive_probability(jaccard_threshold, b, r) > max_false_positive_proba:
+    b, r = _params_given_false_negative_proba(
+        jaccard_threshold, num_perm, max_false_negative_proba, probe_rows, engine
+    )
+    while (
+        _false_positive_probability(jaccard_threshold, b, r, probe_rows, engine)
+        > max_false_positive_proba
+    ):
         if num_perm >= max_num_permutations:
             warnings.warn("Unable to reach error thresholds. Taking the best value.", stacklevel=2)
             break
         num_perm *= 2
         b, r = _params_given_false_negative_proba(
-            jaccard_threshold, num_perm, max_false_negative_proba
+            jaccard_threshold, num_perm, max_false_negative_proba, probe_rows, engine
         )
 
-    return MinhashLshConfig(n_hashes=num_perm, n_bands=b, rows_per_band=r)
+    return MinhashLshConfig(
+        n_hashes=num_perm,
+        n_bands=b,
+        rows_per_band=r,
+        engine=engine,
+        fingerprint_bits=fingerprint_bits,
+        probe_rows=probe_rows,
+    )
+
+
+def _find_simhash_config(
+    jaccard_threshold: float,
+    max_false_negative_proba: float,
+    max_false_positive_proba: float,
+    probe_rows: int,
+) -> MinhashLshConfig:
+    # The bits agree independently, so the same banding math as for minhash applies
+    threshold = simhash_similarity(jaccard_threshold)
+    n_bits = SimHasher.n_hashes
+    b, r = _params_given_false_negative_proba(
+        threshold, n_bits, max_false_negative_proba, probe_rows, "simhash"
+    )
+    if (
+        _false_positive_probability(threshold, b, r, probe_rows, "simhash")
+        > max_false_positive_proba
+    ):
+        warnings.warn("Unable to reach error thresholds. Taking the best value.", stacklevel=2)
+    return MinhashLshConfig(
+        n_hashes=n_bits,
+        n_bands=b,
+        rows_per_band=r,
+        engine="simhash",
+        fingerprint_bits=1,
+        probe_rows=probe_rows,
+    )
+
+
+_GAUSS_NODES, _GAUSS_WEIGHTS = np.polynomial.legendre.leggauss(64)
+
+
+def _band_hit_probability(s: npt.NDArray, r: int, probe_rows: int, engine: str) -> npt.NDArray:
+    """Probability that a band or one of its probed neighbours holds a document of similarity s.
+
+    A differing row is found by a probe for SimHash always. For minhash it is only found if the
+    document lacks the shingle with the smallest value of the query, which is assumed to happen
+    in half of the cases for which the shingle is in the query, i.e. with probability s / 2.
+    """
+    recovered = (1 - s) * (1.0 if engine == "simhash" else s / 2)
+    return np.sum(
+        [
+            math.factorial(r)
+            // (math.factorial(k) * math.factorial(r - k))
+            * s ** (r - k)
+            * recovered**k
+            for k in range(min(probe_rows, r) + 1)
+        ],
+        axis=0,
+    )
+
+
+def _integrate(f, lower: float, upper: float) -> float:
+    """Integrate a vectorized function with Gauss-Legendre quadrature."""
+    x = (upper - lower) / 2 * _GAUSS_NODES + (upper + lower) / 2
+    return float((upper - lower) / 2 * np.sum(_GAUSS_WEIGHTS * f(x)))
+
+
+def _false_positive_probability(
+    threshold: float, b: int, r: int, probe_rows: int = 0, engine: str = "minhash"
+) -> float:
+    if not probe_rows:
+        return _rust.false_positive_probability(threshold, b, r)
+    return _integrate(
+        lambda s: 1 - (1 - _band_hit_probability(s, r, probe_rows, engine)) ** b, 0.0, threshold
+    )
+
+
+def _false_negative_probability(
+    threshold: float, b: int, r: int, probe_rows: int = 0, engine: str = "minhash"
+) -> float:
+    if not probe_rows:
+        return _rust.false_negative_probability(threshold, b, r)
+    return _integrate(
+        lambda s: (1 - _band_hit_probability(s, r, probe_rows, engine)) ** b, threshold, 1.0
+    )
 
 
 def _params_given_false_negative_proba(
-    threshold: float, num_perm: int, max_false_negative_proba: float
+    threshold: float,
+    num_perm: int,
+    max_false_negative_proba: float,
+    probe_rows: int = 0,
+    engine: str = "minhash",
 ):
     for b in range(1, num_perm + 1):
         r = num_perm // b
-        fn = _rust.false_negative_probability(threshold, b, r)
+        fn = _false_negative_probability(threshold, b, r, probe_rows, engine)
         if fn <= max_false_negative_proba:
             return b, r
     warnings.warn(
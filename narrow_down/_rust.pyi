@@ -2,27 +2,69 @@
 
 The actual code is in the folder /rust.
 """
-from typing import Dict, Iterable, List, Optional, Set, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import numpy as np
 import numpy.typing as npt
 
+class Compressor:
+    spec: str
+    dictionary: bytes
+    def __init__(self, spec: str, dictionary: Optional[bytes] = None): ...
+    def compress(self, data: bytes) -> bytes: ...
+    def decompress(self, data: bytes) -> bytes: ...
+
+def train_compression_dictionary(samples: List[bytes], max_size: int) -> bytes: ...
+
 class RustMemoryStore:
     num: int
+    dense_ids: bool
+    def __init__(
+        self,
+        dense_ids: bool = False,
+        spill_file: Optional[str] = None,
+        cache_size: int = 10000,
+        max_id_gap: int = 2**20,
+    ): ...
     def serialize(self) -> bytes: ...
     def to_file(self, file_path: str): ...
     @classmethod
-    def deserialize(cls, msgpack: bytes) -> "RustMemoryStore": ...
+    def deserialize(
+        cls,
+        msgpack: bytes,
+        spill_file: Optional[str] = None,
+        cache_size: int = 10000,
+        max_id_gap: int = 2**20,
+    ) -> "RustMemoryStore": ...
     @classmethod
-    def from_file(cls, file_path: str) -> "RustMemoryStore": ...
+    def from_file(
+        cls,
+        file_path: str,
+        spill_file: Optional[str] = None,
+        cache_size: int = 10000,
+        max_id_gap: int = 2**20,
+    ) -> "RustMemoryStore": ...
+    def to_shared_file(self, file_path: str): ...
     def insert_setting(self, key: str, value: str): ...
     def query_setting(self, key: str) -> Optional[str]: ...
     def insert_document(self, document: bytes, document_id: Optional[int] = None) -> int: ...
-    def query_document(self, document_id: int) -> bytes: ...
+    def query_document(self, document_id: int) -> Optional[bytes]: ...
+    def query_documents(self, document_ids: List[int]) -> List[Optional[bytes]]: ...
     def remove_document(self, document_id: int): ...
     def add_document_to_bucket(self, bucket_id: int, document_hash: int, document_id: int): ...
     def query_ids_from_bucket(self, bucket_id, document_hash: int) -> Iterable[int]: ...
     def remove_id_from_bucket(self, bucket_id: int, document_hash: int, document_id: int): ...
+    bucket_chunks: int
+    def query_bucket_chunk(self, chunk: int, min_size: int) -> List[Tuple[int, int, List[int]]]: ...
+
+class RustSharedMemoryStore:
+    def __init__(self, file_path: str): ...
+    def query_setting(self, key: str) -> Optional[str]: ...
+    def query_document(self, document_id: int) -> Optional[bytes]: ...
+    def query_documents(self, document_ids: List[int]) -> List[Optional[bytes]]: ...
+    def query_ids_from_bucket(self, bucket_id, document_hash: int) -> Iterable[int]: ...
+    bucket_chunks: int
+    def query_bucket_chunk(self, chunk: int, min_size: int) -> List[Tuple[int, int, List[int]]]: ...
 
 def murmur3_32bit(s: Union[str, bytes]) -> int: ...
 def xxhash_32bit(s: Union[str, bytes]) -> int: ...
@@ -30,16 +72,29 @@ def xxhash_64bit(s: Union[str, bytes]) -> int: ...
 def minhash(
     shingle_list: List[str], a: npt.NDArray[np.uint32], b: npt.NDArray[np.uint32]
 ) -> npt.NDArray[np.uint32]: ...
+def minhash_with_runner_up(
+    shingle_list: List[str], a: npt.NDArray[np.uint32], b: npt.NDArray[np.uint32]
+) -> Tuple[List[int], List[int]]: ...
+def one_permutation_minhash(
+    shingle_list: List[str], n_hashes: int, a: int, b: int, seed: int
+) -> List[int]: ...
+def weighted_minhash(token_weights: Dict[str, float], n_hashes: int, seed: int) -> List[int]: ...
+def simhash(shingle_list: List[str], seed: int) -> int: ...
 def false_positive_probability(threshold: float, b: int, r: int) -> float: ...
 def false_negative_probability(threshold: float, b: int, r: int) -> float: ...
 def stored_document_to_protobuf(
-    document: Optional[str],
-    exact_part: Optional[str],
-    fingerprint: Optional[npt.NDArray[np.uint32]],
-    data: Optional[str],
+    document: Optional[str] = None,
+    exact_part: Optional[str] = None,
+    fingerprint: Optional[npt.NDArray[np.uint32]] = None,
+    data: Optional[str] = None,
+    fingerprint_bits: int = 32,
+    n_tokens: Optional[int] = None,
 ) -> bytes: ...
 def protobuf_to_stored_document(
     document: bytes,
 ) -> Dict: ...
+def protobuf_to_stored_documents(
+    documents: List[bytes],
+) -> Dict: ...
 def char_ngrams_bytes(s: bytes, n: int, pad_char: Optional[bytes]) -> Set[str]: ...
 def char_ngrams_str(s: str, n: int, pad_char: Optional[str]) -> Set[str]: ...
@@ -25,6 +25,26 @@ def word_ngrams(s: str, n: int) -> Set[str]:
     return {" ".join(words[i : i + n]) for i in range(len(words) - n + 1)}
 
 
+def count_word_ngrams(s: str, n: int) -> Dict[str, int]:
+    """Count all word n-grams in s.
+
+    Args:
+        s: String to analyze
+        n: The desired length of the n-grams. E.g. `2` to get 2-grams like
+            `"in the"`, `"the house"`
+
+    Returns:
+        A dictionary which maps the found n-grams to the number of occurrences. Like in
+        :func:`word_ngrams` a string with `n` words or less is itself the only n-gram.
+    """
+    if not s:
+        return {}
+    words = s.split()
+    if len(words) <= n:
+        return {" ".join(words): 1}
+    return collections.Counter(" ".join(words[i : i + n]) for i in range(len(words) - n + 1))
+
+
 def char_ngrams(s: str, n: int, pad_char: str = "$") -> Set[str]:
     """Get all character n-grams contained in the string s.
 
@@ -54,7 +74,7 @@ def count_char_ngrams(s: str, n: int, pad_char: str = "$") -> Dict[str, int]:
             `"$a", "ab", "b$"`. Padding can be deactivated by setting pad_char to `""`.
 
     Returns:
-        A dictionary which maps the found n-grams to the number of occurences.
+        A dictionary which maps the found n-grams to the number of occurrences.
     """
     if not s:
         return {}
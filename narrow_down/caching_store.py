@@ -0,0 +1,146 @@
+"""Storage backend wrapper which caches reads of another backend in process."""
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from narrow_down._cache import CacheStats, LruCache
+from narrow_down.storage import StorageBackend
+
+
+class CachingStore(StorageBackend):
+    """Read cache in front of another storage backend.
+
+    Bucket contents and documents are cached with LRU eviction. This is useful for remote
+    backends like :class:`~narrow_down.scylladb.ScyllaDBStore` or
+    :class:`~narrow_down.sqlite.SQLiteStore` where similar queries read the same buckets again and
+    again.
+
+    Writes through this object invalidate the affected entries once they are done. Writes through
+    other objects, e.g. by other processes, are not noticed. Set a time-to-live to bound the
+    staleness in this case.
+    """
+
+    def __init__(
+        self,
+        backend: StorageBackend,
+        max_buckets: int = 100000,
+        max_documents: int = 10000,
+        ttl: Optional[float] = None,
+    ):
+        """Create a new CachingStore.
+
+        Args:
+            backend: The storage backend to wrap.
+            max_buckets: Maximum number of buckets to cache.
+            max_documents: Maximum number of documents to cache.
+            ttl: Optional maximum age of cached entries in seconds.
+        """
+        self.backend = backend
+        self._buckets: LruCache[Tuple[int, int], Tuple[int, ...]] = LruCache(max_buckets, ttl)
+        self._documents: LruCache[int, bytes] = LruCache(max_documents, ttl)
+
+    def bucket_cache_stats(self) -> CacheStats:
+        """Get the counters of the bucket cache."""
+        return self._buckets.stats()
+
+    def document_cache_stats(self) -> CacheStats:
+        """Get the counters of the document cache."""
+        return self._documents.stats()
+
+    async def initialize(self) -> "CachingStore":
+        """Initialize the wrapped backend.
+
+        Returns:
+            self
+        """
+        await self.backend.initialize()
+        return self
+
+    async def insert_setting(self, key: str, value: str):
+        """Store a setting as key-value pair."""
+        await self.backend.insert_setting(key, value)
+
+    async def query_setting(self, key: str) -> Optional[str]:
+        """Query a setting with the given key."""
+        return await self.backend.query_setting(key)
+
+    async def insert_document(self, document: bytes, document_id: Optional[int] = None) -> int:
+        """Add the data of a document to the storage and return its ID."""
+        document_id = await self.backend.insert_document(document, document_id)
+        self._documents.invalidate(document_id)
+        return document_id
+
+    async def query_document(self, document_id: int) -> bytes:
+        """Get the data belonging to a document.
+
+        Args:
+            document_id: Key under which the data is stored.
+
+        Returns:
+            The document value for the given ID.
+
+        Raises:
+            KeyError: If no document with the given ID is stored.
+        """
+        document = self._documents.get(document_id)
+        if document is None:
+            generation = self._documents.generation
+            document = await self.backend.query_document(document_id)
+            self._documents.put(document_id, document, generation)
+        return document
+
+    async def query_documents(self, document_ids: List[int]) -> List[bytes]:
+        """Get the data belonging to multiple documents.
+
+        Only the documents missing in the cache are queried from the backend, in one batch.
+
+        Args:
+            document_ids: Keys under which the data is stored.
+
+        Returns:
+            The list of document values for the given IDs.
+
+        Raises:
+            KeyError: If no document was found for at least one of the ids.
+        """
+        documents = [self._documents.get(doc_id) for doc_id in document_ids]
+        missing = [
+            doc_id for doc_id, doc in zip(document_ids, documents) if doc is None  # noqa=B905
+        ]
+        if missing:
+            generation = self._documents.generation
+            found = dict(zip(missing, await self.backend.query_documents(missing)))  # noqa=B905
+            for doc_id, doc in found.items():
+                self._documents.put(doc_id, doc, generation)
+            documents = [
+                found[i] if d is None else d for i, d in zip(document_ids, documents)  # noqa=B905
+            ]
+        return documents  # type: ignore
+
+    async def remove_document(self, document_id: int):
+        """Remove a document given by ID from the list of documents."""
+        await self.backend.remove_document(document_id)
+        self._documents.invalidate(document_id)
+
+    async def add_document_to_bucket(self, bucket_id: int, document_hash: int, document_id: int):
+        """Link a document to a bucket."""
+        await self.backend.add_document_to_bucket(bucket_id, document_hash, document_id)
+        self._buckets.invalidate((bucket_id, document_hash))
+
+    async def query_ids_from_bucket(self, bucket_id: int, document_hash: int) -> Iterable[int]:
+        """Get all document IDs stored in a bucket for a certain hash value."""
+        key = (bucket_id, document_hash)
+        ids = self._buckets.get(key)
+        if ids is None:
+            generation = self._buckets.generation
+            ids = tuple(await self.backend.query_ids_from_bucket(bucket_id, document_hash))
+            self._buckets.put(key, ids, generation)
+        return ids
+
+    async def remove_id_from_bucket(self, bucket_id: int, document_hash: int, document_id: int):
+        """Remove a document from a bucket."""
+        await self.backend.remove_id_from_bucket(bucket_id, document_hash, document_id)
+        self._buckets.invalidate((bucket_id, document_hash))
+
+    async def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets of the wrapped backend, bypassing the cache."""
+        async for entry in self.backend.iter_buckets(min_size):
+            yield entry
@@ -0,0 +1,210 @@
+"""Command line interface of narrow-down.
+
+Usage example, keeping only the first of all similar lines of a JSONL file::
+
+    narrow-down dedup corpus.jsonl --format jsonl --field text -o unique.jsonl
+"""
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import json
+import sys
+from typing import IO, Deque, Iterator, List, Optional
+
+from narrow_down.similarity_store import SimilarityStore
+from narrow_down.storage import StorageBackend, StorageLevel
+
+OUTPUT_MODES = ("keep", "drop", "cluster")
+
+DEFAULT_THRESHOLD = 0.75
+DEFAULT_TOKENIZE = "word_ngrams(3)"
+
+
+class _InputError(ValueError):
+    """The input file or the options cannot be processed, reported without a traceback."""
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the command line interface.
+
+    Args:
+        argv: Command line arguments without the program name. Per default ``sys.argv`` is used.
+
+    Returns:
+        The exit code.
+    """
+    args = _parser().parse_args(argv)
+    return args.command(args)
+
+
+def _parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="narrow-down", description="Fast fuzzy text search")
+    subparsers = parser.add_subparsers(required=True, metavar="command")
+
+    dedup = subparsers.add_parser(
+        "dedup",
+        help="Remove near-duplicate lines of a text or JSONL file",
+        description="Stream the lines of a file and keep only the first of all similar lines.",
+    )
+    dedup.set_defaults(command=_dedup)
+    dedup.add_argument("input", help="Input file, or - for stdin")
+    dedup.add_argument("-o", "--output", default="-", help="Output file, default: stdout")
+    dedup.add_argument(
+        "--format",
+        choices=("text", "jsonl"),
+        default="text",
+        help="Input format: one text per line or one JSON object per line (default: text)",
+    )
+    dedup.add_argument(
+        "--field", default="text", help="Field with the text of JSONL records (default: text)"
+    )
+    dedup.add_argument(
+        "--mode",
+        choices=OUTPUT_MODES,
+        default="keep",
+        help="Write the kept lines, the dropped lines, or all lines with a cluster ID. The "
+        "cluster ID is prepended with a tab to text lines and added as field cluster_id to "
+        "JSONL records (default: keep)",
+    )
+    dedup.add_argument(
+        "--threshold",
+        type=float,
+        help=f"Jaccard similarity threshold (default: {DEFAULT_THRESHOLD})",
+    )
+    dedup.add_argument(
+        "--tokenize",
+        help='Built-in tokenizer, e.g. "word_ngrams(3)" or "char_ngrams(4)" '
+        f"(default: {DEFAULT_TOKENIZE})",
+    )
+    dedup.add_argument(
+        "--validate",
+        action="store_true",
+        default=None,
+        help="Keep the texts in the index to validate candidates, which removes false positives "
+        "but needs more memory",
+    )
+    dedup.add_argument(
+        "--storage",
+        help="SQLite file to keep the index in instead of memory. An existing file is extended, "
+        "so it can be used to deduplicate against earlier runs. Its threshold, tokenizer and "
+        "validation are kept, so these options may only be given if they match",
+    )
+    dedup.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes to tokenize and fingerprint the texts in (default: 1)",
+    )
+    dedup.add_argument(
+        "--batch-size", type=int, default=1000, help="Texts per batch of a worker (default: 1000)"
+    )
+    return parser
+
+
+def _dedup(args: argparse.Namespace) -> int:
+    with contextlib.ExitStack() as stack:
+        infile = sys.stdin if args.input == "-" else stack.enter_context(_open(args.input, "r"))
+        outfile = sys.stdout if args.output == "-" else stack.enter_context(_open(args.output, "w"))
+        executor = None
+        if args.workers > 1:
+            executor = stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+            )
+        try:
+            asyncio.run(_dedup_stream(args, infile, outfile, executor))
+        except _InputError as e:
+            print(f"narrow-down: error: {e}", file=sys.stderr)
+            return 1
+    return 0
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    return open(path, mode, encoding="utf-8")  # pylint: disable=consider-using-with
+
+
+async def _dedup_stream(
+    args: argparse.Namespace,
+    infile: IO[str],
+    outfile: IO[str],
+    executor: Optional[concurrent.futures.Executor],
+):
+    storage = None
+    if args.storage:
+        from narrow_down.sqlite import SQLiteStore  # pylint: disable=import-outside-toplevel
+
+        storage = SQLiteStore(args.storage)
+    if storage is not None and await storage.query_setting("lsh_config"):
+        await _check_stored_settings(args, storage)
+        simstore = await SimilarityStore.load_from_storage(storage)
+    else:
+        simstore = await SimilarityStore.create(
+            storage=storage,
+            storage_level=StorageLevel.Document if args.validate else StorageLevel.Minimal,
+            tokenize=args.tokenize or DEFAULT_TOKENIZE,
+            similarity_threshold=args.threshold
+            if args.threshold is not None
+            else DEFAULT_THRESHOLD,
+        )
+
+    # The raw lines are kept until their results are written, at most two batches
+    records: Deque[str] = collections.deque()
+
+    def texts() -> Iterator[str]:
+        for number, line in enumerate(_lines(infile), start=1):
+            records.append(line)
+            yield _jsonl_text(line, args.field, number) if args.format == "jsonl" else line
+
+    async for result in simstore.dedup(texts(), executor=executor, batch_size=args.batch_size):
+        record = records.popleft()
+        if args.mode == "cluster":
+            outfile.write(_with_cluster_id(record, result.cluster_id, args.format) + "\n")
+        elif result.is_duplicate == (args.mode == "drop"):
+            outfile.write(record + "\n")
+
+
+async def _check_stored_settings(args: argparse.Namespace, storage: StorageBackend):
+    """Fail if options given on the command line differ from the settings of an existing index."""
+    threshold = await storage.query_setting("similarity_threshold")
+    tokenize = await storage.query_setting("tokenize")
+    storage_level = await storage.query_setting("storage_level")
+    conflicts = []
+    if args.threshold is not None and threshold is not None and args.threshold != float(threshold):
+        conflicts.append(f"--threshold {args.threshold} (index: {threshold})")
+    if args.tokenize is not None and args.tokenize != tokenize:
+        conflicts.append(f"--tokenize {args.tokenize} (index: {tokenize})")
+    if (
+        args.validate
+        and storage_level is not None
+        and not StorageLevel(int(storage_level)) & StorageLevel.Document
+    ):
+        conflicts.append("--validate (index: without texts)")
+    if conflicts:
+        raise _InputError(
+            f"the index in {args.storage} was created with other settings: {', '.join(conflicts)}"
+        )
+
+
+def _lines(infile: IO[str]) -> Iterator[str]:
+    for line in infile:
+        stripped = line.rstrip("\n")
+        if stripped:
+            yield stripped
+
+
+def _jsonl_text(line: str, field: str, number: int) -> str:
+    try:
+        record = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise _InputError(f"record {number} is not valid JSON: {e}") from e
+    text = record.get(field) if isinstance(record, dict) else None
+    if not isinstance(text, str):
+        raise _InputError(f"record {number} has no string field {field!r}")
+    return text
+
+
+def _with_cluster_id(record: str, cluster_id: int, input_format: str) -> str:
+    if input_format == "jsonl":
+        return json.dumps({**json.loads(record), "cluster_id": cluster_id}, ensure_ascii=False)
+    return f"{cluster_id}\t{record}"
@@ -0,0 +1,190 @@
+"""Storage backend wrapper which coalesces concurrent reads of another backend."""
+import asyncio
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple, cast
+
+from narrow_down.storage import StorageBackend
+
+
+class CoalescingStore(StorageBackend):
+    """Wrapper which merges concurrent identical reads into one request to another backend.
+
+    Concurrent queries, e.g. many ``SimilarityStore.query`` calls run with ``asyncio.gather``,
+    often read the same buckets and documents at the same time. With this wrapper a read which
+    is already in flight is shared by all callers. In addition, single document reads are
+    collected for a short time window and then fetched with one ``query_documents`` call.
+
+    Reads which start after a write through this object has finished never share a request
+    which was started before the write.
+    """
+
+    def __init__(
+        self,
+        backend: StorageBackend,
+        batch_window: float = 0.0,
+        max_batch_size: int = 500,
+    ):
+        """Create a new CoalescingStore.
+
+        Args:
+            backend: The storage backend to wrap.
+            batch_window: Time in seconds to collect document reads before sending them as one
+                batch. With the default of 0 only reads issued in the same iteration of the event
+                loop are batched.
+            max_batch_size: Maximum number of documents in one batch. A full batch is sent
+                immediately.
+        """
+        self.backend = backend
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._bucket_reads: Dict[Tuple[int, int], "asyncio.Future[Tuple[int, ...]]"] = {}
+        self._document_reads: Dict[int, "asyncio.Future[bytes]"] = {}
+        self._pending_documents: List[Tuple[int, "asyncio.Future[bytes]"]] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._tasks: Set["asyncio.Task[None]"] = set()
+
+    async def initialize(self) -> "CoalescingStore":
+        """Initialize the wrapped backend.
+
+        Returns:
+            self
+        """
+        await self.backend.initialize()
+        return self
+
+    async def insert_setting(self, key: str, value: str):
+        """Store a setting as key-value pair."""
+        await self.backend.insert_setting(key, value)
+
+    async def query_setting(self, key: str) -> Optional[str]:
+        """Query a setting with the given key."""
+        return await self.backend.query_setting(key)
+
+    async def insert_document(self, document: bytes, document_id: Optional[int] = None) -> int:
+        """Add the data of a document to the storage and return its ID."""
+        document_id = await self.backend.insert_document(document, document_id)
+        self._document_reads.pop(document_id, None)
+        return document_id
+
+    async def query_document(self, document_id: int) -> bytes:
+        """Get the data belonging to a document.
+
+        Args:
+            document_id: Key under which the data is stored.
+
+        Returns:
+            The document value for the given ID.
+
+        Raises:
+            KeyError: If no document with the given ID is stored.
+        """
+        return await asyncio.shield(self._document_future(document_id))
+
+    async def query_documents(self, document_ids: List[int]) -> List[bytes]:
+        """Get the data belonging to multiple documents.
+
+        Args:
+            document_ids: Keys under which the data is stored.
+
+        Returns:
+            The list of document values for the given IDs.
+
+        Raises:
+            KeyError: If no document was found for at least one of the ids.
+        """
+        futures = [asyncio.shield(self._document_future(doc_id)) for doc_id in document_ids]
+        # Wait for all of them, so that no exception of a failed read is left unretrieved
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return cast(List[bytes], results)
+
+    async def remove_document(self, document_id: int):
+        """Remove a document given by ID from the list of documents."""
+        await self.backend.remove_document(document_id)
+        self._document_reads.pop(document_id, None)
+
+    async def add_document_to_bucket(self, bucket_id: int, document_hash: int, document_id: int):
+        """Link a document to a bucket."""
+        await self.backend.add_document_to_bucket(bucket_id, document_hash, document_id)
+        self._bucket_reads.pop((bucket_id, document_hash), None)
+
+    async def query_ids_from_bucket(self, bucket_id: int, document_hash: int) -> Iterable[int]:
+        """Get all document IDs stored in a bucket for a certain hash value."""
+        key = (bucket_id, document_hash)
+        future = self._bucket_reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._read_bucket(bucket_id, document_hash))
+            self._bucket_reads[key] = future
+            future.add_done_callback(lambda f: self._forget(self._bucket_reads, key, f))
+        return await asyncio.shield(future)
+
+    async def remove_id_from_bucket(self, bucket_id: int, document_hash: int, document_id: int):
+        """Remove a document from a bucket."""
+        await self.backend.remove_id_from_bucket(bucket_id, document_hash, document_id)
+        self._bucket_reads.pop((bucket_id, document_hash), None)
+
+    async def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets of the wrapped backend, without coalescing."""
+        async for entry in self.backend.iter_buckets(min_size):
+            yield entry
+
+    async def _read_bucket(self, bucket_id: int, document_hash: int) -> Tuple[int, ...]:
+        return tuple(await self.backend.query_ids_from_bucket(bucket_id, document_hash))
+
+    @staticmethod
+    def _forget(reads: dict, key, future: asyncio.Future) -> None:
+        """Remove a finished read, unless a write already replaced it."""
+        if reads.get(key) is future:
+            del reads[key]
+
+    def _document_future(self, document_id: int) -> "asyncio.Future[bytes]":
+        """Get the future of an in-flight read of the document or schedule a new one."""
+        future = self._document_reads.get(document_id)
+        if future is not None:
+            return future
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._document_reads[document_id] = future
+        self._pending_documents.append((document_id, future))
+        if len(self._pending_documents) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            if self._batch_window > 0:
+                self._flush_handle = loop.call_later(self._batch_window, self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+        return future
+
+    def _flush(self) -> None:
+        """Send the pending document reads as one batch."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending_documents = self._pending_documents, []
+        if batch:
+            task = asyncio.ensure_future(self._read_documents(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _read_documents(self, batch: List[Tuple[int, "asyncio.Future[bytes]"]]) -> None:
+        ids = [doc_id for doc_id, _ in batch]
+        results: List[object]
+        try:
+            results = list(await self.backend.query_documents(ids))
+        except KeyError:
+            # Find out which of the documents are missing
+            results = await asyncio.gather(
+                *(self.backend.query_document(doc_id) for doc_id in ids), return_exceptions=True
+            )
+        except Exception as e:  # noqa: BLE001  # pylint: disable=broad-except
+            # Whatever the backend raises is passed on to every waiting reader
+            results = [e] * len(ids)
+        for (doc_id, future), result in zip(batch, results):  # noqa=B905
+            self._forget(self._document_reads, doc_id, future)
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)  # type: ignore
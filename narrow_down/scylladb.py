@@ -5,9 +5,10 @@ protocol. For details see _`https://www.scylladb.com/`.
 """
 import asyncio
 import contextlib
+import itertools
 import random
 import re
-from typing import Dict, Iterable, List, Optional, Union
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
 
 import cassandra.cluster  # type: ignore
 import cassandra.query  # type: ignore
@@ -15,6 +16,11 @@ import cassandra.query  # type: ignore
 from narrow_down.storage import StorageBackend
 
 QUERY_BATCH_SIZE = 50
+SCAN_SEGMENTS = 1024
+"""Number of token ranges in which the bucket table is read by ScyllaDBStore.iter_buckets()."""
+
+_MIN_TOKEN = -(2**63)
+_MAX_TOKEN = 2**63 - 1
 
 
 def _wrap_future(f: cassandra.cluster.ResponseFuture):
@@ -315,3 +321,25 @@ class ScyllaDBStore(StorageBackend):
                 self._prepared_statements["del_doc_from_bucket"],
                 (bucket_id, document_hash, document_id),
             )
+
+    async def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets with a scan of the bucket table by token ranges.
+
+        All rows of a bucket belong to the same partition and therefore to the same token range,
+        so they are read together and grouped.
+        """
+        step = (_MAX_TOKEN - _MIN_TOKEN) // SCAN_SEGMENTS + 1
+        with self._session() as session:
+            for start in range(_MIN_TOKEN, _MAX_TOKEN + 1, step):
+                end = min(start + step - 1, _MAX_TOKEN)
+                query = cassandra.query.SimpleStatement(
+                    "SELECT bucket, hash, doc_id "
+                    f"FROM {self._keyspace}.{self._table_prefix}buckets "
+                    f"WHERE token(bucket, hash) >= {start} AND token(bucket, hash) <= {end};",
+                    fetch_size=None,
+                )
+                rows = await self._execute(session, query, timeout=60)
+                for key, group in itertools.groupby(rows, key=lambda r: (r.bucket, r.hash)):
+                    doc_ids = [r.doc_id for r in group]
+                    if len(doc_ids) >= min_size:
+                        yield key[0], key[1], doc_ids
@@ -1,11 +1,41 @@
 """High-level API for indexing and retrieval of documents."""
+import asyncio
+import base64
+import collections
+import collections.abc
+import concurrent.futures
+import functools
 import re
 import warnings
-from typing import Callable, Collection, Iterable, List, Optional, Union
+from typing import (
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Collection,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
-from narrow_down import _minhash, _tokenize
-from narrow_down._minhash import MinhashLshConfig
+from narrow_down import _minhash, _rust, _tokenize
+from narrow_down._cache import CacheStats, FingerprintCache, QueryCache
+from narrow_down._minhash import (  # noqa: F401  # BucketCap and its policy are public API
+    BucketCap,
+    BucketCapStats,
+    CandidateIds,
+    InsertResult,
+    MinhashLshConfig,
+    OversizedBucketPolicy,
+)
 from narrow_down.storage import (
+    Fingerprint,
     InMemoryStore,
     StorageBackend,
     StorageLevel,
@@ -13,6 +43,24 @@ from narrow_down.storage import (
     TooLowStorageLevel,
 )
 
+SEARCH_MODES = ("jaccard", "containment")
+
+T = TypeVar("T")
+
+
+class DedupResult(NamedTuple):
+    """Decision of :meth:`SimilarityStore.dedup` for one text."""
+
+    text: str
+    """The input text."""
+
+    cluster_id: int
+    """ID of the document which was kept for the cluster of the text. This is the ID of the text
+    itself if it was kept, otherwise the ID of the earlier document it is similar to."""
+
+    is_duplicate: bool
+    """Whether the text is similar to an earlier document and was therefore not inserted."""
+
 
 class SimilarityStore:
     """Storage class for indexing and fuzzy search of documents."""
@@ -26,6 +74,11 @@ class SimilarityStore:
         "_tokenize",
         "_tokenize_callable",
         "_lsh_config",
+        "_compressor",
+        "_cache",
+        "_fingerprint_cache",
+        "_bucket_cap",
+        "_max_concurrency",
     )
 
     def __init__(self):  # noqa: D107  # Not meant to be called, therefore omitting docstring.
@@ -35,7 +88,12 @@ class SimilarityStore:
             "SimilarityStore.create() or SimilarityStore.load_from_storage().",
             stacklevel=2,
         )
-        self._minhasher: _minhash.MinHasher
+        self._minhasher: Union[
+            _minhash.MinHasher,
+            _minhash.OnePermutationHasher,
+            _minhash.WeightedMinHasher,
+            _minhash.SimHasher,
+        ]
         self._similarity_threshold: float
         self._lsh: _minhash.LSH
         self._storage: StorageBackend
@@ -43,6 +101,11 @@ class SimilarityStore:
         self._tokenize: Union[str, Callable[[str], Collection[str]]]
         self._tokenize_callable: Callable[[str], Collection[str]]
         self._lsh_config: MinhashLshConfig
+        self._compressor: Optional[_rust.Compressor]
+        self._cache: Optional[QueryCache]
+        self._fingerprint_cache: Optional[FingerprintCache]
+        self._bucket_cap: Optional[BucketCap]
+        self._max_concurrency: Optional[int]
 
     @classmethod
     async def create(
@@ -54,6 +117,18 @@ class SimilarityStore:
         max_false_negative_proba: float = 0.05,
         max_false_positive_proba: float = 0.05,
         similarity_threshold: float = 0.75,
+        compression: Optional[str] = None,
+        compression_dictionary: Optional[bytes] = None,
+        query_cache_size: int = 0,
+        query_cache_ttl: Optional[float] = None,
+        fingerprint_cache_size: int = 0,
+        bucket_cap: Optional[BucketCap] = None,
+        max_concurrency: Optional[int] = None,
+        fingerprint_engine: str = "minhash",
+        fingerprint_bits: int = _minhash.FULL_FINGERPRINT_BITS,
+        max_probe_rows: int = 0,
+        lsh_forest_trees: Optional[int] = None,
+        search_mode: str = "jaccard",
     ) -> "SimilarityStore":
         """Create a new SimilarityStore object.
 
@@ -85,9 +160,71 @@ class SimilarityStore:
                 but it leads to slower processing and more storage consumption.
             similarity_threshold: The minimum Jaccard similarity threshold used to identify two
                 documents as being similar.
+            compression: Compression of the stored documents. Per default documents are stored
+                uncompressed. Options are ``"lz4"`` for fast compression, ``"zstd"`` or
+                ``"zstd(level)"`` for a better compression ratio.
+            compression_dictionary: Optional dictionary for the compression, as created by
+                :func:`narrow_down.storage.train_compression_dictionary`. This improves the
+                compression ratio of short documents considerably.
+            query_cache_size: Number of query results to cache. Per default no results are
+                cached. Cached results are invalidated when a document is inserted into or removed
+                from the buckets they were found in, but only by this object. If other processes
+                write to the same storage, set ``query_cache_ttl`` as well.
+            query_cache_ttl: Optional maximum age of a cached result in seconds.
+            fingerprint_cache_size: Number of fingerprints of recently inserted or queried
+                documents to cache. Repeated documents, e.g. an insert after a query for the same
+                text, then only need to be tokenized and minhashed once. Per default nothing is
+                cached.
+            bucket_cap: Optional limit for the number of candidates a query takes from one LSH
+                bucket, see :class:`BucketCap`. This keeps queries fast if boilerplate text puts
+                many documents into the same buckets. Per default all candidates are taken.
+            max_concurrency: Optional limit for the number of storage backend calls in flight at
+                the same time. Each document touches one bucket per LSH band, so gathering many
+                inserts or queries can otherwise create tens of thousands of concurrent calls.
+                With a limit, further calls wait, which slows down bulk operations to the pace
+                of the backend. Per default the calls are not limited.
+            fingerprint_engine: The algorithm to calculate the fingerprints. ``"minhash"``
+                (default) is the classic minhash with one hash permutation per fingerprint entry.
+                ``"one_permutation"`` uses one permutation hashing with optimal densification,
+                which computes the whole fingerprint in one pass over the tokens and is much
+                faster for strict error thresholds. ``"weighted_minhash"`` takes into account
+                how often each token occurs and approximates the weighted Jaccard similarity.
+                With this engine the built-in tokenizers count the n-grams and a custom tokenize
+                function may return a mapping from token to weight. Repeated tokens in other
+                collections count once per occurrence. ``"simhash"`` calculates a 64 bit
+                SimHash, which is an order of magnitude cheaper to calculate and store than a
+                minhash, but finds fewer of the similar documents. It is meant for short texts
+                like product titles and always stores one bit per fingerprint value, ignoring
+                ``fingerprint_bits``. The choice is saved in the storage.
+            fingerprint_bits: Number of bits to store per fingerprint value with
+                ``StorageLevel.Fingerprint``. With 1, 2, 4 or 8 only the lowest bits are stored
+                ("b-bit minhash"), which makes the stored fingerprints 32 / bits times smaller.
+                ``query_top_n()`` then ranks the results by the similarity estimated from these
+                bits if they cannot be validated with the documents. Documents can no longer be
+                removed though. Per default the full 32 bits are stored.
+            max_probe_rows: Allow multi-probe queries, which also read the neighbouring LSH
+                buckets differing from the query in up to this number of rows (1 or 2). Then a
+                configuration with fewer bands may be chosen, which makes the index smaller and
+                inserts cheaper, but queries read more buckets. Only the ``"minhash"`` and
+                ``"simhash"`` engines support probing. Per default no buckets are probed.
+            lsh_forest_trees: Build an LSH forest with this number of trees instead of a fixed
+                split into bands. Each document is then stored with several minhash prefix
+                lengths per tree, so that the same index answers queries with any similarity
+                threshold, see the ``threshold`` argument of :meth:`query`. This needs more
+                bucket entries per document than a single classic index, but fewer than one
+                index per threshold. similarity_threshold is the default for queries and
+                max_false_positive_proba is not used. 8 trees are a good start.
+            search_mode: ``"jaccard"`` finds documents with a Jaccard similarity above the
+                threshold. ``"containment"`` finds documents which contain at least the fraction
+                ``threshold`` of the tokens of the query, e.g. the long texts quoting a short
+                snippet. The documents are then partitioned by their number of tokens into LSH
+                forests, so that any threshold can be queried like with ``lsh_forest_trees``,
+                which defaults to 8 trees in this mode.
 
         Raises:
-            ValueError: If the function specified with ``tokenize`` cannot be found.
+            ValueError: If the function specified with ``tokenize`` cannot be found, the
+                compression, fingerprint engine, number of fingerprint bits or search mode is
+                not supported, max_concurrency is not positive or probing is not possible.
 
         Returns:
             A new SimilarityStore object with already initialized storage.
@@ -98,11 +235,47 @@ class SimilarityStore:
           # noqa: DAR101 similarity_threshold
         """
         # pylint: disable=protected-access
-        obj = await cls._create_object_base(storage, storage_level, similarity_threshold, tokenize)
+        obj = await cls._create_object_base(
+            storage,
+            storage_level,
+            similarity_threshold,
+            tokenize,
+            weighted=fingerprint_engine == "weighted_minhash",
+        )
+        if compression_dictionary is not None and compression is None:
+            raise ValueError("A compression dictionary requires a compression to be set.")
+        if max_concurrency is not None and max_concurrency < 1:
+            raise ValueError("max_concurrency must be positive.")
+        if fingerprint_bits not in _minhash.FINGERPRINT_BITS:
+            raise ValueError(
+                f"Unsupported number of fingerprint bits: {fingerprint_bits}. "
+                f"Options: {_minhash.FINGERPRINT_BITS}"
+            )
+        if fingerprint_engine not in _minhash.FINGERPRINT_ENGINES:
+            raise ValueError(
+                f"Unknown fingerprint engine: {fingerprint_engine}. "
+                f"Options: {_minhash.FINGERPRINT_ENGINES}"
+            )
+        if search_mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode: {search_mode}. Options: {SEARCH_MODES}")
+        obj._compressor = (
+            _rust.Compressor(compression, compression_dictionary) if compression else None
+        )
+        obj._cache = cls._create_cache(query_cache_size, query_cache_ttl)
+        obj._fingerprint_cache = (
+            FingerprintCache(fingerprint_cache_size) if fingerprint_cache_size else None
+        )
+        obj._bucket_cap = bucket_cap
+        obj._max_concurrency = max_concurrency
         obj._lsh_config = _minhash.find_optimal_config(
             jaccard_threshold=similarity_threshold,
             max_false_negative_proba=max_false_negative_proba,
             max_false_positive_proba=max_false_positive_proba,
+            engine=fingerprint_engine,
+            fingerprint_bits=fingerprint_bits,
+            max_probe_rows=max_probe_rows,
+            forest_trees=lsh_forest_trees,
+            containment=search_mode == "containment",
         )
         await obj._initialize_storage()
         return obj
@@ -112,6 +285,11 @@ class SimilarityStore:
         cls,
         storage: StorageBackend,
         tokenize: Optional[Union[str, Callable[[str], Collection[str]]]] = None,
+        query_cache_size: int = 0,
+        query_cache_ttl: Optional[float] = None,
+        fingerprint_cache_size: int = 0,
+        bucket_cap: Optional[BucketCap] = None,
+        max_concurrency: Optional[int] = None,
     ) -> "SimilarityStore":
         """Load a SimilarityStore object from already initialized storage.
 
@@ -120,6 +298,13 @@ class SimilarityStore:
                 SimilarityStore object before.
             tokenize: The tokenization function originally specified in the init when initializing
                 the Similarity Store. See :func:`narrow_down.SimilarityStore.__init__`.
+            query_cache_size: Number of query results to cache. See :meth:`create`.
+            query_cache_ttl: Optional maximum age of a cached result in seconds.
+            fingerprint_cache_size: Number of fingerprints to cache. See :meth:`create`.
+            bucket_cap: Optional limit for the candidates taken from one bucket. See
+                :meth:`create`.
+            max_concurrency: Optional limit for the number of storage calls in flight. See
+                :meth:`create`.
 
         Returns:
             A SimilarityStore object using the given storage backend and with the settings stored
@@ -149,21 +334,44 @@ class SimilarityStore:
         if not lsh_config_setting:
             raise TypeError("lsh_config setting could not be read from storage.")
         lsh_config = MinhashLshConfig.from_json(lsh_config_setting)
+        compression = await storage.query_setting("compression")
+        compression_dictionary = await storage.query_setting("compression_dictionary")
 
         simstore = await cls._create_object_base(
             storage=storage,
             storage_level=storage_level,
             similarity_threshold=similarity_threshold,
             tokenize=tokenize_spec,
+            weighted=lsh_config.engine == "weighted_minhash",
         )
         simstore._lsh_config = lsh_config
-        simstore._minhasher = _minhash.MinHasher(n_hashes=lsh_config.n_hashes)
-        simstore._lsh = _minhash.LSH(lsh_config, storage=storage)
+        simstore._compressor = (
+            _rust.Compressor(
+                compression,
+                base64.b64decode(compression_dictionary) if compression_dictionary else None,
+            )
+            if compression
+            else None
+        )
+        simstore._cache = cls._create_cache(query_cache_size, query_cache_ttl)
+        simstore._fingerprint_cache = (
+            FingerprintCache(fingerprint_cache_size) if fingerprint_cache_size else None
+        )
+        simstore._bucket_cap = bucket_cap
+        simstore._max_concurrency = max_concurrency
+        simstore._minhasher = _minhash.create_hasher(lsh_config)
+        simstore._lsh = _minhash.LSH(
+            lsh_config,
+            storage=storage,
+            compressor=simstore._compressor,
+            bucket_cap=bucket_cap,
+            max_concurrency=max_concurrency,
+        )
         return simstore
 
     @classmethod
     async def _create_object_base(
-        cls, storage, storage_level, similarity_threshold, tokenize
+        cls, storage, storage_level, similarity_threshold, tokenize, weighted=False
     ) -> "SimilarityStore":
         """Create a new SimilarityStore object with the given attributes."""
         # pylint: disable=protected-access
@@ -173,17 +381,29 @@ class SimilarityStore:
         obj._similarity_threshold = similarity_threshold
         if isinstance(tokenize, str) or tokenize is None:
             obj._tokenize = tokenize or "word_ngrams(3)"
-            obj._tokenize_callable = obj._get_tokenize_callable(obj._tokenize)
+            obj._tokenize_callable = obj._get_tokenize_callable(obj._tokenize, counts=weighted)
         else:
             obj._tokenize = "custom"
             obj._tokenize_callable = tokenize
         return obj
 
     @staticmethod
-    def _get_tokenize_callable(tokenize_spec: str):
-        """Find the right python function for the given specification as string."""
+    def _create_cache(size: int, ttl: Optional[float]) -> Optional[QueryCache]:
+        """Create the query result cache if enabled."""
+        if size < 0:
+            raise ValueError("query_cache_size must not be negative.")
+        return QueryCache(size, ttl) if size else None
+
+    @staticmethod
+    def _get_tokenize_callable(tokenize_spec: str, counts: bool = False):
+        """Find the right python function for the given specification as string.
+
+        With counts=True the function returns the number of occurrences of each n-gram.
+        """
         match = re.match(r"([a-z_]+)\((.+)\)", tokenize_spec.replace(" ", ""))
         if match and match.group(1) == "word_ngrams":
+            if counts:
+                return lambda s: _tokenize.count_word_ngrams(s, n=int(match.group(2)))
             return lambda s: _tokenize.word_ngrams(s, n=int(match.group(2)))
         elif match and match.group(1) == "char_ngrams":
             args = match.group(2).split(",")
@@ -198,6 +418,10 @@ class SimilarityStore:
                     pad_char = args[1][1:-1]
                 else:
                     pad_char = args[1]
+            if counts:
+                return lambda s: _tokenize.count_char_ngrams(
+                    s, n=n, pad_char="$" if pad_char is None else pad_char
+                )
             if pad_char is not None:
                 return lambda s: _tokenize.char_ngrams(s, n=n, pad_char=pad_char)
             return lambda s: _tokenize.char_ngrams(s, n=n)
@@ -218,8 +442,20 @@ class SimilarityStore:
         await self._storage.insert_setting("storage_level", str(self._storage_level.value))
         await self._storage.insert_setting("tokenize", self._tokenize)  # type: ignore
         await self._storage.insert_setting("lsh_config", self._lsh_config.to_json())
-        self._minhasher = _minhash.MinHasher(n_hashes=self._lsh_config.n_hashes)
-        self._lsh = _minhash.LSH(self._lsh_config, storage=self._storage)
+        if self._compressor is not None:
+            await self._storage.insert_setting("compression", self._compressor.spec)
+            if self._compressor.dictionary:
+                await self._storage.insert_setting(
+                    "compression_dictionary", base64.b64encode(self._compressor.dictionary).decode()
+                )
+        self._minhasher = _minhash.create_hasher(self._lsh_config)
+        self._lsh = _minhash.LSH(
+            self._lsh_config,
+            storage=self._storage,
+            compressor=self._compressor,
+            bucket_cap=self._bucket_cap,
+            max_concurrency=self._max_concurrency,
+        )
 
     async def insert(
         self,
@@ -240,8 +476,123 @@ class SimilarityStore:
         Returns:
             The ID under which the document was indexed.
         """
-        tokens = self._tokenize_callable(document)
-        fingerprint = self._minhasher.minhash(tokens)
+        tokens, fingerprint = self._fingerprint(document)
+        return await self._insert_fingerprinted(
+            document,
+            fingerprint,
+            self._n_tokens(document, tokens),
+            document_id=document_id,
+            exact_part=exact_part,
+            data=data,
+        )
+
+    async def insert_if_not_similar(
+        self,
+        document: str,
+        *,
+        document_id: Optional[int] = None,
+        exact_part: Optional[str] = None,
+        data: Optional[str] = None,
+        validate: Optional[bool] = None,
+        threshold: Optional[float] = None,
+    ) -> InsertResult:
+        """Index a new document unless a similar document is stored already.
+
+        This is like :meth:`exists_similar` followed by :meth:`insert`, but the document is
+        tokenized, fingerprinted and hashed into buckets only once. Concurrent calls on the same
+        object are serialized per bucket, so of two similar documents inserted at the same time
+        only one gets in.
+
+        Example:
+            >>> import asyncio
+            >>> async def insert_twice(text):
+            ...     simstore = await SimilarityStore.create()
+            ...     return [(await simstore.insert_if_not_similar(text)).inserted for _ in range(2)]
+            >>> asyncio.run(insert_twice("a b c d e"))
+            [True, False]
+
+        Args:
+            document: A document (as string to index).
+            document_id: Optional ID to assign to the document.
+            exact_part: Optional exact string to match when searching for the document.
+            data: Optional additional payload to save together with the document.
+            validate: Whether to validate if the candidates are really above the similarity
+                threshold. See :meth:`query`.
+            threshold: Similarity threshold for this check. See :meth:`query`.
+
+        Returns:
+            The ID of the new document or of the similar one, and whether it was inserted.
+        """
+        threshold = self._query_threshold(threshold)
+        tokens, fingerprint, probes = self._query_fingerprint(document)
+        n_tokens = self._n_tokens(document, tokens)
+        if not (self._storage_level & StorageLevel.Document) or validate is False:
+            tokens = None
+        elif tokens is None:
+            tokens = self._tokenize_callable(document)
+        return await self._insert_if_not_similar(
+            document,
+            fingerprint,
+            probes,
+            tokens,
+            n_tokens,
+            threshold,
+            document_id=document_id,
+            exact_part=exact_part,
+            data=data,
+        )
+
+    async def _insert_if_not_similar(  # pylint: disable=too-many-arguments
+        self,
+        document: str,
+        fingerprint: Fingerprint,
+        probes: Optional[Fingerprint],
+        tokens: Optional[Collection[str]],
+        n_tokens: Optional[int],
+        threshold: float,
+        document_id: Optional[int] = None,
+        exact_part: Optional[str] = None,
+        data: Optional[str] = None,
+    ) -> InsertResult:
+        """Index a fingerprinted document unless a similar one is stored, validated by tokens."""
+        is_similar = None
+        if tokens is not None:
+            is_similar = functools.partial(
+                self._is_similar,
+                tokens=self._comparable_tokens(tokens),
+                exact_part=exact_part,
+                threshold=threshold,
+            )
+        keys = self._lsh.bucket_keys(fingerprint, exact_part, n_tokens)
+        result = await self._lsh.insert_if_not_similar(
+            StoredDocument(
+                id_=document_id,
+                document=document,
+                exact_part=exact_part,
+                fingerprint=fingerprint,
+                data=data,
+            ),
+            storage_level=self._storage_level,
+            probes=probes,
+            threshold=threshold,
+            n_tokens=n_tokens,
+            is_similar=is_similar,
+            keys=keys,
+        )
+        if result.inserted and self._cache is not None:
+            self._cache.invalidate(keys)
+        return result
+
+    async def _insert_fingerprinted(
+        self,
+        document: str,
+        fingerprint: Fingerprint,
+        n_tokens: Optional[int],
+        document_id: Optional[int] = None,
+        exact_part: Optional[str] = None,
+        data: Optional[str] = None,
+    ) -> int:
+        """Index a new document of which the fingerprint is already calculated."""
         stored_doc = StoredDocument(
             id_=document_id,
             document=document,
@@ -249,7 +600,12 @@ class SimilarityStore:
             fingerprint=fingerprint,
             data=data,
         )
-        return await self._lsh.insert(document=stored_doc, storage_level=self._storage_level)
+        document_id = await self._lsh.insert(
+            document=stored_doc, storage_level=self._storage_level, n_tokens=n_tokens
+        )
+        if self._cache is not None:
+            self._cache.invalidate(self._lsh.bucket_keys(fingerprint, exact_part, n_tokens))
+        return document_id
 
     async def remove_by_id(self, document_id: int, check_if_exists: bool = False) -> None:
         """Remove the document with the given ID from the internal data structures.
@@ -269,20 +625,123 @@ class SimilarityStore:
             raise TooLowStorageLevel(
                 "Documents can only be removed with StorageLevel 'Fingerprint' or higher!"
             )
-        await self._lsh.remove_by_id(document_id, check_if_exists)
+        removed = await self._lsh.remove_by_id(document_id, check_if_exists)
+        if self._cache is not None and removed is not None and removed.fingerprint is not None:
+            self._cache.invalidate(
+                self._lsh.bucket_keys(removed.fingerprint, removed.exact_part, removed.n_tokens)
+            )
+
+    def _fingerprint(self, document: str) -> Tuple[Optional[Collection[str]], Fingerprint]:
+        """Calculate the fingerprint of a document or take it from the fingerprint cache.
+
+        Returns:
+            The tokens of the document, or None if the fingerprint came from the cache, together
+            with the fingerprint.
+        """
+        if self._fingerprint_cache is not None:
+            fingerprint = self._fingerprint_cache.get(document)
+            if fingerprint is not None:
+                return None, fingerprint
+        tokens = self._tokenize_callable(document)
+        fingerprint = self._minhasher.minhash(tokens)
+        if self._fingerprint_cache is not None:
+            self._fingerprint_cache.put(document, fingerprint)
+        return tokens, fingerprint
+
+    def _query_fingerprint(
+        self, document: str
+    ) -> Tuple[Optional[Collection[str]], Fingerprint, Optional[Fingerprint]]:
+        """Calculate the fingerprint of a query and the values to probe neighbouring buckets.
+
+        Returns:
+            Like :meth:`_fingerprint`, plus the probe values or None if probing is disabled.
+        """
+        if not self._lsh_config.probe_rows:
+            tokens, fingerprint = self._fingerprint(document)
+            return tokens, fingerprint, None
+        # The probe values are not cached, so the fingerprint is calculated together with them
+        tokens = self._tokenize_callable(document)
+        fingerprint, probes = self._minhasher.minhash_with_probes(tokens)  # type: ignore
+        if self._fingerprint_cache is not None:
+            self._fingerprint_cache.put(document, fingerprint)
+        return tokens, fingerprint, probes
+
+    def _n_tokens(self, document: str, tokens: Optional[Collection[str]]) -> Optional[int]:
+        """Count the distinct tokens of a document for the size partitions of containment search.
+
+        Returns:
+            The number of distinct tokens, or None if the index is not for containment search.
+        """
+        if not self._lsh_config.size_partitions:
+            return None
+        if tokens is None:
+            tokens = self._tokenize_callable(document)
+        if isinstance(tokens, (set, collections.abc.Mapping)):
+            return len(tokens)
+        return len(set(tokens))
+
+    def _comparable_tokens(self, tokens: Collection[str]) -> Collection[str]:
+        """Prepare tokens for the validation with :func:`_jaccard_similarity`.
+
+        Returns:
+            The token weights for the weighted minhash engine, otherwise the set of tokens.
+        """
+        if self._lsh_config.engine != "weighted_minhash":
+            return set(tokens)
+        if isinstance(tokens, collections.abc.Mapping):
+            return tokens
+        return collections.Counter(tokens)
+
+    def _query_threshold(self, threshold: Optional[float]) -> float:
+        """Check the similarity threshold given for a query and fall back to the default.
+
+        Raises:
+            ValueError: If the threshold is not between 0 and 1 or the index is no LSH forest.
+        """
+        if threshold is None:
+            return self._similarity_threshold
+        if not 0 < threshold <= 1:
+            raise ValueError("The similarity threshold must be between 0 and 1.")
+        if not self._lsh_config.forest_depths and threshold != self._similarity_threshold:
+            raise ValueError(
+                "Queries with another similarity threshold need an LSH forest index, see the "
+                "lsh_forest_trees argument of SimilarityStore.create()."
+            )
+        return threshold
+
+    def _similarity(self, query_tokens: Collection[str], candidate_tokens: Collection[str]):
+        """Calculate the similarity of the search mode, Jaccard similarity or containment."""
+        if self._lsh_config.size_partitions:
+            return _containment(query_tokens, candidate_tokens)
+        return _jaccard_similarity(query_tokens, candidate_tokens)
+
+    def _candidate_tokens(self, candidate: StoredDocument) -> Collection[str]:
+        """Tokenize a candidate for the comparison, treating a missing document as empty."""
+        return self._comparable_tokens(self._tokenize_callable(candidate.document or ""))
+
+    def _is_similar(
+        self, candidate: StoredDocument, tokens: Collection[str], exact_part, threshold: float
+    ) -> bool:
+        """Check if a candidate is really above the similarity threshold."""
+        return (
+            candidate.exact_part == exact_part
+            and self._similarity(tokens, self._candidate_tokens(candidate)) >= threshold
+        )
 
-    def _filter_candidates(self, candidates, tokens, exact_part) -> List[StoredDocument]:
+    def _filter_candidates(
+        self, candidates, tokens, exact_part, threshold: float
+    ) -> List[StoredDocument]:
         """Filter out candidates below the similarity threshold and sort by similarity."""
         candidates = list(filter(lambda c: c.exact_part == exact_part, candidates))
-        candidate_tokens = [set(self._tokenize_callable(c.document)) for c in candidates]
-        tokens = set(tokens)
-        true_jaccards = [_jaccard_similarity(tokens, ct) for ct in candidate_tokens]
+        candidate_tokens = [self._candidate_tokens(c) for c in candidates]
+        tokens = self._comparable_tokens(tokens)
+        similarities = [self._similarity(tokens, ct) for ct in candidate_tokens]
         candidates = [
             c
-            for jaccard, c in sorted(
+            for _, c in sorted(
                 filter(
-                    lambda t: t[0] >= self._similarity_threshold,
-                    zip(true_jaccards, candidates),  # noqa=B905
+                    lambda t: t[0] >= threshold,
+                    zip(similarities, candidates),  # noqa=B905
                 ),
                 key=lambda t: (t[0], t[1].id_ or 0),
                 reverse=True,
@@ -291,7 +750,12 @@ class SimilarityStore:
         return candidates
 
     async def query(
-        self, document: str, *, exact_part: Optional[str] = None, validate: Optional[bool] = None
+        self,
+        document: str,
+        *,
+        exact_part: Optional[str] = None,
+        validate: Optional[bool] = None,
+        threshold: Optional[float] = None,
     ) -> Collection[StoredDocument]:
         """Query all similar documents.
 
@@ -301,17 +765,44 @@ class SimilarityStore:
             validate: Whether to validate if the results are really above the similarity threshold.
                 This is only possible if the storage level is at least "Document". Per default
                 validation is done if the data is available, otherwise not.
+            threshold: Similarity threshold for this query. Per default the threshold given at
+                creation is used. Other thresholds are only possible with an LSH forest index.
+                In the containment search mode it is the minimum containment.
 
         Returns:
             A List of :obj:`~narrow_down.storage.StoredDocument` objects with all elements
             which are estimated to be above the similarity threshold.
         """
-        tokens = self._tokenize_callable(document)
-        fingerprint = self._minhasher.minhash(tokens)
-        candidates = await self._lsh.query(fingerprint=fingerprint, exact_part=exact_part)
+        threshold = self._query_threshold(threshold)
+        tokens, fingerprint, probes = self._query_fingerprint(document)
+        n_tokens = self._n_tokens(document, tokens)
+        return await self._cached(
+            ("query", fingerprint.tobytes(), exact_part, validate, threshold, n_tokens),
+            fingerprint,
+            probes,
+            threshold,
+            n_tokens,
+            exact_part,
+            lambda: self._query(
+                document, tokens, fingerprint, probes, exact_part, validate, threshold, n_tokens
+            ),
+        )
+
+    async def _query(
+        self, document, tokens, fingerprint, probes, exact_part, validate, threshold, n_tokens
+    ) -> List[StoredDocument]:
+        candidates = await self._lsh.query(
+            fingerprint=fingerprint,
+            exact_part=exact_part,
+            probes=probes,
+            threshold=threshold,
+            n_tokens=n_tokens,
+        )
         if (self._storage_level & StorageLevel.Document) and validate is not False:
-            candidates = self._filter_candidates(candidates, tokens, exact_part)
-        return candidates
+            if tokens is None:
+                tokens = self._tokenize_callable(document)
+            candidates = self._filter_candidates(candidates, tokens, exact_part, threshold)
+        return list(candidates)
 
     async def query_top_n(
         self,
@@ -320,9 +811,14 @@ class SimilarityStore:
         *,
         exact_part: Optional[str] = None,
         validate: Optional[bool] = None,
+        threshold: Optional[float] = None,
     ) -> Collection[StoredDocument]:
         """Query the top n similar documents.
 
+        With an LSH forest index the candidates are collected from the longest shared minhash
+        prefixes down to the shortest until enough are found, independent of any threshold.
+        In the containment search mode the candidates are collected for the threshold instead.
+
         Args:
             n: The number of similar documents to retrieve.
             document: A document for which to search similar items.
@@ -330,6 +826,7 @@ class SimilarityStore:
             validate: Whether to validate if the results are really above the similarity threshold.
                 This is only possible if the storage level is at least "Document". Per default
                 validation is done if the data is available, otherwise not.
+            threshold: Similarity threshold for the validation. See :meth:`query`.
 
         Returns:
             A List of :obj:`~narrow_down.storage.StoredDocument` objects with the n
@@ -340,19 +837,596 @@ class SimilarityStore:
         documents themselves might differ. However, if `validate` is `True` the ordering of the
         results is correct, because the actual documents are compared with each other.
         """
-        tokens = self._tokenize_callable(document)
-        fingerprint = self._minhasher.minhash(tokens)
+        threshold = self._query_threshold(threshold)
+        tokens, fingerprint, probes = self._query_fingerprint(document)
+        n_tokens = self._n_tokens(document, tokens)
+        # Only containment search reads the buckets for a threshold, see LSH.query_ids()
+        lsh_threshold = threshold if n_tokens is not None else None
+        return await self._cached(
+            ("query_top_n", fingerprint.tobytes(), exact_part, validate, n, threshold, n_tokens),
+            fingerprint,
+            probes,
+            lsh_threshold,
+            n_tokens,
+            exact_part,
+            lambda: self._query_top_n(
+                n,
+                document,
+                tokens,
+                fingerprint,
+                probes,
+                exact_part,
+                validate,
+                threshold,
+                lsh_threshold,
+                n_tokens,
+            ),
+        )
+
+    async def _query_top_n(  # pylint: disable=too-many-arguments
+        self,
+        n,
+        document,
+        tokens,
+        fingerprint,
+        probes,
+        exact_part,
+        validate,
+        threshold,
+        lsh_threshold,
+        n_tokens,
+    ) -> List[StoredDocument]:
+        lsh_args = dict(
+            fingerprint=fingerprint,
+            exact_part=exact_part,
+            probes=probes,
+            threshold=lsh_threshold,
+            n_tokens=n_tokens,
+        )
         if (self._storage_level & StorageLevel.Document) and validate is not False:
+            if tokens is None:
+                tokens = self._tokenize_callable(document)
             # Query 4x the desired number to have some buffer for filtering
-            candidates = await self._lsh.query_top_n(
-                n=n * 4, fingerprint=fingerprint, exact_part=exact_part
+            candidates = await self._lsh.query_top_n(n=n * 4, **lsh_args)
+            candidates = self._filter_candidates(candidates, tokens, exact_part, threshold)
+            return candidates[:n]
+        bits = self._lsh_config.fingerprint_bits
+        b_bit_fingerprints = bits < _minhash.FULL_FINGERPRINT_BITS
+        if (self._storage_level & StorageLevel.Fingerprint) and b_bit_fingerprints:
+            # Rank a buffer of candidates by the similarity estimated from their b-bit fingerprints
+            candidates = await self._lsh.query_top_n(n=n * 4, **lsh_args)
+            estimates = [
+                (_minhash.estimate_similarity(fingerprint, c.fingerprint, bits), c)
+                for c in candidates
+                if c.fingerprint is not None
+            ]
+            return [c for _, c in sorted(estimates, key=lambda t: -t[0])][:n]
+        return list(await self._lsh.query_top_n(n=n, **lsh_args))
+
+    async def query_ids(
+        self, document: str, *, exact_part: Optional[str] = None, threshold: Optional[float] = None
+    ) -> CandidateIds:
+        """Query the IDs of all candidates for similar documents without fetching them.
+
+        Neither the documents table of the storage is read nor are any documents deserialized,
+        which makes this the fastest query, especially with ``StorageLevel.Minimal``. The
+        results are not validated, so they may contain documents below the similarity threshold.
+        They are ordered by the number of LSH bands in which they share the bucket with the
+        document, most likely candidates first.
+
+        Args:
+            document: A document for which to search similar items.
+            exact_part: Part that should be exactly matched.
+            threshold: Similarity threshold for this query. See :meth:`query`.
+
+        Returns:
+            A named tuple with a numpy array of document IDs and a numpy array of their band hits.
+        """
+        threshold = self._query_threshold(threshold)
+        tokens, fingerprint, probes = self._query_fingerprint(document)
+        return await self._lsh.query_ids(
+            fingerprint,
+            exact_part=exact_part,
+            probes=probes,
+            threshold=threshold,
+            n_tokens=self._n_tokens(document, tokens),
+        )
+
+    async def query_top_n_ids(
+        self, n: int, document: str, *, exact_part: Optional[str] = None
+    ) -> CandidateIds:
+        """Query the IDs of the n most likely candidates without fetching them.
+
+        Args:
+            n: The number of IDs to retrieve.
+            document: A document for which to search similar items.
+            exact_part: Part that should be exactly matched.
+
+        Returns:
+            Like :meth:`query_ids`, but with at most n IDs.
+        """
+        tokens, fingerprint, probes = self._query_fingerprint(document)
+        n_tokens = self._n_tokens(document, tokens)
+        return await self._lsh.query_ids(
+            fingerprint,
+            exact_part=exact_part,
+            n=n,
+            probes=probes,
+            threshold=self._similarity_threshold if n_tokens is not None else None,
+            n_tokens=n_tokens,
+        )
+
+    async def iter_query(
+        self,
+        document: str,
+        *,
+        exact_part: Optional[str] = None,
+        validate: Optional[bool] = None,
+        batch_size: int = 100,
+        threshold: Optional[float] = None,
+    ) -> AsyncIterator[StoredDocument]:
+        """Iterate over all similar documents, fetching them from the storage on demand.
+
+        In contrast to :meth:`query` the documents are fetched in batches while iterating, so
+        stopping early saves the fetching and deserialization of the remaining candidates. The
+        query result cache is not used.
+
+        Args:
+            document: A document for which to search similar items.
+            exact_part: Part that should be exactly matched.
+            validate: Whether to validate if the results are really above the similarity threshold.
+                See :meth:`query`.
+            batch_size: Number of documents to fetch from the storage at once.
+            threshold: Similarity threshold for this query. See :meth:`query`.
+
+        Yields:
+            :obj:`~narrow_down.storage.StoredDocument` objects, most likely candidates first.
+        """
+        threshold = self._query_threshold(threshold)
+        tokens, fingerprint, probes = self._query_fingerprint(document)
+        n_tokens = self._n_tokens(document, tokens)
+        token_set = None
+        if (self._storage_level & StorageLevel.Document) and validate is not False:
+            token_set = self._comparable_tokens(
+                tokens if tokens is not None else self._tokenize_callable(document)
+            )
+        async for candidate in self._lsh.iter_query(
+            fingerprint,
+            exact_part=exact_part,
+            batch_size=batch_size,
+            probes=probes,
+            threshold=threshold,
+            n_tokens=n_tokens,
+        ):
+            if token_set is None or self._is_similar(candidate, token_set, exact_part, threshold):
+                yield candidate
+
+    async def exists_similar(
+        self,
+        document: str,
+        *,
+        exact_part: Optional[str] = None,
+        validate: Optional[bool] = None,
+        threshold: Optional[float] = None,
+    ) -> bool:
+        """Check if at least one similar document is stored.
+
+        Candidates are validated one small batch after the other and the search stops at the
+        first similar document. Without validation no documents are fetched at all.
+
+        Args:
+            document: A document for which to search similar items.
+            exact_part: Part that should be exactly matched.
+            validate: Whether to validate if the candidates are really above the similarity
+                threshold. See :meth:`query`.
+            threshold: Similarity threshold for this query. See :meth:`query`.
+
+        Returns:
+            True if a similar document was found.
+        """
+        if not (self._storage_level & StorageLevel.Document) or validate is False:
+            candidates = await self.query_ids(document, exact_part=exact_part, threshold=threshold)
+            return len(candidates.ids) > 0
+        async for _ in self.iter_query(
+            document, exact_part=exact_part, validate=validate, batch_size=10, threshold=threshold
+        ):
+            return True
+        return False
+
+    async def iter_duplicate_pairs(
+        self,
+        *,
+        validate: Optional[bool] = None,
+        threshold: Optional[float] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[Tuple[int, int]]:
+        """Iterate over all pairs of similar documents in the store, i.e. a self-join.
+
+        In contrast to a :meth:`query` per document, every bucket is read only once by scanning
+        the bucket tables of the storage backend. Each pair is yielded with the smaller ID first.
+        A pair sharing several buckets can be yielded more than once, because only the pairs of
+        a bucket and of a validation batch are deduplicated. Neighbouring buckets are not probed,
+        so with ``max_probe_rows`` the recall is lower than the one of queries.
+
+        Args:
+            validate: Whether to validate if the pairs are really above the similarity threshold.
+                See :meth:`query`.
+            threshold: Similarity threshold. See :meth:`query`.
+            executor: Optional thread or process pool to validate the pairs in, batch by batch,
+                while the scan continues. A process pool needs a built-in or picklable tokenizer.
+                Per default the validation runs in the event loop.
+            batch_size: Number of candidate pairs to validate at once.
+
+        Yields:
+            Pairs of document IDs.
+
+        Raises:
+            ValueError: In the containment search mode, which is asymmetric.
+        """
+        threshold = self._query_threshold(threshold)
+        pairs = self._lsh.iter_candidate_pairs(threshold)
+        if not (self._storage_level & StorageLevel.Document) or validate is False:
+            async for pair in pairs:
+                yield pair
+            return
+        # Validate one batch while the next one is collected
+        pending: Optional[Awaitable[List[Tuple[int, int]]]] = None
+        batch: List[Tuple[int, int]] = []
+        async for pair in pairs:
+            batch.append(pair)
+            if len(batch) >= batch_size:
+                validation = await self._start_validation(batch, threshold, executor)
+                if pending is not None:
+                    for similar_pair in await pending:
+                        yield similar_pair
+                pending, batch = validation, []
+        if pending is not None:
+            for similar_pair in await pending:
+                yield similar_pair
+        if batch:
+            for similar_pair in await (await self._start_validation(batch, threshold, executor)):
+                yield similar_pair
+
+    async def _start_validation(
+        self,
+        pairs: List[Tuple[int, int]],
+        threshold: float,
+        executor: Optional[concurrent.futures.Executor],
+    ) -> Awaitable[List[Tuple[int, int]]]:
+        """Fetch the documents of candidate pairs and start their validation."""
+        pairs = list(dict.fromkeys(pairs))
+        doc_ids = sorted({doc_id for pair in pairs for doc_id in pair})
+        docs = await self._lsh.query_documents(doc_ids)
+        documents = {
+            doc_id: (d.document, d.exact_part) for doc_id, d in zip(doc_ids, docs)  # noqa=B905
+        }
+        validation = functools.partial(
+            _similar_pairs,
+            self._tokenize_spec(),
+            self._lsh_config.engine == "weighted_minhash",
+            threshold,
+            documents,
+            pairs,
+        )
+        return _run_in(executor, validation)
+
+    async def find_duplicate_clusters(
+        self,
+        *,
+        validate: Optional[bool] = None,
+        threshold: Optional[float] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[List[int]]:
+        """Group the documents of the store into clusters of near-duplicates.
+
+        The pairs of :meth:`iter_duplicate_pairs` are merged with a union-find structure, so two
+        documents end up in the same cluster if they are connected by a chain of similar pairs.
+        The clusters are complete only after the scan, so they are yielded at its end.
+        Documents without any similar document are left out.
+
+        Args:
+            validate: Whether to validate the pairs. See :meth:`iter_duplicate_pairs`.
+            threshold: Similarity threshold. See :meth:`query`.
+            executor: Optional pool for the validation. See :meth:`iter_duplicate_pairs`.
+            batch_size: Number of candidate pairs to validate at once.
+
+        Yields:
+            The sorted document IDs of each cluster.
+        """
+        clusters = _DisjointSets()
+        async for id1, id2 in self.iter_duplicate_pairs(
+            validate=validate, threshold=threshold, executor=executor, batch_size=batch_size
+        ):
+            clusters.union(id1, id2)
+        for cluster in clusters.groups():
+            yield cluster
+
+    async def dedup(
+        self,
+        texts: Union[Iterable[str], AsyncIterable[str]],
+        *,
+        validate: Optional[bool] = None,
+        executor: Optional[concurrent.futures.Executor] = None,
+        batch_size: int = 1000,
+    ) -> AsyncIterator[DedupResult]:
+        """Filter near-duplicates out of a stream of texts, keeping the first text of each cluster.
+
+        Each text is only inserted if no similar document is stored yet, so the texts are
+        compared with the documents already in the store and with all earlier texts of the
+        stream. Every text is tokenized and fingerprinted once for both the query and the
+        insert. This happens batch by batch, optionally in a thread or process pool, while the
+        previous batch is checked and inserted in input order. So apart from the store itself at
+        most two batches are held in memory.
+
+        Example:
+            >>> import asyncio
+            >>> async def unique(texts):
+            ...     simstore = await SimilarityStore.create(similarity_threshold=0.5)
+            ...     return [r.text async for r in simstore.dedup(texts) if not r.is_duplicate]
+            >>> asyncio.run(unique(["a b c d e", "a b c d e f", "x y z"]))
+            ['a b c d e', 'x y z']
+
+        Args:
+            texts: Iterable or async iterable of the texts.
+            validate: Whether to validate if the candidates are really above the similarity
+                threshold. See :meth:`query`.
+            executor: Optional thread or process pool to fingerprint the texts in. A process
+                pool needs a built-in or picklable tokenizer.
+            batch_size: Number of texts to fingerprint at once.
+
+        Yields:
+            A :class:`DedupResult` per text, in the order of the input.
+
+        Raises:
+            ValueError: In the containment search mode, which is asymmetric.
+        """
+        if self._lsh_config.size_partitions:
+            raise ValueError("Deduplication is not supported in the containment search mode.")
+        validate = bool(self._storage_level & StorageLevel.Document) and validate is not False
+        pending: Optional[Tuple[List[str], Awaitable[List[_FingerprintedText]]]] = None
+        async for batch in _batches(texts, batch_size):
+            fingerprinting = _run_in(
+                executor,
+                functools.partial(
+                    _fingerprint_texts,
+                    self._tokenize_callable if executor is None else self._tokenize_spec(),
+                    self._lsh_config.to_json(),
+                    batch,
+                    validate,
+                ),
             )
-            candidates = self._filter_candidates(candidates, tokens, exact_part)
-            return candidates[:n]  # type: ignore
-        return await self._lsh.query_top_n(n=n, fingerprint=fingerprint, exact_part=exact_part)
+            if pending is not None:
+                async for result in self._dedup_batch(*pending):
+                    yield result
+            pending = (batch, fingerprinting)
+        if pending is not None:
+            async for result in self._dedup_batch(*pending):
+                yield result
+
+    async def _dedup_batch(
+        self,
+        texts: List[str],
+        fingerprinting: Awaitable[List["_FingerprintedText"]],
+    ) -> AsyncIterator[DedupResult]:
+        """Check and insert the texts of a batch one after the other."""
+        for text, (fingerprint, probes, tokens) in zip(texts, await fingerprinting):  # noqa=B905
+            result = await self._insert_if_not_similar(
+                text, fingerprint, probes, tokens, None, self._similarity_threshold
+            )
+            yield DedupResult(text, result.document_id, not result.inserted)
+
+    def _tokenize_spec(self) -> Union[str, Callable[[str], Collection[str]]]:
+        """Get the tokenizer in a picklable form: The spec of a built-in or the custom function."""
+        return self._tokenize if self._tokenize != "custom" else self._tokenize_callable
+
+    async def _cached(
+        self,
+        key: Hashable,
+        fingerprint: Fingerprint,
+        probes: Optional[Fingerprint],
+        threshold: Optional[float],
+        n_tokens: Optional[int],
+        exact_part: Optional[str],
+        compute: Callable[[], Awaitable[List[StoredDocument]]],
+    ) -> List[StoredDocument]:
+        """Return the results for the key from the cache or compute and cache them."""
+        if self._cache is None:
+            return await compute()
+        if probes is not None:
+            # Documents with the same fingerprint can still probe different buckets
+            key = (key, probes.tobytes())
+        results = self._cache.get(key)
+        if results is None:
+            generation = self._cache.generation
+            results = await compute()
+            self._cache.put(
+                key,
+                results,
+                self._lsh.query_keys(fingerprint, exact_part, probes, threshold, n_tokens),
+                generation,
+            )
+        return results
+
+    def query_cache_stats(self) -> Optional[CacheStats]:
+        """Get the hit, miss and eviction counters of the query result cache.
+
+        Returns:
+            The counters or None if the cache is disabled.
+        """
+        return self._cache.stats() if self._cache is not None else None
+
+    def fingerprint_cache_stats(self) -> Optional[CacheStats]:
+        """Get the hit, miss and eviction counters of the fingerprint cache.
+
+        Returns:
+            The counters or None if the cache is disabled.
+        """
+        if self._fingerprint_cache is None:
+            return None
+        return self._fingerprint_cache.stats()
+
+    def bucket_cap_stats(self) -> Optional[BucketCapStats]:
+        """Get the counters of the bucket cap, e.g. how often a bucket had to be capped.
+
+        Returns:
+            The counters or None if no bucket cap is configured.
+        """
+        return self._lsh.bucket_cap_stats()
+
+
+_FingerprintedText = Tuple[Fingerprint, Optional[Fingerprint], Optional[Collection[str]]]
+
+
+def _fingerprint_texts(
+    tokenize: Union[str, Callable[[str], Collection[str]]],
+    lsh_config_json: str,
+    texts: List[str],
+    with_tokens: bool,
+) -> List[_FingerprintedText]:
+    """Calculate fingerprint, probe values and optionally the tokens of texts for dedup().
+
+    Like :func:`_similar_pairs` this can run in a process pool.
+    """
+    lsh_config, hasher = _hasher(lsh_config_json)
+    tokenize_callable: Callable[[str], Collection[str]] = (
+        SimilarityStore._get_tokenize_callable(  # pylint: disable=protected-access
+            tokenize, counts=lsh_config.engine == "weighted_minhash"
+        )
+        if isinstance(tokenize, str)
+        else tokenize
+    )
+    results: List[_FingerprintedText] = []
+    for text in texts:
+        tokens = tokenize_callable(text)
+        if lsh_config.probe_rows:
+            fingerprint, probes = hasher.minhash_with_probes(tokens)  # type: ignore
+        else:
+            fingerprint, probes = hasher.minhash(tokens), None
+        results.append((fingerprint, probes, tokens if with_tokens else None))
+    return results
+
+
+@functools.lru_cache(maxsize=8)
+def _hasher(lsh_config_json: str):
+    """Create the hasher for a configuration once per process."""
+    lsh_config = MinhashLshConfig.from_json(lsh_config_json)
+    return lsh_config, _minhash.create_hasher(lsh_config)
+
+
+def _run_in(executor: Optional[concurrent.futures.Executor], function: Callable[[], T]):
+    """Run a function in the executor, or right away if there is none.
+
+    Returns:
+        An awaitable with the result of the function.
+    """
+    loop = asyncio.get_event_loop()
+    if executor is not None:
+        return loop.run_in_executor(executor, function)
+    future = loop.create_future()
+    future.set_result(function())
+    return future
+
+
+async def _batches(
+    items: Union[Iterable[T], AsyncIterable[T]], batch_size: int
+) -> AsyncIterator[List[T]]:
+    """Split an iterable or async iterable into lists of batch_size items."""
+    batch: List[T] = []
+    if isinstance(items, collections.abc.AsyncIterable):
+        async for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    else:
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _similar_pairs(
+    tokenize: Union[str, Callable[[str], Collection[str]]],
+    counts: bool,
+    threshold: float,
+    documents: Dict[int, Tuple[Optional[str], Optional[str]]],
+    pairs: List[Tuple[int, int]],
+) -> List[Tuple[int, int]]:
+    """Validate candidate pairs of :meth:`SimilarityStore.iter_duplicate_pairs`.
+
+    This is a module-level function so that it can run in a process pool. Built-in tokenizers
+    are passed by their specification, because the callables are not picklable.
+    """
+    tokenize_callable: Callable[[str], Collection[str]] = (
+        SimilarityStore._get_tokenize_callable(  # pylint: disable=protected-access
+            tokenize, counts=counts
+        )
+        if isinstance(tokenize, str)
+        else tokenize
+    )
+    tokens: Dict[int, Collection[str]] = {}
+
+    def comparable_tokens(doc_id: int) -> Collection[str]:
+        if doc_id not in tokens:
+            doc_tokens = tokenize_callable(documents[doc_id][0] or "")
+            if not counts:
+                tokens[doc_id] = set(doc_tokens)
+            elif isinstance(doc_tokens, collections.abc.Mapping):
+                tokens[doc_id] = doc_tokens
+            else:
+                tokens[doc_id] = collections.Counter(doc_tokens)
+        return tokens[doc_id]
+
+    return [
+        (id1, id2)
+        for id1, id2 in pairs
+        if documents[id1][1] == documents[id2][1]
+        and _jaccard_similarity(comparable_tokens(id1), comparable_tokens(id2)) >= threshold
+    ]
+
+
+class _DisjointSets:
+    """Union-find structure with path halving and union by size."""
+
+    def __init__(self):
+        self._parents: Dict[int, int] = {}
+        self._sizes: Dict[int, int] = {}
+
+    def find(self, element: int) -> int:
+        """Find the representative of the set of the element."""
+        parents = self._parents
+        parents.setdefault(element, element)
+        while parents[element] != element:
+            parents[element] = parents[parents[element]]
+            element = parents[element]
+        return element
+
+    def union(self, element1: int, element2: int):
+        """Merge the sets of two elements."""
+        root1, root2 = self.find(element1), self.find(element2)
+        if root1 == root2:
+            return
+        if self._sizes.get(root1, 1) < self._sizes.get(root2, 1):
+            root1, root2 = root2, root1
+        self._parents[root2] = root1
+        self._sizes[root1] = self._sizes.get(root1, 1) + self._sizes.pop(root2, 1)
+
+    def groups(self) -> List[List[int]]:
+        """Get all sets with their sorted elements, largest first."""
+        groups = collections.defaultdict(list)
+        for element in self._parents:
+            groups[self.find(element)].append(element)
+        return sorted((sorted(g) for g in groups.values()), key=lambda g: (-len(g), g[0]))
 
 
 def _jaccard_similarity(s1: Iterable, s2: Iterable):
+    if isinstance(s1, collections.abc.Mapping) and isinstance(s2, collections.abc.Mapping):
+        return _weighted_jaccard_similarity(s1, s2)
     if not isinstance(s1, set):
         s1 = set(s1)
     if not isinstance(s2, set):
@@ -361,3 +1435,27 @@ def _jaccard_similarity(s1: Iterable, s2: Iterable):
     if not union:
         return 1.0 if len(s1) == len(s2) == 0 else 0.0
     return len(s1.intersection(s2)) / len(union)
+
+
+def _containment(query: Iterable, candidate: Iterable):
+    """Calculate the fraction of the query tokens (or token weights) contained in the candidate."""
+    if isinstance(query, collections.abc.Mapping) and isinstance(
+        candidate, collections.abc.Mapping
+    ):
+        total = sum(query.values())
+        if not total:
+            return 1.0
+        return sum(min(w, candidate.get(k, 0)) for k, w in query.items()) / total
+    if not isinstance(query, set):
+        query = set(query)
+    if not query:
+        return 1.0
+    return len(query.intersection(candidate)) / len(query)
+
+
+def _weighted_jaccard_similarity(w1: collections.abc.Mapping, w2: collections.abc.Mapping):
+    keys = set(w1).union(w2)
+    union = sum(max(w1.get(k, 0), w2.get(k, 0)) for k in keys)
+    if not union:
+        return 1.0
+    return sum(min(w1.get(k, 0), w2.get(k, 0)) for k in keys) / union
@@ -1,6 +1,6 @@
 """Storage backend based on SQLite."""
 import sqlite3
-from typing import Iterable, List, Optional
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
 
 from narrow_down.storage import StorageBackend
 
@@ -175,3 +175,14 @@ class SQLiteStore(StorageBackend):
                 f"DELETE FROM buckets_{partition} " "WHERE bucket=? AND hash=? AND doc_id=?",
                 (bucket_id, document_hash, document_id),
             )
+
+    async def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets, scanning one partition table of the buckets at a time."""
+        for partition in range(self.partitions):
+            cursor = self._connection.execute(
+                f"SELECT bucket, hash, group_concat(doc_id) FROM buckets_{partition} "
+                "GROUP BY bucket, hash HAVING count(*) >= ?",
+                (min_size,),
+            )
+            for bucket_id, document_hash, doc_ids in cursor:
+                yield bucket_id, document_hash, [int(i) for i in doc_ids.split(",")]
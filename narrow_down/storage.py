@@ -4,18 +4,41 @@ import dataclasses
 import enum
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Iterable, List, NewType, Optional
+from typing import (
+    AsyncIterator,
+    Iterable,
+    List,
+    NewType,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 import numpy as np
 from numpy import typing as npt
 
-from ._rust import RustMemoryStore, protobuf_to_stored_document, stored_document_to_protobuf
+from ._rust import (
+    Compressor,
+    RustMemoryStore,
+    RustSharedMemoryStore,
+    protobuf_to_stored_document,
+    protobuf_to_stored_documents,
+    stored_document_to_protobuf,
+)
+from ._rust import train_compression_dictionary as _train_compression_dictionary
 
 
 class TooLowStorageLevel(Exception):  # noqa=N818
     """Raised if a feature is used for which a higher storage level is needed."""
 
 
+class ReadOnlyStorage(Exception):  # noqa=N818
+    """Raised if a storage backend which can only be read is about to be modified."""
+
+
 class StorageLevel(enum.Flag):
     """Detail level of document persistence."""
 
@@ -32,10 +55,40 @@ class StorageLevel(enum.Flag):
 Fingerprint = NewType("Fingerprint", npt.NDArray[np.uint32])
 """Type representing the result of a minhashing operation"""
 
+_C = TypeVar("_C")
+
+
+def _with_slots(cls: Type[_C]) -> Type[_C]:
+    """Recreate a frozen dataclass with __slots__ instead of an instance __dict__.
+
+    This is what ``@dataclass(frozen=True, slots=True)`` does from Python 3.10 on.
+    """
+    # The TypeVar can't be bound to dataclasses, the protocol for them only exists in typeshed
+    field_names = tuple(f.name for f in dataclasses.fields(cls))  # type: ignore[arg-type]
+    cls_dict = {k: v for k, v in cls.__dict__.items() if k not in field_names}
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+    cls_dict["__slots__"] = field_names
 
+    def __getstate__(self):  # noqa: N807
+        return [getattr(self, name) for name in field_names]
+
+    def __setstate__(self, state):  # noqa: N807
+        for name, value in zip(field_names, state):  # noqa=B905
+            object.__setattr__(self, name, value)
+
+    cls_dict["__getstate__"] = __getstate__
+    cls_dict["__setstate__"] = __setstate__
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)  # type: ignore
+
+
+@_with_slots
 @dataclass(frozen=True)
 class StoredDocument:
-    """Data object combining all possible fields of a document stored."""
+    """Data object combining all possible fields of a document stored.
+
+    The objects have slots instead of an instance dictionary to keep large result sets small.
+    """
 
     id_: Optional[int] = None
     """Identifier used to distinguish the document from an identical one."""
@@ -52,24 +105,107 @@ class StoredDocument:
     data: Optional[str] = None
     """Payload to persist together with the document in the internal data structures."""
 
-    def serialize(self, storage_level: StorageLevel) -> bytes:
-        """Serialize a document to bytes."""
-        return stored_document_to_protobuf(
-            fingerprint=self.fingerprint.astype(np.uint32)
-            if self.fingerprint is not None and storage_level & StorageLevel.Fingerprint
-            else None,
+    n_tokens: Optional[int] = None
+    """Number of distinct tokens, set by a containment index which partitions documents by it."""
+
+    def serialize(
+        self,
+        storage_level: StorageLevel,
+        compressor: Optional[Compressor] = None,
+        fingerprint_bits: int = 32,
+    ) -> bytes:
+        """Serialize a document to bytes.
+
+        Args:
+            storage_level: Determines the fields to serialize.
+            compressor: Optional compressor to apply to the serialized document.
+            fingerprint_bits: Number of bits to store per fingerprint value. With 1, 2, 4 or 8
+                only the lowest bits are stored ("b-bit minhash") and deserialized as uint8
+                array.
+
+        Returns:
+            The serialized and optionally compressed document.
+
+        Raises:
+            ValueError: If fingerprint_bits is not one of 1, 2, 4, 8 or 32.
+        """
+        fingerprint = self.fingerprint if storage_level & StorageLevel.Fingerprint else None
+        serialized = stored_document_to_protobuf(
+            fingerprint=fingerprint.astype(np.uint32) if fingerprint is not None else None,
+            fingerprint_bits=fingerprint_bits,
+            # Needed together with the fingerprint to find the buckets of the document
+            n_tokens=self.n_tokens if fingerprint is not None else None,
             **{f: getattr(self, f) for f in _FIELDS_FOR_STORAGE_LEVEL[storage_level]},
         )
+        if compressor is not None:
+            return compressor.compress(serialized)
+        return serialized
 
     @staticmethod
-    def deserialize(doc: bytes, id_: int) -> "StoredDocument":
-        """Deserialize a document from bytes."""
+    def deserialize(
+        doc: bytes, id_: int, compressor: Optional[Compressor] = None
+    ) -> "StoredDocument":
+        """Deserialize a document from bytes.
+
+        Args:
+            doc: The output of :meth:`serialize`.
+            id_: The ID to assign to the document.
+            compressor: The compressor used for serialization, if any.
+
+        Returns:
+            The deserialized document.
+        """
+        if compressor is not None:
+            doc = compressor.decompress(doc)
         args = protobuf_to_stored_document(doc)
         return StoredDocument(id_=id_, **args)
 
+    @staticmethod
+    def deserialize_many(
+        docs: Sequence[bytes], ids: Sequence[int], compressor: Optional[Compressor] = None
+    ) -> List["StoredDocument"]:
+        """Deserialize multiple documents from bytes at once.
+
+        This is considerably faster than calling :meth:`deserialize` for every document. The
+        fingerprints of the returned documents are rows of one shared 2-dimensional array.
+
+        Args:
+            docs: Outputs of :meth:`serialize`.
+            ids: The IDs to assign to the documents.
+            compressor: The compressor used for serialization, if any.
+
+        Returns:
+            The deserialized documents in the order of the input.
+        """
+        if compressor is not None:
+            docs = [compressor.decompress(doc) for doc in docs]
+        columns = protobuf_to_stored_documents(list(docs))
+        fingerprints = columns["fingerprint"]
+        return [
+            StoredDocument(
+                id_=id_,
+                document=document,
+                exact_part=exact_part,
+                fingerprint=fingerprints[i] if fingerprints is not None else None,
+                data=data,
+                n_tokens=n_tokens,
+            )
+            for i, (id_, document, exact_part, data, n_tokens) in enumerate(
+                zip(  # noqa=B905
+                    ids,
+                    columns["document"],
+                    columns["exact_part"],
+                    columns["data"],
+                    columns["n_tokens"],
+                )
+            )
+        ]
+
     def without(self, *attributes: str) -> "StoredDocument":
         """Create a copy with the specified attributes left out.
 
+        The copy is shallow, i.e. the fingerprint array is shared with the original.
+
         Args:
             attributes: The names of the attributes to leave empty
 
@@ -78,7 +214,12 @@ class StoredDocument:
             So they will have their default value (None).
         """
         return StoredDocument(
-            **{k: v for k, v in dataclasses.asdict(self).items() if k not in attributes}
+            id_=None if "id_" in attributes else self.id_,
+            document=None if "document" in attributes else self.document,
+            exact_part=None if "exact_part" in attributes else self.exact_part,
+            fingerprint=None if "fingerprint" in attributes else self.fingerprint,
+            data=None if "data" in attributes else self.data,
+            n_tokens=None if "n_tokens" in attributes else self.n_tokens,
         )
 
 
@@ -91,6 +232,28 @@ _FIELDS_FOR_STORAGE_LEVEL = {
 """Fields of StoredDocument which need to be serialized to reach a certain storage level."""
 
 
+def train_compression_dictionary(
+    samples: Iterable[Union[str, bytes]], max_size: int = 16384
+) -> bytes:
+    """Train a compression dictionary from sample documents.
+
+    A dictionary improves the compression of short documents a lot, because they don't contain
+    enough repetitions to be compressed well on their own.
+
+    Args:
+        samples: Representative documents. The dictionary needs in the order of 100 times
+            max_size bytes of samples to be effective.
+        max_size: Maximum size of the dictionary in bytes.
+
+    Returns:
+        A dictionary which can be passed to :meth:`SimilarityStore.create` together with a
+        compression setting.
+    """
+    return _train_compression_dictionary(
+        [s.encode("utf-8") if isinstance(s, str) else s for s in samples], max_size
+    )
+
+
 class StorageBackend(ABC):
     """Storage backend for a SimilarityStore."""
 
@@ -177,13 +340,55 @@ class StorageBackend(ABC):
         """Remove a document from a bucket."""
         raise NotImplementedError
 
+    def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets in an arbitrary order.
+
+        This is a scan over the whole bucket table, used for self-joins like
+        :meth:`narrow_down.similarity_store.SimilarityStore.find_duplicate_clusters`.
+
+        Args:
+            min_size: Skip buckets with fewer document IDs.
+
+        Returns:
+            An async iterator over tuples of bucket ID, document hash and document IDs.
+
+        Raises:
+            NotImplementedError: If the backend does not support scanning its buckets.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support scanning buckets.")
+
 
 class InMemoryStore(StorageBackend):
-    """Rust implementation of InMemoryStore."""
+    """Rust implementation of InMemoryStore.
 
-    def __init__(self):
-        """Create a new RustMemoryStore."""
-        self.rms = RustMemoryStore()
+    The store is thread-safe. It is internally synchronized and releases the GIL while accessing
+    the data, so one object can be shared and queried in parallel by multiple threads.
+    """
+
+    def __init__(
+        self,
+        dense_ids: bool = False,
+        spill_file: Optional[str] = None,
+        cache_size: int = 10000,
+        max_id_gap: int = 2**20,
+    ):
+        """Create a new RustMemoryStore.
+
+        Args:
+            dense_ids: Keep the documents in an array indexed by their ID instead of a hash map.
+                IDs of removed documents are reused and the buckets need only half the memory.
+                In this mode document IDs must be smaller than 2^32. Use it if the IDs are
+                assigned by the store or are otherwise consecutive.
+            spill_file: Keep only the buckets in memory and append the documents to this file.
+                Queries then read the documents of the candidates from the file. An existing
+                file is overwritten. Cannot be combined with ``dense_ids``.
+            cache_size: Number of recently queried documents to keep in memory if a spill file
+                is used. 0 disables the cache.
+            max_id_gap: With ``dense_ids``, how far an explicitly given document ID may lie
+                beyond the largest ID so far. Memory is allocated for all IDs up to it, so larger
+                IDs are rejected with a ValueError.
+        """
+        self.rms = RustMemoryStore(dense_ids, spill_file, cache_size, max_id_gap)
 
     def serialize(self) -> bytes:
         """Serialize the data into a messagepack so that it can be persisted somewhere."""
@@ -193,18 +398,59 @@ class InMemoryStore(StorageBackend):
         """Serialize the data into a messagepack file with the given path."""
         return self.rms.to_file(file_path)
 
+    def to_shared_file(self, file_path: str):
+        """Write the data into a file which can be opened as :class:`SharedMemoryStore`.
+
+        Args:
+            file_path: Target path. To keep the data in memory, choose a path on a tmpfs like
+                ``/dev/shm``.
+        """
+        self.rms.to_shared_file(file_path)
+
     @classmethod
-    def deserialize(cls, msgpack: bytes) -> "InMemoryStore":
-        """Deserialize an InMemoryStore object from messagepack."""
+    def deserialize(
+        cls,
+        msgpack: bytes,
+        spill_file: Optional[str] = None,
+        cache_size: int = 10000,
+        max_id_gap: int = 2**20,
+    ) -> "InMemoryStore":
+        """Deserialize an InMemoryStore object from messagepack.
+
+        Args:
+            msgpack: The output of :meth:`serialize`.
+            spill_file: Optional file to move the documents to. See :meth:`__init__`.
+            cache_size: Size of the document cache if a spill file is used.
+            max_id_gap: Largest gap of explicit IDs with dense IDs. See :meth:`__init__`.
+
+        Returns:
+            The deserialized InMemoryStore.
+        """
         obj = cls.__new__(cls)
-        obj.rms = RustMemoryStore.deserialize(msgpack)
+        obj.rms = RustMemoryStore.deserialize(msgpack, spill_file, cache_size, max_id_gap)
         return obj
 
     @classmethod
-    def from_file(cls, file_path: str) -> "InMemoryStore":
-        """Deserialize an InMemoryStore object the given messagepack file."""
+    def from_file(
+        cls,
+        file_path: str,
+        spill_file: Optional[str] = None,
+        cache_size: int = 10000,
+        max_id_gap: int = 2**20,
+    ) -> "InMemoryStore":
+        """Deserialize an InMemoryStore object the given messagepack file.
+
+        Args:
+            file_path: The file written by :meth:`to_file`.
+            spill_file: Optional file to move the documents to. See :meth:`__init__`.
+            cache_size: Size of the document cache if a spill file is used.
+            max_id_gap: Largest gap of explicit IDs with dense IDs. See :meth:`__init__`.
+
+        Returns:
+            The deserialized InMemoryStore.
+        """
         obj = cls.__new__(cls)
-        obj.rms = RustMemoryStore.from_file(file_path)
+        obj.rms = RustMemoryStore.from_file(file_path, spill_file, cache_size, max_id_gap)
         return obj
 
     async def insert_setting(self, key: str, value: str):
@@ -237,6 +483,24 @@ class InMemoryStore(StorageBackend):
             raise KeyError(f"No document with id {document_id}")
         return doc
 
+    async def query_documents(self, document_ids: List[int]) -> List[bytes]:
+        """Get the data belonging to multiple documents.
+
+        Args:
+            document_ids: Key under which the data is stored.
+
+        Returns:
+            The list of document values for the given IDs.
+
+        Raises:
+            KeyError: If no document was found for at least one of the ids.
+        """
+        docs = self.rms.query_documents(document_ids)
+        for doc_id, doc in zip(document_ids, docs):  # noqa=B905
+            if doc is None:
+                raise KeyError(f"No document with id {doc_id}")
+        return docs  # type: ignore
+
     async def remove_document(self, document_id: int):
         """Remove a document given by ID from the list of documents."""
         self.rms.remove_document(document_id)
@@ -252,3 +516,126 @@ class InMemoryStore(StorageBackend):
     async def remove_id_from_bucket(self, bucket_id: int, document_hash: int, document_id: int):
         """Remove a document from a bucket."""
         self.rms.remove_id_from_bucket(bucket_id, document_hash, document_id)
+
+    async def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets, reading one internal shard of the bucket table at a time."""
+        for chunk in range(self.rms.bucket_chunks):
+            for entry in self.rms.query_bucket_chunk(chunk, min_size):
+                yield entry
+
+
+class SharedMemoryStore(StorageBackend):
+    """Read-only storage backend which can be shared by multiple processes.
+
+    The data is queried in place from a memory-mapped file which is written once with
+    :meth:`InMemoryStore.to_shared_file`. All processes which open the same file share its pages,
+    so the memory is only needed once instead of once per process.
+
+    Example:
+        In the main process, before starting the workers::
+
+            store.to_shared_file("/dev/shm/narrow_down_index")
+
+        In every worker process::
+
+            simstore = await SimilarityStore.load_from_storage(
+                SharedMemoryStore("/dev/shm/narrow_down_index")
+            )
+    """
+
+    def __init__(self, file_path: str):
+        """Open a file written by :meth:`InMemoryStore.to_shared_file`.
+
+        Args:
+            file_path: Path of the file to map into memory.
+        """
+        self.rsms = RustSharedMemoryStore(file_path)
+
+    async def insert_setting(self, key: str, value: str):
+        """Not supported, because the store is read-only.
+
+        Raises:
+            ReadOnlyStorage: Always.
+        """
+        raise ReadOnlyStorage("Cannot insert a setting into a SharedMemoryStore.")
+
+    async def query_setting(self, key: str) -> Optional[str]:
+        """Query a setting with the given key."""
+        return self.rsms.query_setting(key)
+
+    async def insert_document(self, document: bytes, document_id: Optional[int] = None) -> int:
+        """Not supported, because the store is read-only.
+
+        Raises:
+            ReadOnlyStorage: Always.
+        """
+        raise ReadOnlyStorage("Cannot insert a document into a SharedMemoryStore.")
+
+    async def query_document(self, document_id: int) -> bytes:
+        """Get the data belonging to a document.
+
+        Args:
+            document_id: The id of the document.
+
+        Returns:
+            The document stored under the key `document_id` as bytes object.
+
+        Raises:
+            KeyError: If the document is not stored.
+        """
+        doc = self.rsms.query_document(document_id)
+        if doc is None:
+            raise KeyError(f"No document with id {document_id}")
+        return doc
+
+    async def query_documents(self, document_ids: List[int]) -> List[bytes]:
+        """Get the data belonging to multiple documents.
+
+        Args:
+            document_ids: Key under which the data is stored.
+
+        Returns:
+            The list of document values for the given IDs.
+
+        Raises:
+            KeyError: If no document was found for at least one of the ids.
+        """
+        docs = self.rsms.query_documents(document_ids)
+        for doc_id, doc in zip(document_ids, docs):  # noqa=B905
+            if doc is None:
+                raise KeyError(f"No document with id {doc_id}")
+        return docs  # type: ignore
+
+    async def remove_document(self, document_id: int):
+        """Not supported, because the store is read-only.
+
+        Raises:
+            ReadOnlyStorage: Always.
+        """
+        raise ReadOnlyStorage("Cannot remove a document from a SharedMemoryStore.")
+
+    async def add_document_to_bucket(self, bucket_id: int, document_hash: int, document_id: int):
+        """Not supported, because the store is read-only.
+
+        Raises:
+            ReadOnlyStorage: Always.
+        """
+        raise ReadOnlyStorage("Cannot add a document to a bucket of a SharedMemoryStore.")
+
+    async def query_ids_from_bucket(self, bucket_id, document_hash: int) -> Iterable[int]:
+        """Get all document IDs stored in a bucket for a certain hash value."""
+        return self.rsms.query_ids_from_bucket(bucket_id, document_hash)
+
+    async def remove_id_from_bucket(self, bucket_id: int, document_hash: int, document_id: int):
+        """Not supported, because the store is read-only.
+
+        Raises:
+            ReadOnlyStorage: Always.
+        """
+        raise ReadOnlyStorage("Cannot remove a document from a bucket of a SharedMemoryStore.")
+
+    async def iter_buckets(self, min_size: int = 1) -> AsyncIterator[Tuple[int, int, List[int]]]:
+        """Iterate over all buckets, reading the bucket index of the file chunk by chunk."""
+        for chunk in range(self.rsms.bucket_chunks):
+            for entry in self.rsms.query_bucket_chunk(chunk, min_size):
+                yield entry
@@ -0,0 +1,187 @@
+//! Compression of serialized documents.
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyBytes;
+use std::sync::Mutex;
+
+/// Compression level used for zstd if none is given in the specification
+const DEFAULT_ZSTD_LEVEL: i32 = 3;
+
+enum Codec {
+    Zstd {
+        compressor: Mutex<zstd::bulk::Compressor<'static>>,
+        decompressor: Mutex<zstd::bulk::Decompressor<'static>>,
+    },
+    Lz4,
+}
+
+/// Parse a specification like "lz4", "zstd" or "zstd(9)" into algorithm name and level.
+fn parse_spec(spec: &str) -> Option<(&str, Option<i32>)> {
+    let spec = spec.trim();
+    match spec.find('(') {
+        None => Some((spec, None)),
+        Some(i) => {
+            let argument = spec[i + 1..].strip_suffix(')')?;
+            Some((&spec[..i], Some(argument.trim().parse().ok()?)))
+        }
+    }
+}
+
+fn to_py_err(e: std::io::Error) -> PyErr {
+    PyValueError::new_err(e.to_string())
+}
+
+/// Compressor(spec: str, dictionary: Optional[bytes] = None)
+/// Compress and decompress serialized documents.
+///
+/// The spec selects the algorithm: "lz4", "zstd" or "zstd(level)". An optional dictionary,
+/// e.g. from train_compression_dictionary(), improves the compression ratio of short documents.
+/// The compressed data is prefixed with the uncompressed length as 32 bit integer.
+#[pyclass]
+pub struct Compressor {
+    spec: String,
+    dictionary: Vec<u8>,
+    codec: Codec,
+}
+
+impl Compressor {
+    fn compress_vec(&self, data: &[u8]) -> std::io::Result<Vec<u8>> {
+        match &self.codec {
+            Codec::Zstd { compressor, .. } => {
+                let compressed = compressor.lock().unwrap().compress(data)?;
+                let mut result = Vec::with_capacity(4 + compressed.len());
+                result.extend_from_slice(&(data.len() as u32).to_le_bytes());
+                result.extend_from_slice(&compressed);
+                Ok(result)
+            }
+            Codec::Lz4 => Ok(lz4_flex::block::compress_prepend_size_with_dict(
+                data,
+                &self.dictionary,
+            )),
+        }
+    }
+
+    fn decompress_vec(&self, data: &[u8]) -> std::io::Result<Vec<u8>> {
+        let invalid = |msg: String| std::io::Error::new(std::io::ErrorKind::InvalidData, msg);
+        match &self.codec {
+            Codec::Zstd { decompressor, .. } => {
+                if data.len() < 4 {
+                    return Err(invalid("Compressed document is truncated".to_string()));
+                }
+                let size = u32::from_le_bytes(data[..4].try_into().unwrap()) as usize;
+                decompressor.lock().unwrap().decompress(&data[4..], size)
+            }
+            Codec::Lz4 => {
+                lz4_flex::block::decompress_size_prepended_with_dict(data, &self.dictionary)
+                    .map_err(|e| invalid(e.to_string()))
+            }
+        }
+    }
+}
+
+#[pymethods]
+impl Compressor {
+    #[new]
+    #[pyo3(signature = (spec, dictionary=None))]
+    fn new(spec: &str, dictionary: Option<Vec<u8>>) -> PyResult<Self> {
+        let dictionary = dictionary.unwrap_or_default();
+        let codec = match parse_spec(spec) {
+            Some(("zstd", level)) => {
+                let level = level.unwrap_or(DEFAULT_ZSTD_LEVEL);
+                Codec::Zstd {
+                    compressor: Mutex::new(
+                        zstd::bulk::Compressor::with_dictionary(level, &dictionary)
+                            .map_err(to_py_err)?,
+                    ),
+                    decompressor: Mutex::new(
+                        zstd::bulk::Decompressor::with_dictionary(&dictionary)
+                            .map_err(to_py_err)?,
+                    ),
+                }
+            }
+            Some(("lz4", None)) => Codec::Lz4,
+            _ => {
+                return Err(PyValueError::new_err(format!(
+                    "Unknown compression: {}",
+                    spec
+                )))
+            }
+        };
+        Ok(Compressor {
+            spec: spec.to_string(),
+            dictionary,
+            codec,
+        })
+    }
+    fn __repr__(&self) -> String {
+        format!("Compressor({:?})", self.spec)
+    }
+    /// The specification string this object was created with.
+    #[getter]
+    fn spec(&self) -> &str {
+        &self.spec
+    }
+    /// The compression dictionary, empty if none is used.
+    #[getter]
+    fn dictionary<'py>(&self, py: Python<'py>) -> &'py PyBytes {
+        PyBytes::new(py, &self.dictionary)
+    }
+    /// Compress a serialized document.
+    fn compress<'py>(&self, py: Python<'py>, data: &[u8]) -> PyResult<&'py PyBytes> {
+        let compressed = py
+            .allow_threads(|| self.compress_vec(data))
+            .map_err(to_py_err)?;
+        Ok(PyBytes::new(py, &compressed))
+    }
+    /// Decompress a document compressed with the same specification and dictionary.
+    fn decompress<'py>(&self, py: Python<'py>, data: &[u8]) -> PyResult<&'py PyBytes> {
+        let decompressed = py
+            .allow_threads(|| self.decompress_vec(data))
+            .map_err(to_py_err)?;
+        Ok(PyBytes::new(py, &decompressed))
+    }
+}
+
+/// train_compression_dictionary(samples: List[bytes], max_size: int) -> bytes
+/// Train a zstd dictionary of at most max_size bytes from a list of sample documents.
+#[pyfunction]
+pub fn train_compression_dictionary<'py>(
+    py: Python<'py>,
+    samples: Vec<&[u8]>,
+    max_size: usize,
+) -> PyResult<&'py PyBytes> {
+    let dictionary = py
+        .allow_threads(|| zstd::dict::from_samples(&samples, max_size))
+        .map_err(to_py_err)?;
+    Ok(PyBytes::new(py, &dictionary))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_parse_spec() {
+        assert_eq!(parse_spec("lz4"), Some(("lz4", None)));
+        assert_eq!(parse_spec("zstd"), Some(("zstd", None)));
+        assert_eq!(parse_spec("zstd(9)"), Some(("zstd", Some(9))));
+        assert_eq!(parse_spec(" zstd( -1 ) "), Some(("zstd", Some(-1))));
+        assert_eq!(parse_spec("zstd(x)"), None);
+        assert_eq!(parse_spec("zstd(9"), None);
+    }
+
+    #[test]
+    fn test_roundtrip() {
+        let data = b"Some example document, some example document, some example document";
+        for spec in ["lz4", "zstd", "zstd(19)"] {
+            for dictionary in [None, Some(b"example document".to_vec())] {
+                let compressor = Compressor::new(spec, dictionary).unwrap();
+                let compressed = compressor.compress_vec(data).unwrap();
+                assert_eq!(
+                    compressor.decompress_vec(&compressed).unwrap(),
+                    data.to_vec()
+                );
+            }
+        }
+    }
+}
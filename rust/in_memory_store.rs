@@ -1,123 +1,983 @@
 //! This module contains a Rust implementation of an in-memory storage backend for LSH.
+//!
+//! The store is internally synchronized: Settings and documents are protected by a read-write
+//! lock each, the buckets are distributed over a number of independently locked shards. All
+//! methods only take a shared reference and release the GIL while they access the data, so
+//! that multiple Python threads can query one store in parallel.
+//!
+//! Documents are either kept in a hash map with arbitrary u64 IDs (the default) or, in dense ID
+//! mode, in a vector indexed by u32 IDs. The dense mode reuses the IDs of removed documents and
+//! stores only half as many bytes per ID in the buckets. Alternatively the documents can be
+//! spilled to an append-only file, with only an index and a cache of hot documents in memory.
+use lru::LruCache;
+use pyo3::exceptions::{PyIOError, PyValueError};
 use pyo3::prelude::*;
 use pyo3::types::{PyBytes, PyType};
 use rustc_hash::{FxHashMap, FxHashSet};
-use serde::{Deserialize, Serialize};
-use std::fs::File;
+use serde::ser::{Error as _, SerializeMap};
+use serde::{Deserialize, Serialize, Serializer};
+use std::borrow::Cow;
+use std::fs::{File, OpenOptions};
+use std::hash::Hash;
+use std::io::{Seek, SeekFrom, Write};
+use std::num::NonZeroUsize;
+use std::sync::{Mutex, RwLock, RwLockReadGuard};
+
+use crate::shared_memory_store;
+
+/// Number of independently locked shards of the bucket table
+const BUCKET_SHARDS: usize = 32;
+
+/// Default number of documents in the cache in front of a spill file
+const DEFAULT_CACHE_SIZE: usize = 10_000;
+
+/// Default of how far an explicit ID may lie beyond the largest ID of a store with dense IDs
+const DEFAULT_MAX_ID_GAP: usize = 1 << 20;
 
 /// A small struct to use as key for a HashMap
 #[derive(PartialEq, Hash, std::cmp::Eq, Serialize, Deserialize)]
-struct BucketKey {
-    bucket_id: u32,
-    document_hash: u32,
+pub(crate) struct BucketKey {
+    pub(crate) bucket_id: u32,
+    pub(crate) document_hash: u32,
 }
 
-/// Python class with the in-memory storage implementation.
-#[pyclass]
-#[derive(Serialize, Deserialize)]
-pub struct RustMemoryStore {
+impl BucketKey {
+    /// Index of the shard responsible for this key.
+    ///
+    /// The document hash is already the output of a hash function, so it is evenly distributed.
+    fn shard(&self) -> usize {
+        self.document_hash as usize % BUCKET_SHARDS
+    }
+}
+
+type BucketMap<T> = FxHashMap<BucketKey, FxHashSet<T>>;
+
+fn dense_id(document_id: u64) -> PyResult<u32> {
+    u32::try_from(document_id).map_err(|_| {
+        PyValueError::new_err(format!(
+            "Document ID {} is too large for a store with dense IDs",
+            document_id
+        ))
+    })
+}
+
+/// Documents keyed by arbitrary IDs.
+#[derive(Default)]
+pub(crate) struct SparseDocuments {
+    documents: FxHashMap<u64, Vec<u8>>,
+    last_doc_id: u64,
+}
+
+/// Documents in a vector indexed by their ID.
+///
+/// Slots of removed documents and gaps left by explicitly given IDs are kept in a free list and
+/// reused for new documents. Slot 0 is not assigned automatically, so that IDs start at 1 like in
+/// the sparse table. An explicit ID may lie at most max_id_gap slots beyond the end of the
+/// vector, because all slots up to it are allocated.
+pub(crate) struct DenseDocuments {
+    slots: Vec<Option<Vec<u8>>>,
+    free: Vec<u32>,
+    len: usize,
+    max_id_gap: usize,
+}
+
+impl DenseDocuments {
+    fn new(max_id_gap: usize) -> Self {
+        DenseDocuments {
+            slots: Vec::new(),
+            free: Vec::new(),
+            len: 0,
+            max_id_gap,
+        }
+    }
+
+    fn from_map(documents: FxHashMap<u64, Vec<u8>>, max_id_gap: usize) -> PyResult<Self> {
+        let size = match documents.keys().max() {
+            Some(&max_id) => dense_id(max_id)? as usize + 1,
+            None => 0,
+        };
+        let mut table = DenseDocuments {
+            slots: Vec::with_capacity(size),
+            free: Vec::new(),
+            len: documents.len(),
+            max_id_gap,
+        };
+        table.slots.resize_with(size, || None);
+        for (id, document) in documents {
+            table.slots[id as usize] = Some(document);
+        }
+        table.free = (1..size)
+            .rev()
+            .filter(|&i| table.slots[i].is_none())
+            .map(|i| i as u32)
+            .collect();
+        Ok(table)
+    }
+
+    fn insert(&mut self, document: Vec<u8>, document_id: Option<u64>) -> PyResult<u64> {
+        let index = match document_id {
+            Some(id) => {
+                let index = dense_id(id)? as usize;
+                if index.saturating_sub(self.slots.len()) > self.max_id_gap {
+                    return Err(PyValueError::new_err(format!(
+                        "Document ID {} is more than {} IDs beyond the largest ID of the store \
+                         with dense IDs",
+                        id, self.max_id_gap
+                    )));
+                }
+                if index >= self.slots.len() {
+                    // Make the skipped slots available for new documents, smallest first
+                    let gap_start = self.slots.len().max(1);
+                    self.free.extend((gap_start..index).rev().map(|i| i as u32));
+                    self.slots.resize_with(index + 1, || None);
+                }
+                index
+            }
+            None => self.next_free_slot()?,
+        };
+        if self.slots[index].replace(document).is_none() {
+            self.len += 1;
+        }
+        Ok(index as u64)
+    }
+
+    fn next_free_slot(&mut self) -> PyResult<usize> {
+        // The free list may contain slots which were filled with explicit IDs in the meantime
+        while let Some(index) = self.free.pop() {
+            if self.slots[index as usize].is_none() {
+                return Ok(index as usize);
+            }
+        }
+        if self.slots.is_empty() {
+            self.slots.push(None);
+        }
+        let index = dense_id(self.slots.len() as u64)? as usize;
+        self.slots.push(None);
+        Ok(index)
+    }
+
+    fn get(&self, document_id: u64) -> Option<&Vec<u8>> {
+        usize::try_from(document_id)
+            .ok()
+            .and_then(|i| self.slots.get(i))
+            .and_then(Option::as_ref)
+    }
+
+    fn remove(&mut self, document_id: u64) {
+        let slot = usize::try_from(document_id)
+            .ok()
+            .and_then(|i| self.slots.get_mut(i));
+        if let Some(slot) = slot {
+            if slot.take().is_some() {
+                self.len -= 1;
+                self.free.push(document_id as u32);
+            }
+        }
+    }
+}
+
+/// Documents in an append-only file with an in-memory index and an LRU cache of hot documents.
+///
+/// The space of overwritten and removed documents in the file is not reclaimed. The file is only
+/// valid together with the index, so it is truncated when the table is created.
+///
+/// Documents are read at their offset without a shared file position, so that reads of
+/// multiple threads run in parallel. Appends need a mutable reference, i.e. the write lock of
+/// the table.
+pub(crate) struct SpilledDocuments {
+    file: File,
+    file_len: u64,
+    /// Offset and length of each document in the file
+    index: FxHashMap<u64, (u64, u64)>,
+    last_doc_id: u64,
+    cache: Option<Mutex<LruCache<u64, Vec<u8>>>>,
+}
+
+impl SpilledDocuments {
+    fn create(file_path: &str, cache_size: usize) -> std::io::Result<Self> {
+        let file = OpenOptions::new()
+            .read(true)
+            .write(true)
+            .create(true)
+            .truncate(true)
+            .open(file_path)?;
+        Ok(SpilledDocuments {
+            file,
+            file_len: 0,
+            index: FxHashMap::default(),
+            last_doc_id: 0,
+            cache: NonZeroUsize::new(cache_size).map(|size| Mutex::new(LruCache::new(size))),
+        })
+    }
+
+    fn insert(&mut self, document: Vec<u8>, document_id: Option<u64>) -> std::io::Result<u64> {
+        let index = &self.index;
+        let id = document_id
+            .unwrap_or_else(|| next_sparse_id(&mut self.last_doc_id, |id| index.contains_key(&id)));
+        self.file.seek(SeekFrom::Start(self.file_len))?;
+        self.file.write_all(&document)?;
+        self.index
+            .insert(id, (self.file_len, document.len() as u64));
+        self.file_len += document.len() as u64;
+        if let Some(cache) = self.cache.as_mut() {
+            cache.get_mut().unwrap().pop(&id);
+        }
+        Ok(id)
+    }
+
+    /// Read a document from the file, bypassing the cache.
+    fn read(&self, document_id: u64) -> std::io::Result<Option<Vec<u8>>> {
+        let (offset, len) = match self.index.get(&document_id) {
+            Some(&location) => location,
+            None => return Ok(None),
+        };
+        let mut document = vec![0; len as usize];
+        read_exact_at(&self.file, &mut document, offset)?;
+        Ok(Some(document))
+    }
+
+    fn get(&self, document_id: u64) -> std::io::Result<Option<Vec<u8>>> {
+        let cache = match &self.cache {
+            Some(cache) => cache,
+            None => return self.read(document_id),
+        };
+        if let Some(document) = cache.lock().unwrap().get(&document_id) {
+            return Ok(Some(document.clone()));
+        }
+        let document = self.read(document_id)?;
+        if let Some(document) = &document {
+            cache.lock().unwrap().put(document_id, document.clone());
+        }
+        Ok(document)
+    }
+
+    fn remove(&mut self, document_id: u64) {
+        self.index.remove(&document_id);
+        if let Some(cache) = self.cache.as_mut() {
+            cache.get_mut().unwrap().pop(&document_id);
+        }
+    }
+}
+
+/// Fill the buffer with the bytes of the file at the given offset.
+#[cfg(unix)]
+fn read_exact_at(file: &File, buf: &mut [u8], offset: u64) -> std::io::Result<()> {
+    std::os::unix::fs::FileExt::read_exact_at(file, buf, offset)
+}
+
+/// Fill the buffer with the bytes of the file at the given offset.
+#[cfg(windows)]
+fn read_exact_at(file: &File, mut buf: &mut [u8], mut offset: u64) -> std::io::Result<()> {
+    use std::os::windows::fs::FileExt;
+    while !buf.is_empty() {
+        match file.seek_read(buf, offset) {
+            Ok(0) => return Err(std::io::ErrorKind::UnexpectedEof.into()),
+            Ok(n) => {
+                buf = &mut buf[n..];
+                offset += n as u64;
+            }
+            Err(e) if e.kind() == std::io::ErrorKind::Interrupted => {}
+            Err(e) => return Err(e),
+        }
+    }
+    Ok(())
+}
+
+/// Next unused ID after last_doc_id, which is advanced to the returned ID.
+fn next_sparse_id(last_doc_id: &mut u64, exists: impl Fn(u64) -> bool) -> u64 {
+    let mut id = *last_doc_id + 1;
+    while exists(id) {
+        id += 1;
+    }
+    *last_doc_id = id;
+    id
+}
+
+/// The documents together with the state needed to assign new document IDs.
+pub(crate) enum DocumentTable {
+    Sparse(SparseDocuments),
+    Dense(DenseDocuments),
+    Spilled(SpilledDocuments),
+}
+
+impl DocumentTable {
+    fn new(
+        dense_ids: bool,
+        spill_file: Option<&str>,
+        cache_size: usize,
+        max_id_gap: usize,
+    ) -> PyResult<Self> {
+        match (dense_ids, spill_file) {
+            (true, Some(_)) => Err(PyValueError::new_err(
+                "Dense IDs cannot be combined with a spill file",
+            )),
+            (true, None) => Ok(DocumentTable::Dense(DenseDocuments::new(max_id_gap))),
+            (false, Some(file_path)) => Ok(DocumentTable::Spilled(SpilledDocuments::create(
+                file_path, cache_size,
+            )?)),
+            (false, None) => Ok(DocumentTable::Sparse(SparseDocuments::default())),
+        }
+    }
+
+    fn insert(&mut self, document: Vec<u8>, document_id: Option<u64>) -> PyResult<u64> {
+        match self {
+            DocumentTable::Sparse(table) => {
+                let documents = &table.documents;
+                let id = document_id.unwrap_or_else(|| {
+                    next_sparse_id(&mut table.last_doc_id, |id| documents.contains_key(&id))
+                });
+                table.documents.insert(id, document);
+                Ok(id)
+            }
+            DocumentTable::Dense(table) => table.insert(document, document_id),
+            DocumentTable::Spilled(table) => Ok(table.insert(document, document_id)?),
+        }
+    }
+
+    /// Get a document. Documents read from a spill file are added to its cache.
+    fn get(&self, document_id: u64) -> std::io::Result<Option<Cow<[u8]>>> {
+        match self {
+            DocumentTable::Spilled(table) => Ok(table.get(document_id)?.map(Cow::Owned)),
+            _ => self.get_uncached(document_id),
+        }
+    }
+
+    /// Get a document without affecting the cache, e.g. to export the whole table.
+    pub(crate) fn get_uncached(&self, document_id: u64) -> std::io::Result<Option<Cow<[u8]>>> {
+        Ok(match self {
+            DocumentTable::Sparse(table) => table
+                .documents
+                .get(&document_id)
+                .map(|doc| Cow::Borrowed(doc.as_slice())),
+            DocumentTable::Dense(table) => table
+                .get(document_id)
+                .map(|doc| Cow::Borrowed(doc.as_slice())),
+            DocumentTable::Spilled(table) => table.read(document_id)?.map(Cow::Owned),
+        })
+    }
+
+    fn remove(&mut self, document_id: u64) {
+        match self {
+            DocumentTable::Sparse(table) => {
+                table.documents.remove(&document_id);
+            }
+            DocumentTable::Dense(table) => table.remove(document_id),
+            DocumentTable::Spilled(table) => table.remove(document_id),
+        }
+    }
+
+    pub(crate) fn len(&self) -> usize {
+        match self {
+            DocumentTable::Sparse(table) => table.documents.len(),
+            DocumentTable::Dense(table) => table.len,
+            DocumentTable::Spilled(table) => table.index.len(),
+        }
+    }
+
+    /// Iterate over the IDs and byte lengths of all documents.
+    pub(crate) fn lengths(&self) -> Box<dyn Iterator<Item = (u64, usize)> + '_> {
+        match self {
+            DocumentTable::Sparse(table) => {
+                Box::new(table.documents.iter().map(|(id, doc)| (*id, doc.len())))
+            }
+            DocumentTable::Dense(table) => Box::new(
+                table
+                    .slots
+                    .iter()
+                    .enumerate()
+                    .filter_map(|(id, doc)| doc.as_ref().map(|doc| (id as u64, doc.len()))),
+            ),
+            DocumentTable::Spilled(table) => Box::new(
+                table
+                    .index
+                    .iter()
+                    .map(|(id, (_, len))| (*id, *len as usize)),
+            ),
+        }
+    }
+
+    fn last_doc_id(&self) -> u64 {
+        match self {
+            DocumentTable::Sparse(table) => table.last_doc_id,
+            DocumentTable::Dense(table) => table.slots.len().saturating_sub(1) as u64,
+            DocumentTable::Spilled(table) => table.last_doc_id,
+        }
+    }
+
+    fn is_dense(&self) -> bool {
+        matches!(self, DocumentTable::Dense(_))
+    }
+}
+
+impl Serialize for DocumentTable {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        let mut map = serializer.serialize_map(Some(self.len()))?;
+        for (id, _) in self.lengths() {
+            if let Some(document) = self.get_uncached(id).map_err(S::Error::custom)? {
+                map.serialize_entry(&id, &*document)?;
+            }
+        }
+        map.end()
+    }
+}
+
+/// One shard of the bucket table, with u32 document IDs in dense ID mode.
+pub(crate) enum BucketShard {
+    Sparse(BucketMap<u64>),
+    Dense(BucketMap<u32>),
+}
+
+fn add_id<T: Hash + Eq>(buckets: &mut BucketMap<T>, key: BucketKey, document_id: T) {
+    buckets
+        .entry(key)
+        .or_insert_with(|| FxHashSet::with_capacity_and_hasher(1, Default::default()))
+        .insert(document_id);
+}
+
+/// A bucket as tuple of bucket ID, document hash and document IDs, like it is passed to Python.
+pub(crate) type BucketEntry = (u32, u32, Vec<u64>);
+
+fn entries<T: Copy + Into<u64>>(buckets: &BucketMap<T>, min_size: usize) -> Vec<BucketEntry> {
+    buckets
+        .iter()
+        .filter(|(_, ids)| ids.len() >= min_size)
+        .map(|(key, ids)| {
+            let ids = ids.iter().map(|&id| id.into()).collect();
+            (key.bucket_id, key.document_hash, ids)
+        })
+        .collect()
+}
+
+fn query_ids<T: Copy + Into<u64>>(buckets: &BucketMap<T>, key: &BucketKey) -> Vec<u64> {
+    match buckets.get(key) {
+        Some(bucket) => bucket.iter().map(|&id| id.into()).collect(),
+        None => Vec::with_capacity(0),
+    }
+}
+
+impl BucketShard {
+    fn new(dense_ids: bool) -> Self {
+        if dense_ids {
+            BucketShard::Dense(BucketMap::default())
+        } else {
+            BucketShard::Sparse(BucketMap::default())
+        }
+    }
+
+    fn from_map(buckets: BucketMap<u64>, dense_ids: bool) -> PyResult<Self> {
+        if !dense_ids {
+            return Ok(BucketShard::Sparse(buckets));
+        }
+        let mut dense = BucketMap::default();
+        dense.reserve(buckets.len());
+        for (key, ids) in buckets {
+            let ids = ids.into_iter().map(dense_id).collect::<PyResult<_>>()?;
+            dense.insert(key, ids);
+        }
+        Ok(BucketShard::Dense(dense))
+    }
+
+    fn add(&mut self, key: BucketKey, document_id: u64) -> PyResult<()> {
+        match self {
+            BucketShard::Sparse(buckets) => add_id(buckets, key, document_id),
+            BucketShard::Dense(buckets) => add_id(buckets, key, dense_id(document_id)?),
+        }
+        Ok(())
+    }
+
+    fn query(&self, key: &BucketKey) -> Vec<u64> {
+        match self {
+            BucketShard::Sparse(buckets) => query_ids(buckets, key),
+            BucketShard::Dense(buckets) => query_ids(buckets, key),
+        }
+    }
+
+    fn remove(&mut self, key: &BucketKey, document_id: u64) {
+        match self {
+            BucketShard::Sparse(buckets) => {
+                if let Some(bucket) = buckets.get_mut(key) {
+                    bucket.remove(&document_id);
+                }
+            }
+            BucketShard::Dense(buckets) => {
+                if let (Some(bucket), Ok(id)) = (buckets.get_mut(key), u32::try_from(document_id)) {
+                    bucket.remove(&id);
+                }
+            }
+        }
+    }
+
+    fn len(&self) -> usize {
+        match self {
+            BucketShard::Sparse(buckets) => buckets.len(),
+            BucketShard::Dense(buckets) => buckets.len(),
+        }
+    }
+
+    /// All buckets of the shard with at least min_size document IDs.
+    fn entries(&self, min_size: usize) -> Vec<BucketEntry> {
+        match self {
+            BucketShard::Sparse(buckets) => entries(buckets, min_size),
+            BucketShard::Dense(buckets) => entries(buckets, min_size),
+        }
+    }
+
+    fn keys(&self) -> Box<dyn Iterator<Item = &BucketKey> + '_> {
+        match self {
+            BucketShard::Sparse(buckets) => Box::new(buckets.keys()),
+            BucketShard::Dense(buckets) => Box::new(buckets.keys()),
+        }
+    }
+
+    fn serialize_entries<M: SerializeMap>(&self, map: &mut M) -> Result<(), M::Error> {
+        match self {
+            BucketShard::Sparse(buckets) => buckets
+                .iter()
+                .try_for_each(|(key, ids)| map.serialize_entry(key, ids)),
+            BucketShard::Dense(buckets) => buckets
+                .iter()
+                .try_for_each(|(key, ids)| map.serialize_entry(key, ids)),
+        }
+    }
+}
+
+/// Read-locked view on all bucket shards which serializes like a single map.
+pub(crate) struct ShardedBuckets<'a>(Vec<RwLockReadGuard<'a, BucketShard>>);
+
+impl ShardedBuckets<'_> {
+    pub(crate) fn len(&self) -> usize {
+        self.0.iter().map(|shard| shard.len()).sum()
+    }
+    /// Iterate over all buckets with their document IDs.
+    pub(crate) fn iter(&self) -> impl Iterator<Item = (&BucketKey, Vec<u64>)> {
+        self.0
+            .iter()
+            .flat_map(|shard| shard.keys().map(move |key| (key, shard.query(key))))
+    }
+}
+
+impl Serialize for ShardedBuckets<'_> {
+    fn serialize<S: Serializer>(&self, serializer: S) -> Result<S::Ok, S::Error> {
+        let mut map = serializer.serialize_map(Some(self.len()))?;
+        for shard in self.0.iter() {
+            shard.serialize_entries(&mut map)?;
+        }
+        map.end()
+    }
+}
+
+/// Serialization format of the store.
+///
+/// Kept identical to the field layout of earlier, unsynchronized versions, so that files written
+/// by them can still be read. The dense_ids flag was added later and defaults to false.
+#[derive(Serialize)]
+pub(crate) struct StoreSnapshotRef<'a> {
+    pub(crate) settings: &'a FxHashMap<String, String>,
+    pub(crate) documents: &'a DocumentTable,
+    pub(crate) buckets: ShardedBuckets<'a>,
+    pub(crate) last_doc_id: u64,
+    pub(crate) dense_ids: bool,
+}
+
+/// Owned counterpart of StoreSnapshotRef for deserialization.
+#[derive(Deserialize)]
+struct StoreSnapshot {
     settings: FxHashMap<String, String>,
     documents: FxHashMap<u64, Vec<u8>>,
-    buckets: FxHashMap<BucketKey, FxHashSet<u64>>,
+    buckets: BucketMap<u64>,
     last_doc_id: u64,
+    #[serde(default)]
+    dense_ids: bool,
+}
+
+/// Python class with the in-memory storage implementation.
+#[pyclass]
+pub struct RustMemoryStore {
+    settings: RwLock<FxHashMap<String, String>>,
+    documents: RwLock<DocumentTable>,
+    buckets: Vec<RwLock<BucketShard>>,
+}
+
+impl RustMemoryStore {
+    fn from_snapshot(
+        snapshot: StoreSnapshot,
+        spill_file: Option<&str>,
+        cache_size: usize,
+        max_id_gap: usize,
+    ) -> PyResult<Self> {
+        let dense_ids = snapshot.dense_ids;
+        let mut buckets: Vec<BucketMap<u64>> =
+            (0..BUCKET_SHARDS).map(|_| BucketMap::default()).collect();
+        for (key, ids) in snapshot.buckets {
+            buckets[key.shard()].insert(key, ids);
+        }
+        let documents = match DocumentTable::new(dense_ids, spill_file, cache_size, max_id_gap)? {
+            DocumentTable::Sparse(_) => DocumentTable::Sparse(SparseDocuments {
+                documents: snapshot.documents,
+                last_doc_id: snapshot.last_doc_id,
+            }),
+            DocumentTable::Dense(_) => {
+                DocumentTable::Dense(DenseDocuments::from_map(snapshot.documents, max_id_gap)?)
+            }
+            DocumentTable::Spilled(mut table) => {
+                for (id, document) in snapshot.documents {
+                    table.insert(document, Some(id))?;
+                }
+                table.last_doc_id = snapshot.last_doc_id;
+                DocumentTable::Spilled(table)
+            }
+        };
+        Ok(RustMemoryStore {
+            settings: RwLock::new(snapshot.settings),
+            documents: RwLock::new(documents),
+            buckets: buckets
+                .into_iter()
+                .map(|shard| BucketShard::from_map(shard, dense_ids).map(RwLock::new))
+                .collect::<PyResult<_>>()?,
+        })
+    }
+
+    /// Run the given function with a consistent, read-locked snapshot of the whole store.
+    fn with_snapshot<T>(&self, f: impl FnOnce(&StoreSnapshotRef) -> T) -> T {
+        let settings = self.settings.read().unwrap();
+        let documents = self.documents.read().unwrap();
+        // Writers only ever lock a single shard, so locking all of them in order is safe.
+        let buckets = ShardedBuckets(self.buckets.iter().map(|s| s.read().unwrap()).collect());
+        f(&StoreSnapshotRef {
+            settings: &settings,
+            documents: &documents,
+            buckets,
+            last_doc_id: documents.last_doc_id(),
+            dense_ids: documents.is_dense(),
+        })
+    }
+
+    fn bucket_shard(&self, key: &BucketKey) -> &RwLock<BucketShard> {
+        &self.buckets[key.shard()]
+    }
 }
 
 #[pymethods]
 impl RustMemoryStore {
     #[new]
-    fn new() -> Self {
-        RustMemoryStore {
-            settings: FxHashMap::default(),
-            documents: FxHashMap::default(),
-            buckets: FxHashMap::default(),
-            last_doc_id: 0,
-        }
+    #[pyo3(signature = (
+        dense_ids=false,
+        spill_file=None,
+        cache_size=DEFAULT_CACHE_SIZE,
+        max_id_gap=DEFAULT_MAX_ID_GAP
+    ))]
+    fn new(
+        dense_ids: bool,
+        spill_file: Option<&str>,
+        cache_size: usize,
+        max_id_gap: usize,
+    ) -> PyResult<Self> {
+        Ok(RustMemoryStore {
+            settings: RwLock::new(FxHashMap::default()),
+            documents: RwLock::new(DocumentTable::new(
+                dense_ids, spill_file, cache_size, max_id_gap,
+            )?),
+            buckets: (0..BUCKET_SHARDS)
+                .map(|_| RwLock::new(BucketShard::new(dense_ids)))
+                .collect(),
+        })
     }
     fn __repr__(&self) -> PyResult<String> {
-        let serialized = serde_json::to_string(&self.settings).unwrap();
+        let serialized = serde_json::to_string(&*self.settings.read().unwrap()).unwrap();
         Ok(format!(
             "InMemoryStore(size={}, settings={})",
-            self.documents.len(),
+            self.documents.read().unwrap().len(),
             serialized
         ))
     }
+    /// Whether the store assigns dense u32 document IDs.
+    #[getter]
+    fn dense_ids(&self) -> bool {
+        self.documents.read().unwrap().is_dense()
+    }
     fn serialize<'a>(&self, py: Python<'a>) -> PyResult<&'a PyBytes> {
-        Ok(PyBytes::new(
-            py,
-            &rmp_serde::encode::to_vec_named(&self).unwrap(),
-        ))
+        let msgpack = py.allow_threads(|| {
+            self.with_snapshot(|snapshot| rmp_serde::encode::to_vec_named(snapshot))
+                .map_err(|e| PyIOError::new_err(e.to_string()))
+        })?;
+        Ok(PyBytes::new(py, &msgpack))
     }
-    fn to_file(&self, file_path: &str) {
-        let mut f = File::create(file_path).unwrap();
-        rmp_serde::encode::write_named(&mut f, self).unwrap();
+    fn to_file(&self, py: Python, file_path: &str) -> PyResult<()> {
+        py.allow_threads(|| {
+            let mut f = File::create(file_path)?;
+            self.with_snapshot(|snapshot| rmp_serde::encode::write_named(&mut f, snapshot))
+                .map_err(|e| PyIOError::new_err(e.to_string()))
+        })
     }
+    /// Deserialize a store. If a spill file is given, the documents are moved to it.
     #[classmethod]
-    fn deserialize(_cls: &PyType, msgpack: &[u8]) -> PyResult<RustMemoryStore> {
-        Ok(rmp_serde::from_slice(msgpack).unwrap())
+    #[pyo3(signature = (
+        msgpack, spill_file=None, cache_size=DEFAULT_CACHE_SIZE, max_id_gap=DEFAULT_MAX_ID_GAP
+    ))]
+    fn deserialize(
+        _cls: &PyType,
+        py: Python,
+        msgpack: &[u8],
+        spill_file: Option<&str>,
+        cache_size: usize,
+        max_id_gap: usize,
+    ) -> PyResult<RustMemoryStore> {
+        py.allow_threads(|| {
+            Self::from_snapshot(
+                rmp_serde::from_slice(msgpack).unwrap(),
+                spill_file,
+                cache_size,
+                max_id_gap,
+            )
+        })
     }
+    /// Read a store from a file. If a spill file is given, the documents are moved to it.
     #[classmethod]
-    fn from_file(_cls: &PyType, file_path: &str) -> PyResult<RustMemoryStore> {
-        let mut f = File::open(file_path).unwrap();
-        let obj = rmp_serde::from_read(&mut f).unwrap();
-        Ok(obj)
+    #[pyo3(signature = (
+        file_path, spill_file=None, cache_size=DEFAULT_CACHE_SIZE, max_id_gap=DEFAULT_MAX_ID_GAP
+    ))]
+    fn from_file(
+        _cls: &PyType,
+        py: Python,
+        file_path: &str,
+        spill_file: Option<&str>,
+        cache_size: usize,
+        max_id_gap: usize,
+    ) -> PyResult<RustMemoryStore> {
+        py.allow_threads(|| {
+            let mut f = File::open(file_path).unwrap();
+            Self::from_snapshot(
+                rmp_serde::from_read(&mut f).unwrap(),
+                spill_file,
+                cache_size,
+                max_id_gap,
+            )
+        })
     }
-    fn insert_setting(&mut self, key: String, value: String) {
-        self.settings.insert(key, value);
+    /// Write the store in the read-only format of RustSharedMemoryStore to the given file.
+    fn to_shared_file(&self, py: Python, file_path: &str) -> PyResult<()> {
+        py.allow_threads(|| {
+            self.with_snapshot(|snapshot| {
+                shared_memory_store::write_shared_file(snapshot, file_path)
+            })
+        })?;
+        Ok(())
     }
-    fn query_setting(&self, key: String) -> Option<&String> {
-        self.settings.get(&*key)
+    fn insert_setting(&self, key: String, value: String) {
+        self.settings.write().unwrap().insert(key, value);
     }
-    fn insert_document(&mut self, document: Vec<u8>, document_id: Option<u64>) -> u64 {
-        if let Some(id) = document_id {
-            self.documents.insert(id, document);
-            id
-        } else {
-            let mut id = self.last_doc_id + 1;
-            while self.documents.contains_key(&id) {
-                id += 1;
-            }
-            self.last_doc_id = id;
-            self.documents.insert(id, document);
-            id
-        }
+    fn query_setting(&self, key: String) -> Option<String> {
+        self.settings.read().unwrap().get(&*key).cloned()
     }
-    fn query_document<'a>(&self, py: Python<'a>, document_id: u64) -> Option<&'a PyBytes> {
-        if let Some(bytes) = self.documents.get(&document_id) {
-            Some(PyBytes::new(py, bytes))
-        } else {
-            None
-        }
+    fn insert_document(
+        &self,
+        py: Python,
+        document: Vec<u8>,
+        document_id: Option<u64>,
+    ) -> PyResult<u64> {
+        py.allow_threads(|| {
+            self.documents
+                .write()
+                .unwrap()
+                .insert(document, document_id)
+        })
     }
-    fn remove_document(&mut self, document_id: u64) {
-        self.documents.remove(&document_id);
+    fn query_document<'a>(
+        &self,
+        py: Python<'a>,
+        document_id: u64,
+    ) -> PyResult<Option<&'a PyBytes>> {
+        let document = py.allow_threads(|| {
+            let table = self.documents.read().unwrap();
+            table.get(document_id).map(|doc| doc.map(Cow::into_owned))
+        })?;
+        Ok(document.map(|bytes| PyBytes::new(py, &bytes)))
     }
-    fn add_document_to_bucket(&mut self, bucket_id: u32, document_hash: u32, document_id: u64) {
-        let documents = self
-            .buckets
-            .entry(BucketKey {
-                bucket_id,
-                document_hash,
-            })
-            .or_insert_with(|| FxHashSet::with_capacity_and_hasher(1, Default::default()));
-        documents.insert(document_id);
+    /// Query multiple documents at once. Missing documents are returned as None.
+    fn query_documents<'a>(
+        &self,
+        py: Python<'a>,
+        document_ids: Vec<u64>,
+    ) -> PyResult<Vec<Option<&'a PyBytes>>> {
+        let documents = py.allow_threads(|| {
+            let table = self.documents.read().unwrap();
+            document_ids
+                .iter()
+                .map(|&id| table.get(id).map(|doc| doc.map(Cow::into_owned)))
+                .collect::<std::io::Result<Vec<_>>>()
+        })?;
+        Ok(documents
+            .into_iter()
+            .map(|doc| doc.map(|bytes| PyBytes::new(py, &bytes)))
+            .collect())
+    }
+    fn remove_document(&self, py: Python, document_id: u64) {
+        py.allow_threads(|| self.documents.write().unwrap().remove(document_id))
     }
-    fn query_ids_from_bucket(&self, bucket_id: u32, document_hash: u32) -> Vec<u64> {
-        if let Some(bucket) = self.buckets.get(&BucketKey {
+    fn add_document_to_bucket(
+        &self,
+        py: Python,
+        bucket_id: u32,
+        document_hash: u32,
+        document_id: u64,
+    ) -> PyResult<()> {
+        let key = BucketKey {
             bucket_id,
             document_hash,
-        }) {
-            bucket.iter().copied().collect::<Vec<_>>()
-        } else {
-            Vec::<u64>::with_capacity(0)
-        }
+        };
+        py.allow_threads(|| {
+            self.bucket_shard(&key)
+                .write()
+                .unwrap()
+                .add(key, document_id)
+        })
     }
-    fn remove_id_from_bucket(&mut self, bucket_id: u32, document_hash: u32, document_id: u64) {
-        let maybe_bucket = self.buckets.get_mut(&BucketKey {
+    fn query_ids_from_bucket(&self, py: Python, bucket_id: u32, document_hash: u32) -> Vec<u64> {
+        let key = BucketKey {
             bucket_id,
             document_hash,
-        });
-        if let Some(bucket) = maybe_bucket {
-            bucket.remove(&document_id);
+        };
+        py.allow_threads(|| self.bucket_shard(&key).read().unwrap().query(&key))
+    }
+    fn remove_id_from_bucket(
+        &self,
+        py: Python,
+        bucket_id: u32,
+        document_hash: u32,
+        document_id: u64,
+    ) {
+        let key = BucketKey {
+            bucket_id,
+            document_hash,
+        };
+        py.allow_threads(|| {
+            self.bucket_shard(&key)
+                .write()
+                .unwrap()
+                .remove(&key, document_id)
+        })
+    }
+    /// Number of chunks in which query_bucket_chunk returns the buckets, one per shard.
+    #[getter]
+    fn bucket_chunks(&self) -> usize {
+        BUCKET_SHARDS
+    }
+    /// All buckets of a chunk with at least min_size document IDs.
+    ///
+    /// Only the shard of the chunk is locked, so a scan over all chunks does not block writers
+    /// of the other shards.
+    fn query_bucket_chunk(&self, py: Python, chunk: usize, min_size: usize) -> Vec<BucketEntry> {
+        py.allow_threads(|| match self.buckets.get(chunk) {
+            Some(shard) => shard.read().unwrap().entries(min_size),
+            None => Vec::with_capacity(0),
+        })
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_bucket_shard__entries() {
+        for dense_ids in [false, true] {
+            let mut shard = BucketShard::new(dense_ids);
+            let key = |document_hash| BucketKey {
+                bucket_id: 1,
+                document_hash,
+            };
+            shard.add(key(5), 7).unwrap();
+            shard.add(key(5), 9).unwrap();
+            shard.add(key(6), 7).unwrap();
+            let mut entries = shard.entries(2);
+            entries[0].2.sort_unstable();
+            assert_eq!(entries, vec![(1, 5, vec![7, 9])]);
+            assert_eq!(shard.entries(1).len(), 2);
         }
     }
+
+    #[test]
+    fn test_dense_documents__reuses_removed_ids() {
+        let mut table = DenseDocuments::new(DEFAULT_MAX_ID_GAP);
+        assert_eq!(table.insert(b"a".to_vec(), None).unwrap(), 1);
+        assert_eq!(table.insert(b"b".to_vec(), None).unwrap(), 2);
+        table.remove(1);
+        assert_eq!(table.len, 1);
+        assert_eq!(table.insert(b"c".to_vec(), None).unwrap(), 1);
+        assert_eq!(table.get(1), Some(&b"c".to_vec()));
+        assert_eq!(table.insert(b"d".to_vec(), None).unwrap(), 3);
+    }
+
+    #[test]
+    fn test_dense_documents__fills_gaps_of_explicit_ids() {
+        let mut table = DenseDocuments::new(DEFAULT_MAX_ID_GAP);
+        assert_eq!(table.insert(b"a".to_vec(), Some(3)).unwrap(), 3);
+        assert_eq!(table.insert(b"b".to_vec(), Some(1)).unwrap(), 1);
+        assert_eq!(table.insert(b"c".to_vec(), None).unwrap(), 2);
+        assert_eq!(table.insert(b"d".to_vec(), None).unwrap(), 4);
+        assert_eq!(table.len, 4);
+        assert_eq!(table.get(0), None);
+    }
+
+    #[test]
+    fn test_dense_documents__rejects_large_gaps() {
+        let mut table = DenseDocuments::new(10);
+        assert_eq!(table.insert(b"a".to_vec(), Some(10)).unwrap(), 10);
+        assert_eq!(table.insert(b"b".to_vec(), Some(21)).unwrap(), 21);
+        assert!(table.insert(b"c".to_vec(), Some(33)).is_err());
+        assert!(table.insert(b"c".to_vec(), Some(u32::MAX as u64)).is_err());
+        assert_eq!(table.slots.len(), 22);
+        assert_eq!(table.len, 2);
+    }
+
+    #[test]
+    fn test_dense_documents__from_map() {
+        let mut documents = FxHashMap::default();
+        documents.insert(2, b"a".to_vec());
+        documents.insert(4, b"b".to_vec());
+        let mut table = DenseDocuments::from_map(documents, DEFAULT_MAX_ID_GAP).unwrap();
+        assert_eq!(table.len, 2);
+        assert_eq!(table.insert(b"c".to_vec(), None).unwrap(), 1);
+        assert_eq!(table.insert(b"d".to_vec(), None).unwrap(), 3);
+        assert_eq!(table.insert(b"e".to_vec(), None).unwrap(), 5);
+    }
+
+    #[test]
+    fn test_spilled_documents() {
+        let path = std::env::temp_dir().join("narrow_down_test_spilled_documents.bin");
+        let mut table = SpilledDocuments::create(path.to_str().unwrap(), 1).unwrap();
+        assert_eq!(table.insert(b"a".to_vec(), None).unwrap(), 1);
+        assert_eq!(table.insert(b"bb".to_vec(), Some(5)).unwrap(), 5);
+        assert_eq!(table.insert(b"c".to_vec(), None).unwrap(), 2);
+        assert_eq!(table.get(5).unwrap(), Some(b"bb".to_vec()));
+        assert_eq!(table.get(1).unwrap(), Some(b"a".to_vec()));
+        // Overwriting must invalidate the cached version
+        table.insert(b"d".to_vec(), Some(1)).unwrap();
+        assert_eq!(table.get(1).unwrap(), Some(b"d".to_vec()));
+        table.remove(5);
+        assert_eq!(table.get(5).unwrap(), None);
+        assert_eq!(table.index.len(), 2);
+        std::fs::remove_file(path).unwrap();
+    }
+
+    #[test]
+    fn test_spilled_documents__parallel_reads() {
+        let path = std::env::temp_dir().join("narrow_down_test_spilled_documents_parallel.bin");
+        let mut table = SpilledDocuments::create(path.to_str().unwrap(), 0).unwrap();
+        for i in 0..100u8 {
+            table.insert(vec![i; i as usize + 1], None).unwrap();
+        }
+        let table = &table;
+        std::thread::scope(|scope| {
+            for _ in 0..4 {
+                scope.spawn(move || {
+                    for i in (0..100u8).rev() {
+                        let document = table.get(i as u64 + 1).unwrap();
+                        assert_eq!(document, Some(vec![i; i as usize + 1]));
+                    }
+                });
+            }
+        });
+        std::fs::remove_file(path).unwrap();
+    }
 }
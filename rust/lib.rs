@@ -1,7 +1,9 @@
 //! Compiling the library to a Python package
+mod compression;
 mod hash;
 mod in_memory_store;
 mod minhash;
+mod shared_memory_store;
 mod storage;
 mod tokenize;
 
@@ -11,16 +13,27 @@ use pyo3::wrap_pyfunction;
 #[pymodule]
 fn _rust(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add("__version__", env!("CARGO_PKG_VERSION"))?;
+    m.add_function(wrap_pyfunction!(
+        compression::train_compression_dictionary,
+        m
+    )?)?;
     m.add_function(wrap_pyfunction!(hash::murmur3_32bit, m)?)?;
     m.add_function(wrap_pyfunction!(hash::xxhash_32bit, m)?)?;
     m.add_function(wrap_pyfunction!(hash::xxhash_64bit, m)?)?;
     m.add_function(wrap_pyfunction!(minhash::minhash, m)?)?;
+    m.add_function(wrap_pyfunction!(minhash::minhash_with_runner_up, m)?)?;
+    m.add_function(wrap_pyfunction!(minhash::one_permutation_minhash, m)?)?;
+    m.add_function(wrap_pyfunction!(minhash::weighted_minhash, m)?)?;
+    m.add_function(wrap_pyfunction!(minhash::simhash, m)?)?;
     m.add_function(wrap_pyfunction!(minhash::false_negative_probability, m)?)?;
     m.add_function(wrap_pyfunction!(minhash::false_positive_probability, m)?)?;
     m.add_function(wrap_pyfunction!(storage::stored_document_to_protobuf, m)?)?;
     m.add_function(wrap_pyfunction!(storage::protobuf_to_stored_document, m)?)?;
+    m.add_function(wrap_pyfunction!(storage::protobuf_to_stored_documents, m)?)?;
     m.add_function(wrap_pyfunction!(tokenize::char_ngrams_bytes, m)?)?;
     m.add_function(wrap_pyfunction!(tokenize::char_ngrams_str, m)?)?;
+    m.add_class::<compression::Compressor>()?;
     m.add_class::<in_memory_store::RustMemoryStore>()?;
+    m.add_class::<shared_memory_store::RustSharedMemoryStore>()?;
     Ok(())
 }
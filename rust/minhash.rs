@@ -1,8 +1,11 @@
 //! Implementation of the minhash algorithm.
 use crate::hash;
 
+use std::collections::HashMap;
+
 use numpy::PyReadonlyArray1;
 use peroxide::numerical::integral;
+use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
 
 const MERSENNE_PRIME: u64 = u32::MAX as u64; // mersenne prime (1 << 32) - 1
@@ -37,6 +40,187 @@ pub fn minhash(
     Ok(minhashes)
 }
 
+/// Calculate the minhashes together with the second smallest hash value of each permutation.
+///
+/// The second smallest values are the most likely minhashes of a similar document which lacks
+/// the shingle with the smallest value. They are used to probe neighbouring LSH buckets.
+/// Permutations with less than two distinct values get (1 << 32) - 1 as second value.
+#[pyfunction]
+pub fn minhash_with_runner_up(
+    shingle_list: Vec<&str>,
+    a: PyReadonlyArray1<'_, u32>,
+    b: PyReadonlyArray1<'_, u32>,
+) -> PyResult<(Vec<u32>, Vec<u32>)> {
+    assert_eq!(a.ndim(), 1);
+    assert_eq!(b.ndim(), 1);
+    assert_eq!(a.shape()[0], b.shape()[0]);
+
+    let murmur_hashes: Vec<u64> = shingle_list
+        .iter()
+        .map(|s| hash::murmur3_32bit(s.as_bytes()) as u64)
+        .collect();
+    let mut minhashes: Vec<u32> = Vec::new();
+    let mut runners_up: Vec<u32> = Vec::new();
+
+    for (a_i, b_i) in a.as_slice()?.iter().zip(b.as_slice()?) {
+        let mut smallest = MERSENNE_PRIME;
+        let mut second = MERSENNE_PRIME;
+        for h in &murmur_hashes {
+            let value = (u64::from(*a_i) * h + u64::from(*b_i)) % MERSENNE_PRIME;
+            if value < smallest {
+                second = smallest;
+                smallest = value;
+            } else if value > smallest && value < second {
+                second = value;
+            }
+        }
+        minhashes.push(smallest as u32);
+        runners_up.push(second as u32);
+    }
+
+    Ok((minhashes, runners_up))
+}
+
+/// Calculate a fingerprint with one permutation hashing (OPH) and optimal densification.
+///
+/// Each shingle is hashed only once with the universal hash `(a * h + b) % p`. The hash range is
+/// split into n_hashes bins and the minimum of each bin forms one entry of the fingerprint.
+/// Empty bins borrow the value of another bin, chosen by a hash of the bin number and the
+/// attempt number ("optimal densification", Shrivastava 2017). This makes the cost
+/// O(n_shingles + n_hashes) instead of O(n_shingles * n_hashes) for the classic minhash.
+#[pyfunction]
+pub fn one_permutation_minhash(
+    shingle_list: Vec<&str>,
+    n_hashes: usize,
+    a: u32,
+    b: u32,
+    seed: u64,
+) -> PyResult<Vec<u32>> {
+    if n_hashes == 0 {
+        return Err(PyValueError::new_err("n_hashes must be positive"));
+    }
+    const EMPTY: u64 = u64::MAX;
+    let mut bins = vec![EMPTY; n_hashes];
+    for shingle in shingle_list {
+        let h = (u64::from(a) * hash::murmur3_32bit(shingle.as_bytes()) as u64 + u64::from(b))
+            % MERSENNE_PRIME;
+        let bin = ((h * n_hashes as u64) >> 32) as usize;
+        if h < bins[bin] {
+            bins[bin] = h;
+        }
+    }
+    if bins.iter().all(|h| *h == EMPTY) {
+        return Ok(vec![MERSENNE_PRIME as u32; n_hashes]);
+    }
+
+    let minhashes = (0..n_hashes)
+        .map(|i| {
+            let mut attempt: u64 = 0;
+            let mut h = bins[i];
+            while h == EMPTY {
+                let j = splitmix64(seed ^ ((i as u64) << 32) ^ attempt) % n_hashes as u64;
+                h = bins[j as usize];
+                attempt += 1;
+            }
+            h as u32
+        })
+        .collect();
+    Ok(minhashes)
+}
+
+/// Calculate a weighted minhash fingerprint with Improved Consistent Weighted Sampling (ICWS).
+///
+/// The probability that two fingerprints agree in one position equals the weighted Jaccard
+/// similarity sum(min(w1, w2)) / sum(max(w1, w2)) of the token weights, e.g. term frequencies.
+/// The random variables of each token and hash position are derived from the token's hash, so
+/// the same token gets the same values in every document.
+///
+/// Source: Ioffe, "Improved Consistent Sampling, Weighted Minhash and L1 Sketching", 2010.
+#[pyfunction]
+pub fn weighted_minhash(
+    token_weights: HashMap<&str, f64>,
+    n_hashes: usize,
+    seed: u64,
+) -> PyResult<Vec<u32>> {
+    if token_weights.values().any(|w| !w.is_finite() || *w < 0.0) {
+        return Err(PyValueError::new_err(
+            "Token weights must be finite and not negative",
+        ));
+    }
+    let tokens: Vec<(u64, f64)> = token_weights
+        .iter()
+        .filter(|(_, w)| **w > 0.0)
+        .map(|(t, w)| (hash::xxhash_64bit(t.as_bytes()), w.ln()))
+        .collect();
+    if tokens.is_empty() {
+        return Ok(vec![MERSENNE_PRIME as u32; n_hashes]);
+    }
+
+    let minhashes = (0..n_hashes as u64)
+        .map(|k| {
+            let mut best_a = f64::INFINITY;
+            let mut best = 0u32;
+            for (token_hash, ln_weight) in &tokens {
+                let base = splitmix64(seed ^ token_hash) ^ k.wrapping_mul(0x9e3779b97f4a7c15);
+                let mut uniform = (0..5).map(|i| unit_interval(splitmix64(base ^ i)));
+                let r = -(uniform.next().unwrap() * uniform.next().unwrap()).ln(); // Gamma(2, 1)
+                let c = -(uniform.next().unwrap() * uniform.next().unwrap()).ln(); // Gamma(2, 1)
+                let beta = uniform.next().unwrap();
+                let t = (ln_weight / r + beta).floor();
+                let ln_y = r * (t - beta);
+                let a = c.ln() - ln_y - r;
+                if a < best_a {
+                    best_a = a;
+                    best = splitmix64(token_hash ^ (t as i64 as u64).rotate_left(32)) as u32;
+                }
+            }
+            best
+        })
+        .collect();
+    Ok(minhashes)
+}
+
+/// Calculate a 64 bit SimHash fingerprint of the given shingles.
+///
+/// Each shingle is hashed to 64 random bits, which vote with +1 or -1 for each bit of the
+/// fingerprint. This corresponds to random hyperplanes, so the fraction of differing bits of two
+/// fingerprints estimates the angle between the shingle vectors of the two documents divided by
+/// pi. An empty list of shingles gives 0.
+///
+/// Source: Charikar, "Similarity Estimation Techniques from Rounding Algorithms", 2002.
+#[pyfunction]
+pub fn simhash(shingle_list: Vec<&str>, seed: u64) -> u64 {
+    let mut votes = [0i64; 64];
+    for shingle in &shingle_list {
+        let h = splitmix64(hash::xxhash_64bit(shingle.as_bytes()) ^ seed);
+        for (bit, vote) in votes.iter_mut().enumerate() {
+            if (h >> bit) & 1 == 1 {
+                *vote += 1;
+            } else {
+                *vote -= 1;
+            }
+        }
+    }
+    votes
+        .iter()
+        .enumerate()
+        .filter(|(_, vote)| **vote > 0)
+        .fold(0u64, |fingerprint, (bit, _)| fingerprint | (1 << bit))
+}
+
+/// Map a random 64 bit integer to a float in the open interval (0, 1).
+fn unit_interval(x: u64) -> f64 {
+    ((x >> 11) as f64 + 0.5) / (1u64 << 53) as f64
+}
+
+/// Well mixing 64 bit hash function for integers, used to select the bins for densification.
+fn splitmix64(x: u64) -> u64 {
+    let mut z = x.wrapping_add(0x9e3779b97f4a7c15);
+    z = (z ^ (z >> 30)).wrapping_mul(0xbf58476d1ce4e5b9);
+    z = (z ^ (z >> 27)).wrapping_mul(0x94d049bb133111eb);
+    z ^ (z >> 31)
+}
+
 /// Calculate the false-positive probability of a given minhash-LSH configuration
 #[pyfunction]
 pub fn false_positive_probability(threshold: f64, b: i64, r: i64) -> f64 {
@@ -84,6 +268,72 @@ mod tests {
         assert_approx_eq!(false_negative_probability(0.2, 10, 1), 0.007809031447272733);
     }
 
+    #[test]
+    fn test_one_permutation_minhash() {
+        let shingles = vec!["abc", "def", "ghi", "jkl"];
+        let mh = one_permutation_minhash(shingles.clone(), 16, 1608637543, 4083286876, 42).unwrap();
+        assert_eq!(mh.len(), 16);
+        assert!(mh.iter().all(|h| *h < MERSENNE_PRIME as u32));
+        // Every value comes from one of the shingles
+        let mut distinct = mh.clone();
+        distinct.sort();
+        distinct.dedup();
+        assert!(distinct.len() <= shingles.len());
+        assert_eq!(
+            one_permutation_minhash(shingles, 16, 1608637543, 4083286876, 42).unwrap(),
+            mh
+        );
+    }
+
+    #[test]
+    fn test_one_permutation_minhash_empty() {
+        let mh = one_permutation_minhash(vec![], 4, 1, 0, 42).unwrap();
+        assert_eq!(mh, vec![MERSENNE_PRIME as u32; 4]);
+    }
+
+    #[test]
+    fn test_weighted_minhash() {
+        let weights = HashMap::from([("abc", 1.0), ("def", 3.0), ("ghi", 0.5)]);
+        let mh = weighted_minhash(weights.clone(), 32, 42).unwrap();
+        assert_eq!(mh.len(), 32);
+        assert_eq!(weighted_minhash(weights.clone(), 32, 42).unwrap(), mh);
+        // Zero weights are ignored
+        let mut with_zero = weights.clone();
+        with_zero.insert("xyz", 0.0);
+        assert_eq!(weighted_minhash(with_zero, 32, 42).unwrap(), mh);
+        let empty = weighted_minhash(HashMap::new(), 4, 42).unwrap();
+        assert_eq!(empty, vec![MERSENNE_PRIME as u32; 4]);
+    }
+
+    #[test]
+    fn test_weighted_minhash_estimates_weighted_jaccard() {
+        let mut w1 = HashMap::new();
+        let mut w2 = HashMap::new();
+        let names: Vec<String> = (0..100).map(|i| format!("token {}", i)).collect();
+        for name in &names {
+            w1.insert(name.as_str(), 2.0);
+            w2.insert(name.as_str(), 1.0);
+        }
+        // Weighted Jaccard similarity: 100 / 200 = 0.5
+        let mh1 = weighted_minhash(w1, 1024, 42).unwrap();
+        let mh2 = weighted_minhash(w2, 1024, 42).unwrap();
+        let matches = mh1.iter().zip(&mh2).filter(|(a, b)| a == b).count() as f64 / 1024.0;
+        assert!((matches - 0.5).abs() < 0.07, "{}", matches);
+    }
+
+    #[test]
+    fn test_simhash() {
+        let shingles: Vec<String> = (0..100).map(|i| format!("shingle {}", i)).collect();
+        let shingle_refs: Vec<&str> = shingles.iter().map(|s| s.as_str()).collect();
+        let fingerprint = simhash(shingle_refs.clone(), 42);
+        assert_eq!(simhash(shingle_refs.clone(), 42), fingerprint);
+        assert_eq!(simhash(vec![], 42), 0);
+        // A small change flips only a few bits
+        let mut changed = shingle_refs.clone();
+        changed[0] = "other";
+        assert!((simhash(changed, 42) ^ fingerprint).count_ones() < 16);
+    }
+
     // // This needs linking to libpython and doesn't work with cargo test:
     // use numpy::IntoPyArray;
     // #[test]
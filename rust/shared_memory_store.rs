@@ -0,0 +1,284 @@
+//! Read-only store which is queried in place from a memory-mapped file.
+//!
+//! The file is written once from a RustMemoryStore. Afterwards any number of processes can map
+//! it. Because the data is never copied into the process heap, the operating system shares the
+//! pages between all of them. Placing the file on a tmpfs like /dev/shm keeps it in memory.
+//!
+//! File layout (all integers little endian):
+//!
+//! - Header: the magic bytes, the format version and offset and length of five sections
+//! - Settings: The settings map as messagepack
+//! - Bucket index: Entries of (bucket_id: u32, document_hash: u32, start: u64, len: u64),
+//!   sorted by bucket_id and document_hash. start and len refer to the bucket ID section.
+//! - Bucket IDs: The document IDs of all buckets as u64, one bucket after the other.
+//! - Document index: Entries of (id: u64, start: u64, len: u64), sorted by id. start and len
+//!   refer to the payload section.
+//! - Payload: The serialized documents, one after the other.
+use memmap2::Mmap;
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::PyBytes;
+use rustc_hash::FxHashMap;
+use std::fs::{self, File};
+use std::io::{BufWriter, Write};
+
+use crate::in_memory_store::{BucketEntry, StoreSnapshotRef};
+
+const MAGIC: &[u8; 8] = b"NRWDNSHM";
+const FORMAT_VERSION: u64 = 1;
+const N_SECTIONS: usize = 5;
+const HEADER_SIZE: usize = 16 + N_SECTIONS * 16;
+const BUCKET_ENTRY_SIZE: usize = 24;
+const DOCUMENT_ENTRY_SIZE: usize = 24;
+/// Number of bucket index entries per chunk of query_bucket_chunk
+const SCAN_CHUNK_SIZE: usize = 65536;
+
+/// Offset and length in bytes of a section of the file.
+#[derive(Clone, Copy, Default)]
+struct Section {
+    offset: usize,
+    len: usize,
+}
+
+fn read_u32(buf: &[u8], pos: usize) -> u32 {
+    u32::from_le_bytes(buf[pos..pos + 4].try_into().unwrap())
+}
+
+fn read_u64(buf: &[u8], pos: usize) -> u64 {
+    u64::from_le_bytes(buf[pos..pos + 8].try_into().unwrap())
+}
+
+/// Write the contents of a store snapshot in the shared file format.
+///
+/// The file is first written under a temporary name and then moved to the target path, so that
+/// processes never see a partially written file.
+pub(crate) fn write_shared_file(
+    snapshot: &StoreSnapshotRef,
+    file_path: &str,
+) -> std::io::Result<()> {
+    let settings = rmp_serde::encode::to_vec_named(snapshot.settings).unwrap();
+
+    let mut buckets: Vec<_> = snapshot.buckets.iter().collect();
+    buckets.sort_unstable_by_key(|(key, _)| (key.bucket_id, key.document_hash));
+    for (_, ids) in buckets.iter_mut() {
+        ids.sort_unstable();
+    }
+    let n_bucket_ids: usize = buckets.iter().map(|(_, ids)| ids.len()).sum();
+
+    let mut documents: Vec<(u64, usize)> = snapshot.documents.lengths().collect();
+    documents.sort_unstable();
+    let payload_len: usize = documents.iter().map(|(_, len)| len).sum();
+
+    let section_lengths = [
+        settings.len(),
+        buckets.len() * BUCKET_ENTRY_SIZE,
+        n_bucket_ids * 8,
+        documents.len() * DOCUMENT_ENTRY_SIZE,
+        payload_len,
+    ];
+
+    let tmp_path = format!("{}.tmp", file_path);
+    let mut f = BufWriter::new(File::create(&tmp_path)?);
+    f.write_all(MAGIC)?;
+    f.write_all(&FORMAT_VERSION.to_le_bytes())?;
+    let mut offset = HEADER_SIZE;
+    for len in section_lengths {
+        f.write_all(&(offset as u64).to_le_bytes())?;
+        f.write_all(&(len as u64).to_le_bytes())?;
+        offset += len;
+    }
+
+    f.write_all(&settings)?;
+
+    let mut start: u64 = 0;
+    for (key, ids) in buckets.iter() {
+        f.write_all(&key.bucket_id.to_le_bytes())?;
+        f.write_all(&key.document_hash.to_le_bytes())?;
+        f.write_all(&start.to_le_bytes())?;
+        f.write_all(&(ids.len() as u64).to_le_bytes())?;
+        start += ids.len() as u64;
+    }
+    for (_, ids) in buckets.iter() {
+        for id in ids {
+            f.write_all(&id.to_le_bytes())?;
+        }
+    }
+
+    let mut start: u64 = 0;
+    for (id, len) in documents.iter() {
+        f.write_all(&id.to_le_bytes())?;
+        f.write_all(&start.to_le_bytes())?;
+        f.write_all(&(*len as u64).to_le_bytes())?;
+        start += *len as u64;
+    }
+    // Documents are fetched one by one, so that spilled documents are never all in memory
+    for (id, _) in documents.iter() {
+        if let Some(doc) = snapshot.documents.get_uncached(*id)? {
+            f.write_all(&doc)?;
+        }
+    }
+
+    f.into_inner()?.sync_all()?;
+    fs::rename(&tmp_path, file_path)
+}
+
+/// Python class with a read-only store backed by a memory-mapped file.
+#[pyclass]
+pub struct RustSharedMemoryStore {
+    mmap: Mmap,
+    settings: FxHashMap<String, String>,
+    bucket_index: Section,
+    bucket_ids: Section,
+    document_index: Section,
+    payload: Section,
+}
+
+impl RustSharedMemoryStore {
+    /// Find the IDs stored in a bucket by binary search in the bucket index.
+    fn find_bucket(&self, bucket_id: u32, document_hash: u32) -> Vec<u64> {
+        let buf = &self.mmap[..];
+        let entry = |i: usize| self.bucket_index.offset + i * BUCKET_ENTRY_SIZE;
+        let (mut lo, mut hi) = (0, self.bucket_index.len / BUCKET_ENTRY_SIZE);
+        while lo < hi {
+            let mid = (lo + hi) / 2;
+            let pos = entry(mid);
+            let key = (read_u32(buf, pos), read_u32(buf, pos + 4));
+            match key.cmp(&(bucket_id, document_hash)) {
+                std::cmp::Ordering::Less => lo = mid + 1,
+                std::cmp::Ordering::Greater => hi = mid,
+                std::cmp::Ordering::Equal => return self.read_bucket_ids(pos),
+            }
+        }
+        Vec::with_capacity(0)
+    }
+
+    /// Read the document IDs of the bucket index entry at the given position.
+    fn read_bucket_ids(&self, pos: usize) -> Vec<u64> {
+        let buf = &self.mmap[..];
+        let start = read_u64(buf, pos + 8) as usize;
+        let len = read_u64(buf, pos + 16) as usize;
+        let first = self.bucket_ids.offset + start * 8;
+        (0..len).map(|i| read_u64(buf, first + i * 8)).collect()
+    }
+
+    fn n_buckets(&self) -> usize {
+        self.bucket_index.len / BUCKET_ENTRY_SIZE
+    }
+
+    /// Find a document by binary search in the document index.
+    fn find_document(&self, document_id: u64) -> Option<&[u8]> {
+        let buf = &self.mmap[..];
+        let entry = |i: usize| self.document_index.offset + i * DOCUMENT_ENTRY_SIZE;
+        let (mut lo, mut hi) = (0, self.document_index.len / DOCUMENT_ENTRY_SIZE);
+        while lo < hi {
+            let mid = (lo + hi) / 2;
+            let pos = entry(mid);
+            match read_u64(buf, pos).cmp(&document_id) {
+                std::cmp::Ordering::Less => lo = mid + 1,
+                std::cmp::Ordering::Greater => hi = mid,
+                std::cmp::Ordering::Equal => {
+                    let start = self.payload.offset + read_u64(buf, pos + 8) as usize;
+                    let len = read_u64(buf, pos + 16) as usize;
+                    return Some(&buf[start..start + len]);
+                }
+            }
+        }
+        None
+    }
+}
+
+#[pymethods]
+impl RustSharedMemoryStore {
+    #[new]
+    fn new(file_path: &str) -> PyResult<Self> {
+        let f = File::open(file_path)?;
+        // Safety: The file is only written once under a temporary name and never modified after
+        // it has been moved to its final path.
+        let mmap = unsafe { Mmap::map(&f)? };
+        if mmap.len() < HEADER_SIZE || &mmap[..8] != MAGIC {
+            return Err(PyValueError::new_err(format!(
+                "Not a shared memory store file: {}",
+                file_path
+            )));
+        }
+        let version = read_u64(&mmap, 8);
+        if version != FORMAT_VERSION {
+            return Err(PyValueError::new_err(format!(
+                "Unsupported shared memory store format version: {}",
+                version
+            )));
+        }
+        let mut sections = [Section::default(); N_SECTIONS];
+        for (i, section) in sections.iter_mut().enumerate() {
+            section.offset = read_u64(&mmap, 16 + i * 16) as usize;
+            section.len = read_u64(&mmap, 24 + i * 16) as usize;
+            if section.offset + section.len > mmap.len() {
+                return Err(PyValueError::new_err(format!(
+                    "Truncated shared memory store file: {}",
+                    file_path
+                )));
+            }
+        }
+        let [settings, bucket_index, bucket_ids, document_index, payload] = sections;
+        let settings =
+            rmp_serde::from_slice(&mmap[settings.offset..settings.offset + settings.len])
+                .map_err(|e| PyValueError::new_err(e.to_string()))?;
+        Ok(RustSharedMemoryStore {
+            mmap,
+            settings,
+            bucket_index,
+            bucket_ids,
+            document_index,
+            payload,
+        })
+    }
+    fn __repr__(&self) -> PyResult<String> {
+        let serialized = serde_json::to_string(&self.settings).unwrap();
+        Ok(format!(
+            "SharedMemoryStore(size={}, settings={})",
+            self.document_index.len / DOCUMENT_ENTRY_SIZE,
+            serialized
+        ))
+    }
+    fn query_setting(&self, key: String) -> Option<String> {
+        self.settings.get(&*key).cloned()
+    }
+    fn query_document<'a>(&self, py: Python<'a>, document_id: u64) -> Option<&'a PyBytes> {
+        self.find_document(document_id)
+            .map(|bytes| PyBytes::new(py, bytes))
+    }
+    /// Query multiple documents at once. Missing documents are returned as None.
+    fn query_documents<'a>(
+        &self,
+        py: Python<'a>,
+        document_ids: Vec<u64>,
+    ) -> Vec<Option<&'a PyBytes>> {
+        document_ids
+            .into_iter()
+            .map(|id| self.find_document(id).map(|bytes| PyBytes::new(py, bytes)))
+            .collect()
+    }
+    fn query_ids_from_bucket(&self, py: Python, bucket_id: u32, document_hash: u32) -> Vec<u64> {
+        py.allow_threads(|| self.find_bucket(bucket_id, document_hash))
+    }
+    /// Number of chunks in which query_bucket_chunk returns the buckets.
+    #[getter]
+    fn bucket_chunks(&self) -> usize {
+        (self.n_buckets() + SCAN_CHUNK_SIZE - 1) / SCAN_CHUNK_SIZE
+    }
+    /// All buckets of a chunk of the bucket index with at least min_size document IDs.
+    fn query_bucket_chunk(&self, py: Python, chunk: usize, min_size: usize) -> Vec<BucketEntry> {
+        py.allow_threads(|| {
+            let buf = &self.mmap[..];
+            let end = ((chunk + 1) * SCAN_CHUNK_SIZE).min(self.n_buckets());
+            (chunk * SCAN_CHUNK_SIZE..end)
+                .map(|i| self.bucket_index.offset + i * BUCKET_ENTRY_SIZE)
+                .filter(|&pos| read_u64(buf, pos + 16) as usize >= min_size)
+                .map(|pos| {
+                    let ids = self.read_bucket_ids(pos);
+                    (read_u32(buf, pos), read_u32(buf, pos + 4), ids)
+                })
+                .collect()
+        })
+    }
+}
@@ -3,6 +3,7 @@ use std::io::Cursor;
 use numpy::PyArray1;
 use numpy::PyReadonlyArray1;
 use prost::Message;
+use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
 use pyo3::types::{PyBytes, PyDict};
 
@@ -11,34 +12,127 @@ mod stored_document {
 }
 
 /// Create a StoredDocumentProto message from the inputs and return it as bytes object.
+///
+/// With fingerprint_bits below 32 only the lowest bits of each fingerprint value are stored,
+/// packed into bytes.
 #[pyfunction]
+#[pyo3(signature = (
+    document=None,
+    exact_part=None,
+    fingerprint=None,
+    data=None,
+    fingerprint_bits=32,
+    n_tokens=None
+))]
 pub fn stored_document_to_protobuf(
     py: Python,
     document: Option<String>,
     exact_part: Option<String>,
     fingerprint: Option<PyReadonlyArray1<'_, u32>>,
     data: Option<String>,
-) -> PyObject {
+    fingerprint_bits: u32,
+    n_tokens: Option<u32>,
+) -> PyResult<PyObject> {
     let fingerprint_rust = match fingerprint {
         Some(array) => array.to_vec().unwrap(), // TODO: unsafe
         None => Vec::new(),
     };
-    let pb_doc = stored_document::StoredDocumentProto {
+    let mut pb_doc = stored_document::StoredDocumentProto {
         id: None,
         document: document,
         exact_part: exact_part,
-        fingerprint: fingerprint_rust,
+        fingerprint: Vec::new(),
         data: data,
+        packed_fingerprint: None,
+        fingerprint_bits: None,
+        fingerprint_length: None,
+        n_tokens,
     };
+    match fingerprint_bits {
+        32 => pb_doc.fingerprint = fingerprint_rust,
+        1 | 2 | 4 | 8 => {
+            if !fingerprint_rust.is_empty() {
+                pb_doc.packed_fingerprint =
+                    Some(pack_low_bits(&fingerprint_rust, fingerprint_bits));
+                pb_doc.fingerprint_bits = Some(fingerprint_bits);
+                pb_doc.fingerprint_length = Some(fingerprint_rust.len() as u32);
+            }
+        }
+        _ => {
+            return Err(PyValueError::new_err(format!(
+                "Unsupported number of fingerprint bits: {}. Options: 1, 2, 4, 8, 32",
+                fingerprint_bits
+            )))
+        }
+    }
+
+    Ok(PyBytes::new(py, &pb_doc.encode_to_vec()).into())
+}
+
+/// Pack the lowest `bits` bits of each value into bytes, starting at the lowest bits of a byte.
+fn pack_low_bits(values: &[u32], bits: u32) -> Vec<u8> {
+    let per_byte = (8 / bits) as usize;
+    let mask = (1u32 << bits) - 1;
+    values
+        .chunks(per_byte)
+        .map(|chunk| {
+            chunk.iter().enumerate().fold(0u8, |byte, (i, v)| {
+                byte | (((v & mask) as u8) << (i as u32 * bits))
+            })
+        })
+        .collect()
+}
+
+/// Unpack `length` values of `bits` bits each from the output of [pack_low_bits].
+fn unpack_low_bits(packed: &[u8], bits: u32, length: usize) -> Vec<u8> {
+    let per_byte = (8 / bits) as usize;
+    let mask = ((1u32 << bits) - 1) as u8;
+    (0..length)
+        .map(|i| (packed[i / per_byte] >> ((i % per_byte) as u32 * bits)) & mask)
+        .collect()
+}
 
-    PyBytes::new(py, &pb_doc.encode_to_vec()).into()
+/// Fingerprint of a decoded document, either full or with the low bits of each value only.
+enum DecodedFingerprint {
+    Full(Vec<u32>),
+    LowBits(Vec<u8>),
 }
 
-/// Parse a binary StoredDocumentProto message and return its contents as Python dictionary.s
+impl DecodedFingerprint {
+    fn from_proto(pb_doc: &mut stored_document::StoredDocumentProto) -> Result<Self, String> {
+        match pb_doc.packed_fingerprint.take() {
+            None => Ok(DecodedFingerprint::Full(std::mem::take(
+                &mut pb_doc.fingerprint,
+            ))),
+            Some(packed) => {
+                let bits = pb_doc.fingerprint_bits.unwrap_or(0);
+                let length = pb_doc.fingerprint_length.unwrap_or(0) as usize;
+                if !matches!(bits, 1 | 2 | 4 | 8) || packed.len() * (8 / bits as usize) < length {
+                    return Err("Corrupt packed fingerprint".to_string());
+                }
+                Ok(DecodedFingerprint::LowBits(unpack_low_bits(
+                    &packed, bits, length,
+                )))
+            }
+        }
+    }
+
+    fn len(&self) -> usize {
+        match self {
+            DecodedFingerprint::Full(v) => v.len(),
+            DecodedFingerprint::LowBits(v) => v.len(),
+        }
+    }
+}
+
+/// Parse a binary StoredDocumentProto message and return its contents as Python dictionary.
+///
+/// b-bit fingerprints are returned as uint8 array with the low bits of each value.
 #[pyfunction]
 pub fn protobuf_to_stored_document<'py>(py: Python<'py>, document: &[u8]) -> PyResult<&'py PyDict> {
     let buf = Cursor::new(document);
-    let pb_doc = stored_document::StoredDocumentProto::decode(buf).unwrap();
+    let mut pb_doc = stored_document::StoredDocumentProto::decode(buf).unwrap();
+    let fingerprint = DecodedFingerprint::from_proto(&mut pb_doc).map_err(PyValueError::new_err)?;
 
     let result_dict = PyDict::new(py);
     if let Some(x) = pb_doc.document {
@@ -47,13 +141,115 @@ pub fn protobuf_to_stored_document<'py>(py: Python<'py>, document: &[u8]) -> PyR
     if let Some(x) = pb_doc.exact_part {
         result_dict.set_item("exact_part", x).unwrap();
     }
-    if !pb_doc.fingerprint.is_empty() {
-        result_dict
-            .set_item("fingerprint", PyArray1::from_vec(py, pb_doc.fingerprint))
-            .unwrap();
+    match fingerprint {
+        DecodedFingerprint::Full(v) if !v.is_empty() => {
+            result_dict.set_item("fingerprint", PyArray1::from_vec(py, v))?;
+        }
+        DecodedFingerprint::LowBits(v) => {
+            result_dict.set_item("fingerprint", PyArray1::from_vec(py, v))?;
+        }
+        _ => {}
     }
     if let Some(x) = pb_doc.data {
         result_dict.set_item("data", x).unwrap();
     }
+    if let Some(x) = pb_doc.n_tokens {
+        result_dict.set_item("n_tokens", x)?;
+    }
     Ok(result_dict)
 }
+
+/// Parse a list of binary StoredDocumentProto messages and return their contents column-wise.
+///
+/// The result is a dictionary with the lists "document", "exact_part", "data" and "n_tokens" and
+/// the entry
+/// "fingerprint", which holds all fingerprints as one 2-dimensional array with one row per
+/// document, or None if the documents have no fingerprints. b-bit fingerprints are returned as
+/// uint8 array with the low bits of each value.
+#[pyfunction]
+pub fn protobuf_to_stored_documents<'py>(
+    py: Python<'py>,
+    documents: Vec<&[u8]>,
+) -> PyResult<&'py PyDict> {
+    let decoded = py
+        .allow_threads(|| {
+            documents
+                .iter()
+                .map(|doc| {
+                    let mut pb_doc = stored_document::StoredDocumentProto::decode(*doc)
+                        .map_err(|e| e.to_string())?;
+                    let fingerprint = DecodedFingerprint::from_proto(&mut pb_doc)?;
+                    Ok((pb_doc, fingerprint))
+                })
+                .collect::<Result<Vec<_>, String>>()
+        })
+        .map_err(|e| PyValueError::new_err(format!("Invalid serialized document: {}", e)))?;
+
+    let n_documents = decoded.len();
+    let n_hashes = decoded.first().map_or(0, |(_, fp)| fp.len());
+    let low_bits = matches!(decoded.first(), Some((_, DecodedFingerprint::LowBits(_))));
+    if decoded.iter().any(|(_, fp)| {
+        fp.len() != n_hashes || low_bits != matches!(fp, DecodedFingerprint::LowBits(_))
+    }) {
+        return Err(PyValueError::new_err(
+            "The documents have fingerprints of different lengths",
+        ));
+    }
+    let mut texts = Vec::with_capacity(n_documents);
+    let mut exact_parts = Vec::with_capacity(n_documents);
+    let mut data = Vec::with_capacity(n_documents);
+    let mut n_tokens = Vec::with_capacity(n_documents);
+    let mut full_fingerprints: Vec<u32> = Vec::new();
+    let mut low_bit_fingerprints: Vec<u8> = Vec::new();
+    for (doc, fingerprint) in decoded {
+        texts.push(doc.document);
+        exact_parts.push(doc.exact_part);
+        data.push(doc.data);
+        n_tokens.push(doc.n_tokens);
+        match fingerprint {
+            DecodedFingerprint::Full(v) => full_fingerprints.extend_from_slice(&v),
+            DecodedFingerprint::LowBits(v) => low_bit_fingerprints.extend_from_slice(&v),
+        }
+    }
+
+    let result_dict = PyDict::new(py);
+    result_dict.set_item("document", texts)?;
+    result_dict.set_item("exact_part", exact_parts)?;
+    result_dict.set_item("data", data)?;
+    result_dict.set_item("n_tokens", n_tokens)?;
+    if n_hashes == 0 {
+        result_dict.set_item("fingerprint", py.None())?;
+    } else if low_bits {
+        let array =
+            PyArray1::from_vec(py, low_bit_fingerprints).reshape([n_documents, n_hashes])?;
+        result_dict.set_item("fingerprint", array)?;
+    } else {
+        let array = PyArray1::from_vec(py, full_fingerprints).reshape([n_documents, n_hashes])?;
+        result_dict.set_item("fingerprint", array)?;
+    }
+    Ok(result_dict)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_pack_low_bits() {
+        let values = vec![0b1011u32, 0b0110, 0xFFFF_FFFF, 0, 5];
+        assert_eq!(pack_low_bits(&values, 8), vec![0b1011, 0b0110, 0xFF, 0, 5]);
+        assert_eq!(
+            pack_low_bits(&values, 4),
+            vec![0b0110_1011, 0b0000_1111, 0b0101]
+        );
+        assert_eq!(pack_low_bits(&values, 1), vec![0b0001_0101]);
+        for bits in [1, 2, 4, 8] {
+            let mask = (1u32 << bits) - 1;
+            let expected: Vec<u8> = values.iter().map(|v| (v & mask) as u8).collect();
+            assert_eq!(
+                unpack_low_bits(&pack_low_bits(&values, bits), bits, values.len()),
+                expected
+            );
+        }
+    }
+}
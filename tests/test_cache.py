@@ -0,0 +1,95 @@
+"""Tests for the `narrow_down._cache` module."""
+import numpy as np
+import pytest
+
+from narrow_down._cache import CacheStats, FingerprintCache, LruCache, QueryCache
+from narrow_down.storage import Fingerprint, StoredDocument
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_cache__on_drop():
+    clock = FakeClock()
+    dropped = []
+    cache = LruCache(max_size=2, ttl=5.0, clock=clock, on_drop=lambda k, v: dropped.append(k))
+    cache.put("a", 1, cache.generation)
+    cache.put("a", 2, cache.generation)
+    cache.put("b", 3, cache.generation)
+    cache.put("c", 4, cache.generation)
+    cache.invalidate_many(["c", "x"])
+    clock.now = 5.0
+    assert cache.get("b") is None
+    assert dropped == ["a", "a", "c", "b"]
+    assert cache.stats() == CacheStats(hits=0, misses=1, evictions=2, invalidations=1, size=0)
+
+
+def test_query_cache__hit_and_miss():
+    cache = QueryCache(max_size=10)
+    assert cache.get("q") is None
+    cache.put("q", [StoredDocument(id_=1)], [(0, 10)], cache.generation)
+    assert cache.get("q") == [StoredDocument(id_=1)]
+    assert cache.stats() == CacheStats(hits=1, misses=1, evictions=0, invalidations=0, size=1)
+
+
+def test_query_cache__lru_eviction():
+    cache = QueryCache(max_size=2)
+    cache.put("a", [], [(0, 1)], cache.generation)
+    cache.put("b", [], [(0, 2)], cache.generation)
+    cache.get("a")
+    cache.put("c", [], [(0, 3)], cache.generation)
+    assert cache.get("b") is None
+    assert cache.get("a") == []
+    assert cache.get("c") == []
+    assert cache.stats().evictions == 1
+
+
+def test_query_cache__ttl():
+    clock = FakeClock()
+    cache = QueryCache(max_size=10, ttl=5.0, clock=clock)
+    cache.put("q", [], [(0, 1)], cache.generation)
+    clock.now = 4.9
+    assert cache.get("q") == []
+    clock.now = 5.0
+    assert cache.get("q") is None
+    assert cache.stats() == CacheStats(hits=1, misses=1, evictions=1, invalidations=0, size=0)
+
+
+def test_query_cache__invalidate_only_affected_entries():
+    cache = QueryCache(max_size=10)
+    cache.put("a", [], [(0, 1), (1, 2)], cache.generation)
+    cache.put("b", [], [(0, 3), (1, 4)], cache.generation)
+    cache.invalidate([(0, 5), (1, 2)])
+    assert cache.get("a") is None
+    assert cache.get("b") == []
+    assert cache.stats().invalidations == 1
+
+
+def test_query_cache__put_after_invalidation_is_ignored():
+    cache = QueryCache(max_size=10)
+    generation = cache.generation
+    cache.invalidate([(0, 1)])
+    cache.put("q", [], [(0, 2)], generation)
+    assert cache.get("q") is None
+
+
+def test_query_cache__invalid_size():
+    with pytest.raises(ValueError):
+        QueryCache(max_size=0)
+
+
+def test_fingerprint_cache():
+    cache = FingerprintCache(max_size=2)
+    assert cache.get("a") is None
+    cache.put("a", Fingerprint(np.array([1, 2], dtype=np.uint32)))
+    cache.put("b", Fingerprint(np.array([3, 4], dtype=np.uint32)))
+    assert list(cache.get("a")) == [1, 2]
+    cache.put("c", Fingerprint(np.array([5, 6], dtype=np.uint32)))
+    assert cache.get("b") is None
+    assert not cache.get("c").flags.writeable
+    assert cache.stats() == CacheStats(hits=2, misses=2, evictions=1, invalidations=0, size=2)
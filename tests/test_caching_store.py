@@ -0,0 +1,75 @@
+"""Tests for the `narrow_down.caching_store` module."""
+import pytest
+
+from narrow_down.caching_store import CachingStore
+from narrow_down.similarity_store import SimilarityStore
+from narrow_down.sqlite import SQLiteStore
+from narrow_down.storage import InMemoryStore, StorageLevel
+
+
+@pytest.mark.asyncio
+async def test_caching_store__settings():
+    store = await CachingStore(InMemoryStore()).initialize()
+    await store.insert_setting(key="k", value="155")
+    assert await store.query_setting("k") == "155"
+
+
+@pytest.mark.asyncio
+async def test_caching_store__query_ids_from_bucket():
+    backend = await InMemoryStore().initialize()
+    store = await CachingStore(backend).initialize()
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=5)
+    assert list(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == [5]
+    assert list(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == [5]
+    assert store.bucket_cache_stats().hits == 1
+
+    # Writes through the wrapper invalidate the bucket
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=6)
+    assert set(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == {5, 6}
+    await store.remove_id_from_bucket(bucket_id=1, document_hash=10, document_id=5)
+    assert list(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == [6]
+
+    # Writes bypassing the wrapper are not noticed
+    await backend.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=7)
+    assert list(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == [6]
+
+
+@pytest.mark.asyncio
+async def test_caching_store__query_documents():
+    backend = await InMemoryStore().initialize()
+    store = await CachingStore(backend, max_documents=2).initialize()
+    ids = [await store.insert_document(f"doc {i}".encode()) for i in range(3)]
+
+    assert await store.query_document(ids[0]) == b"doc 0"
+    assert await store.query_documents(ids) == [b"doc 0", b"doc 1", b"doc 2"]
+    stats = store.document_cache_stats()
+    assert (stats.hits, stats.misses, stats.evictions, stats.size) == (1, 3, 1, 2)
+
+    await store.insert_document(b"new doc 2", document_id=ids[2])
+    assert await store.query_document(ids[2]) == b"new doc 2"
+    await store.remove_document(ids[2])
+    with pytest.raises(KeyError):
+        await store.query_document(ids[2])
+
+
+@pytest.mark.asyncio
+async def test_caching_store__ttl():
+    backend = await InMemoryStore().initialize()
+    store = await CachingStore(backend, ttl=0).initialize()
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=5)
+    await store.query_ids_from_bucket(bucket_id=1, document_hash=10)
+    await backend.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=6)
+    assert set(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == {5, 6}
+
+
+@pytest.mark.asyncio
+async def test_caching_store__similarity_store_with_sqlite():
+    store = CachingStore(SQLiteStore(":memory:"))
+    simstore = await SimilarityStore.create(storage=store, storage_level=StorageLevel.Fingerprint)
+    doc_id = await simstore.insert("Some example document")
+    assert [r.id_ for r in await simstore.query("Some example document")] == [doc_id]
+    assert [r.id_ for r in await simstore.query("Some example document")] == [doc_id]
+    assert store.bucket_cache_stats().hits > 0
+
+    await simstore.remove_by_id(doc_id)
+    assert await simstore.query("Some example document") == []
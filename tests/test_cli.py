@@ -0,0 +1,106 @@
+"""Tests for the `narrow_down.cli` module."""
+import json
+
+import pytest
+
+from narrow_down import cli
+
+LINES = [
+    "The quick brown fox jumps over the lazy dog",
+    "A completely different sentence about something else",
+    "The quick brown fox jumps over the lazy dog.",
+    "The quick brown fox jumps over the lazy dog",
+]
+
+
+@pytest.mark.parametrize(
+    "mode, expected",
+    [
+        ("keep", [LINES[0], LINES[1]]),
+        ("drop", [LINES[2], LINES[3]]),
+    ],
+)
+def test_dedup__text(tmp_path, mode, expected):
+    infile = tmp_path / "in.txt"
+    infile.write_text("\n".join(LINES) + "\n", encoding="utf-8")
+    outfile = tmp_path / "out.txt"
+    args = [
+        "dedup",
+        str(infile),
+        "-o",
+        str(outfile),
+        "--mode",
+        mode,
+        "--tokenize",
+        "char_ngrams(3)",
+        "--batch-size",
+        "2",
+    ]
+    assert cli.main(args) == 0
+    assert outfile.read_text(encoding="utf-8").splitlines() == expected
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_dedup__jsonl_clusters(tmp_path, workers):
+    infile = tmp_path / "in.jsonl"
+    records = [{"id": i, "content": line} for i, line in enumerate(LINES)]
+    infile.write_text("\n".join(json.dumps(r) for r in records) + "\n", encoding="utf-8")
+    outfile = tmp_path / "out.jsonl"
+    args = ["dedup", str(infile), "-o", str(outfile), "--format", "jsonl", "--field", "content"]
+    args += ["--mode", "cluster", "--validate", "--workers", str(workers)]
+    args += ["--tokenize", "char_ngrams(3)"]
+    assert cli.main(args) == 0
+
+    results = [json.loads(line) for line in outfile.read_text(encoding="utf-8").splitlines()]
+    assert [r["id"] for r in results] == [0, 1, 2, 3]
+    cluster_ids = [r["cluster_id"] for r in results]
+    assert cluster_ids[0] == cluster_ids[2] == cluster_ids[3] != cluster_ids[1]
+
+
+def test_dedup__sqlite_storage(tmp_path):
+    infile = tmp_path / "in.txt"
+    outfile = tmp_path / "out.txt"
+    storage = str(tmp_path / "index.db")
+    args = ["dedup", str(infile), "-o", str(outfile), "--storage", storage]
+
+    infile.write_text(LINES[0] + "\n", encoding="utf-8")
+    assert cli.main(args) == 0
+    assert outfile.read_text(encoding="utf-8").splitlines() == [LINES[0]]
+    # A second run deduplicates against the documents of the first run
+    infile.write_text(LINES[3] + "\n" + LINES[1] + "\n", encoding="utf-8")
+    assert cli.main(args) == 0
+    assert outfile.read_text(encoding="utf-8").splitlines() == [LINES[1]]
+
+
+@pytest.mark.parametrize(
+    "record, message",
+    [
+        ('{"content": "no text field"}', "record 2 has no string field 'text'"),
+        ('{"text": 42}', "record 2 has no string field 'text'"),
+        ("not json", "record 2 is not valid JSON"),
+    ],
+)
+def test_dedup__invalid_jsonl(tmp_path, capsys, record, message):
+    infile = tmp_path / "in.jsonl"
+    infile.write_text(json.dumps({"text": LINES[0]}) + "\n" + record + "\n", encoding="utf-8")
+    args = ["dedup", str(infile), "-o", str(tmp_path / "out.jsonl"), "--format", "jsonl"]
+    assert cli.main(args) == 1
+    assert message in capsys.readouterr().err
+
+
+def test_dedup__sqlite_storage__other_settings(tmp_path, capsys):
+    infile = tmp_path / "in.txt"
+    infile.write_text(LINES[0] + "\n", encoding="utf-8")
+    storage = str(tmp_path / "index.db")
+    args = ["dedup", str(infile), "-o", str(tmp_path / "out.txt"), "--storage", storage]
+    assert cli.main([*args, "--threshold", "0.8"]) == 0
+    # Options which match the index, or are left out, are fine
+    assert cli.main([*args, "--threshold", "0.8", "--tokenize", "word_ngrams(3)"]) == 0
+    assert cli.main(args) == 0
+
+    assert cli.main([*args, "--threshold", "0.5", "--validate"]) == 1
+    error = capsys.readouterr().err
+    assert "--threshold 0.5 (index: 0.8)" in error
+    assert "--validate" in error
+    assert cli.main([*args, "--tokenize", "char_ngrams(3)"]) == 1
+    assert "--tokenize char_ngrams(3)" in capsys.readouterr().err
@@ -0,0 +1,130 @@
+"""Tests for the `narrow_down.coalescing_store` module."""
+import asyncio
+import gc
+
+import pytest
+
+from narrow_down.coalescing_store import CoalescingStore
+from narrow_down.similarity_store import SimilarityStore
+from narrow_down.storage import InMemoryStore, StorageLevel
+
+
+class CountingStore(InMemoryStore):
+    """InMemoryStore which counts the read calls and yields to the event loop in each of them."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = {"query_document": 0, "query_documents": 0, "query_ids_from_bucket": 0}
+
+    async def query_document(self, document_id):
+        self.calls["query_document"] += 1
+        await asyncio.sleep(0)
+        return await super().query_document(document_id)
+
+    async def query_documents(self, document_ids):
+        self.calls["query_documents"] += 1
+        await asyncio.sleep(0)
+        return await super().query_documents(document_ids)
+
+    async def query_ids_from_bucket(self, bucket_id, document_hash):
+        self.calls["query_ids_from_bucket"] += 1
+        await asyncio.sleep(0)
+        return await super().query_ids_from_bucket(bucket_id, document_hash)
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__settings():
+    store = await CoalescingStore(InMemoryStore()).initialize()
+    await store.insert_setting(key="k", value="155")
+    assert await store.query_setting("k") == "155"
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__query_ids_from_bucket():
+    backend = await CountingStore().initialize()
+    store = await CoalescingStore(backend).initialize()
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=5)
+    results = await asyncio.gather(
+        *(store.query_ids_from_bucket(bucket_id=1, document_hash=10) for _ in range(10))
+    )
+    assert [list(r) for r in results] == [[5]] * 10
+    assert backend.calls["query_ids_from_bucket"] == 1
+
+    # Reads after a write don't share the previous read
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=6)
+    assert set(await store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == {5, 6}
+    assert backend.calls["query_ids_from_bucket"] == 2
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__query_documents_batched():
+    backend = await CountingStore().initialize()
+    store = await CoalescingStore(backend).initialize()
+    ids = [await store.insert_document(f"doc {i}".encode()) for i in range(5)]
+
+    results = await asyncio.gather(
+        *(store.query_document(ids[i % 5]) for i in range(20)),
+        store.query_documents(ids[:2]),
+    )
+    assert results[:20] == [f"doc {i % 5}".encode() for i in range(20)]
+    assert results[20] == [b"doc 0", b"doc 1"]
+    assert backend.calls == {"query_document": 0, "query_documents": 1, "query_ids_from_bucket": 0}
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__missing_document_only_fails_its_readers():
+    backend = await CountingStore().initialize()
+    store = await CoalescingStore(backend, batch_window=0.001).initialize()
+    doc_id = await store.insert_document(b"doc")
+
+    results = await asyncio.gather(
+        store.query_document(doc_id), store.query_document(doc_id + 1), return_exceptions=True
+    )
+    assert results[0] == b"doc"
+    assert isinstance(results[1], KeyError)
+    with pytest.raises(KeyError):
+        await store.query_documents([doc_id, doc_id + 1])
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__query_documents__several_missing():
+    store = await CoalescingStore(await CountingStore().initialize()).initialize()
+    doc_id = await store.insert_document(b"doc")
+    loop = asyncio.get_event_loop()
+    unhandled = []
+    loop.set_exception_handler(lambda _, context: unhandled.append(context))
+    try:
+        # Not pytest.raises, whose traceback would keep the futures of the other reads alive
+        await store.query_documents([doc_id + 1, doc_id, doc_id + 2, doc_id + 3])
+    except KeyError as e:
+        # The first failed read in the order of the ids is reported
+        assert str(doc_id + 1) in str(e)
+    else:
+        pytest.fail("KeyError not raised")
+    await asyncio.sleep(0)
+    gc.collect()
+    loop.set_exception_handler(None)
+    assert unhandled == []
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__max_batch_size():
+    backend = await CountingStore().initialize()
+    store = await CoalescingStore(backend, batch_window=10, max_batch_size=3).initialize()
+    ids = [await store.insert_document(f"doc {i}".encode()) for i in range(6)]
+    assert await store.query_documents(ids) == [f"doc {i}".encode() for i in range(6)]
+    assert backend.calls["query_documents"] == 2
+
+
+@pytest.mark.asyncio
+async def test_coalescing_store__parallel_similarity_queries():
+    backend = CountingStore()
+    store = CoalescingStore(backend)
+    simstore = await SimilarityStore.create(storage=store, storage_level=StorageLevel.Document)
+    await simstore.insert("Some example document")
+    await simstore.insert("Another example document")
+    backend.calls = dict.fromkeys(backend.calls, 0)
+
+    results = await asyncio.gather(*(simstore.query("Some example document") for _ in range(25)))
+    assert all([r.document for r in result] == ["Some example document"] for result in results)
+    assert backend.calls["query_ids_from_bucket"] == simstore._lsh_config.n_bands
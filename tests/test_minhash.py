@@ -1,4 +1,6 @@
 """Tests for `narrow_down.minhash`."""
+import asyncio
+
 import numpy as np
 import pytest
 
@@ -22,6 +24,133 @@ def test_minhash():
     assert (minhashes == np.array([2048153058, 2194504465], dtype=np.uint32)).all()
 
 
+def test_minhash_lsh_config__json_without_engine():
+    config = _minhash.MinhashLshConfig.from_json(
+        '{"n_hashes": 16, "n_bands": 4, "rows_per_band": 4}'
+    )
+    assert config.engine == "minhash"
+
+
+def test_one_permutation_hasher():
+    hasher = _minhash.OnePermutationHasher(64, 42)
+    shingles = [f"shingle {i}" for i in range(100)]
+    fingerprint = hasher.minhash(shingles)
+    assert fingerprint.shape == (64,)
+    assert fingerprint.dtype == np.uint32
+    assert (fingerprint == _minhash.OnePermutationHasher(64, 42).minhash(shingles)).all()
+    assert (hasher.minhash([]) == np.uint32((1 << 32) - 1)).all()
+    # Few shingles leave most bins empty, which are filled by densification
+    assert len(set(hasher.minhash(["a", "b"]).tolist())) <= 2
+
+
+def test_one_permutation_hasher__estimates_jaccard_similarity():
+    hasher = _minhash.OnePermutationHasher(512, 42)
+    shingles1 = [f"shingle {i}" for i in range(0, 300)]
+    shingles2 = [f"shingle {i}" for i in range(100, 400)]  # Jaccard similarity 0.5
+    estimate = np.mean(hasher.minhash(shingles1) == hasher.minhash(shingles2))
+    assert 0.4 < estimate < 0.6
+
+
+def test_weighted_minhasher():
+    hasher = _minhash.WeightedMinHasher(64, 42)
+    weights = {f"shingle {i}": i % 3 + 1 for i in range(100)}
+    fingerprint = hasher.minhash(weights)
+    assert fingerprint.shape == (64,)
+    assert fingerprint.dtype == np.uint32
+    assert (fingerprint == _minhash.WeightedMinHasher(64, 42).minhash(weights)).all()
+    assert (hasher.minhash({}) == np.uint32((1 << 32) - 1)).all()
+    # Other collections are counted
+    assert (hasher.minhash(["a", "b", "a"]) == hasher.minhash({"a": 2, "b": 1})).all()
+    with pytest.raises(ValueError):
+        hasher.minhash({"a": -1.0})
+
+
+def test_weighted_minhasher__estimates_weighted_jaccard_similarity():
+    hasher = _minhash.WeightedMinHasher(512, 42)
+    weights1 = {f"shingle {i}": 3 for i in range(100)}
+    weights2 = {f"shingle {i}": 1 for i in range(100)}  # Weighted Jaccard similarity 1/3
+    estimate = np.mean(hasher.minhash(weights1) == hasher.minhash(weights2))
+    assert 0.23 < estimate < 0.43
+    # Plain minhash cannot tell the documents apart
+    minhasher = _minhash.MinHasher(512, 42)
+    assert (minhasher.minhash(weights1) == minhasher.minhash(weights2)).all()
+
+
+def test_simhasher():
+    hasher = _minhash.SimHasher(42)
+    shingles = [f"shingle {i}" for i in range(100)]
+    fingerprint = hasher.minhash(shingles)
+    assert fingerprint.shape == (64,)
+    assert fingerprint.dtype == np.uint32
+    assert set(fingerprint.tolist()) == {0, 1}
+    assert (fingerprint == _minhash.SimHasher(42).minhash(shingles)).all()
+    assert (hasher.minhash([]) == 0).all()
+    # Similar documents have few differing bits
+    assert np.sum(fingerprint != hasher.minhash(shingles[:95] + ["a", "b"])) < 16
+
+
+def test_find_optimal_config__simhash():
+    config = _minhash.find_optimal_config(0.75, 0.05, 0.05, engine="simhash")
+    assert config.engine == "simhash"
+    assert config.n_hashes == 64
+    assert config.fingerprint_bits == 1
+    assert config.n_bands * config.rows_per_band <= 64
+    assert _minhash.simhash_similarity(1.0) == 1.0
+    assert _minhash.simhash_similarity(0.0) == 0.5
+
+
+def test_minhasher__minhash_with_probes():
+    hasher = _minhash.MinHasher(16, 42)
+    shingles = ["abc", "def", "g"]
+    fingerprint, probes = hasher.minhash_with_probes(shingles)
+    assert (fingerprint == hasher.minhash(shingles)).all()
+    assert (probes > fingerprint).all()
+    _, probes = hasher.minhash_with_probes(["abc"])
+    assert (probes == _minhash._MERSENNE_PRIME).all()
+    fingerprint, probes = _minhash.SimHasher().minhash_with_probes(shingles)
+    assert (fingerprint + probes == 1).all()
+
+
+@pytest.mark.parametrize("engine", ["minhash", "simhash"])
+def test_find_optimal_config__probing_needs_fewer_bands(engine):
+    without_probes = _minhash.find_optimal_config(0.5, 0.05, 0.05, engine=engine)
+    with_probes = _minhash.find_optimal_config(0.5, 0.05, 0.05, engine=engine, max_probe_rows=2)
+    assert without_probes.probe_rows == 0
+    assert with_probes.probe_rows > 0
+    assert with_probes.n_bands < without_probes.n_bands
+
+
+def test_find_optimal_config__invalid_probing():
+    with pytest.raises(ValueError, match="max_probe_rows"):
+        _minhash.find_optimal_config(0.5, 0.05, 0.05, max_probe_rows=3)
+    with pytest.raises(ValueError, match="does not support probing"):
+        _minhash.find_optimal_config(0.5, 0.05, 0.05, engine="one_permutation", max_probe_rows=1)
+
+
+@pytest.mark.parametrize("bits", [1, 2, 4, 8, 32])
+def test_estimate_similarity(bits):
+    hasher = _minhash.MinHasher(512, 42)
+    fingerprint1 = hasher.minhash([f"shingle {i}" for i in range(0, 300)])
+    fingerprint2 = hasher.minhash([f"shingle {i}" for i in range(100, 400)])
+    fingerprint3 = hasher.minhash([f"other {i}" for i in range(300)])
+    assert _minhash.estimate_similarity(fingerprint1, fingerprint1, bits) == 1.0
+    assert 0.3 < _minhash.estimate_similarity(fingerprint1, fingerprint2, bits) < 0.7
+    assert _minhash.estimate_similarity(fingerprint1, fingerprint3, bits) < 0.15
+
+
+def test_create_hasher():
+    config = _minhash.MinhashLshConfig(16, 4, 4)
+    assert isinstance(_minhash.create_hasher(config), _minhash.MinHasher)
+    config = _minhash.MinhashLshConfig(16, 4, 4, engine="one_permutation")
+    assert isinstance(_minhash.create_hasher(config), _minhash.OnePermutationHasher)
+    config = _minhash.MinhashLshConfig(16, 4, 4, engine="weighted_minhash")
+    assert isinstance(_minhash.create_hasher(config), _minhash.WeightedMinHasher)
+    config = _minhash.MinhashLshConfig(64, 8, 8, engine="simhash")
+    assert isinstance(_minhash.create_hasher(config), _minhash.SimHasher)
+    with pytest.raises(ValueError, match="Unknown fingerprint engine"):
+        _minhash.create_hasher(_minhash.MinhashLshConfig(16, 4, 4, engine="other"))
+
+
 def test_minhash_benchmark(benchmark, sample_byte_strings):
     sample_strings = [s.decode("utf-8") for s in sample_byte_strings]
 
@@ -116,6 +245,153 @@ async def test_lsh__top_n():
     assert sorted([r.document for r in result]) == ["1", "2", "3"]
 
 
+@pytest.mark.asyncio
+async def test_lsh__query_ids_and_iter_query():
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=3, n_bands=3, rows_per_band=1),
+        storage=await storage.InMemoryStore().initialize(),
+    )
+    id1 = await lsh.insert(StoredDocument(document="1", fingerprint=np.array([2, 5, 7])))
+    id2 = await lsh.insert(StoredDocument(document="2", fingerprint=np.array([2, 4, 6])))
+    id3 = await lsh.insert(StoredDocument(document="3", fingerprint=np.array([2, 4, 7])))
+
+    fingerprint = storage.Fingerprint(np.array([2, 4, 6]))
+    ids, band_hits = await lsh.query_ids(fingerprint)
+    assert ids.tolist() == [id2, id3, id1]
+    assert band_hits.tolist() == [3, 2, 1]
+    assert (await lsh.query_ids(fingerprint, n=1)).ids.tolist() == [id2]
+    docs = [d.document async for d in lsh.iter_query(fingerprint, batch_size=2)]
+    assert docs == ["2", "3", "1"]
+
+
+@pytest.mark.asyncio
+async def test_lsh__multi_probe_query():
+    doc = StoredDocument(fingerprint=storage.Fingerprint(np.array([1, 2, 3, 4], dtype=np.uint32)))
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=4, n_bands=2, rows_per_band=2, probe_rows=1),
+        storage=await storage.InMemoryStore().initialize(),
+    )
+    doc_id = await lsh.insert(doc)
+    # The query differs from the document in one row of each band
+    query = storage.Fingerprint(np.array([9, 2, 3, 9], dtype=np.uint32))
+    probes = storage.Fingerprint(np.array([1, 5, 5, 4], dtype=np.uint32))
+    assert len(await lsh.query(query)) == 0
+    assert [d.id_ for d in await lsh.query(query, probes=probes)] == [doc_id]
+    assert (await lsh.query_ids(query, probes=probes)).ids.tolist() == [doc_id]
+    keys = lsh.query_keys(query, probes=probes)
+    assert keys[:2] == lsh.bucket_keys(query)
+    assert len(keys) == 2 + 4
+
+
+def test_lsh__query_keys_with_two_probe_rows():
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=6, n_bands=2, rows_per_band=3, probe_rows=2),
+        storage=storage.InMemoryStore(),
+    )
+    fingerprint = storage.Fingerprint(np.arange(6, dtype=np.uint32))
+    probes = storage.Fingerprint(np.arange(6, dtype=np.uint32) + 10)
+    probes[0] = _minhash._MERSENNE_PRIME  # No second value for this row
+    keys = lsh.query_keys(fingerprint, probes=probes)
+    # 2 bands, 2 + 3 single row probes and 1 + 3 probes with two rows
+    assert len(keys) == 2 + 5 + 4
+    assert len(set(keys)) == len(keys)
+    assert lsh.query_keys(fingerprint) == lsh.bucket_keys(fingerprint)
+
+
+@pytest.mark.asyncio
+async def test_lsh__forest():
+    config = _minhash.find_optimal_config(0.75, 0.05, 0.05, forest_trees=2)
+    lsh = _minhash.LSH(config, storage=await storage.InMemoryStore().initialize())
+    fingerprint = storage.Fingerprint(np.arange(config.n_hashes, dtype=np.uint32))
+    assert len(lsh.bucket_keys(fingerprint)) == 2 * len(_minhash.FOREST_DEPTHS)
+    assert lsh.forest_depth(0.3) < lsh.forest_depth(0.9)
+    similar = fingerprint.copy()
+    similar[[10, 26]] = 1000  # Shares a prefix of 10 values in both trees
+    dissimilar = fingerprint.copy()
+    dissimilar[[1, 17]] = 1000  # Shares only the first value in both trees
+    similar_id = await lsh.insert(StoredDocument(fingerprint=similar))
+    dissimilar_id = await lsh.insert(StoredDocument(fingerprint=dissimilar))
+
+    top = await lsh.query_ids(fingerprint, n=1)
+    assert top.ids.tolist() == [similar_id]
+    assert top.band_hits.tolist() == [2]
+    assert (await lsh.query_ids(fingerprint, n=5)).ids.tolist() == [similar_id, dissimilar_id]
+    assert [d.id_ for d in await lsh.query(fingerprint, threshold=0.9)] == []
+    assert len(await lsh.query(fingerprint, threshold=0.1)) == 2
+
+
+def test_find_optimal_config__forest():
+    config = _minhash.find_optimal_config(0.75, 0.05, 0.05, forest_trees=8)
+    assert config.forest_depths == _minhash.FOREST_DEPTHS
+    assert config.n_bands == 8
+    assert config.n_hashes == 8 * config.rows_per_band
+    assert _minhash.MinhashLshConfig.from_json(config.to_json()) == config
+    with pytest.raises(ValueError):
+        _minhash.find_optimal_config(0.75, 0.05, 0.05, forest_trees=0)
+    with pytest.raises(ValueError):
+        _minhash.find_optimal_config(0.75, 0.05, 0.05, engine="simhash", forest_trees=8)
+
+
+@pytest.mark.asyncio
+async def test_lsh__containment():
+    config = _minhash.find_optimal_config(0.75, 0.05, 0.05, containment=True)
+    assert config.size_partitions == _minhash.CONTAINMENT_PARTITIONS
+    assert config.n_bands == 8
+    lsh = _minhash.LSH(config, storage=await storage.InMemoryStore().initialize())
+    assert [lsh.size_partition(n) for n in (0, 1, 3, 4, 1000, 10**9)] == [0, 0, 1, 2, 9, 15]
+    fingerprint = storage.Fingerprint(np.arange(config.n_hashes, dtype=np.uint32))
+    n_keys = 8 * len(_minhash.FOREST_DEPTHS)
+    assert len(lsh.bucket_keys(fingerprint, n_tokens=10)) == n_keys
+    assert len(set(lsh.bucket_keys(fingerprint))) == config.size_partitions * n_keys
+    # Partitions 0 to 2 only hold documents with less than 8 tokens
+    assert len(lsh.query_keys(fingerprint, threshold=0.8, n_tokens=10)) == 13 * 8
+
+    large_id = await lsh.insert(StoredDocument(fingerprint=fingerprint), n_tokens=100)
+    await lsh.insert(StoredDocument(fingerprint=fingerprint), n_tokens=3)
+    results = await lsh.query(fingerprint, threshold=0.8, n_tokens=10)
+    assert [d.id_ for d in results] == [large_id]
+    with pytest.raises(ValueError):
+        await lsh.insert(StoredDocument(fingerprint=fingerprint))
+    with pytest.raises(ValueError):
+        await lsh.query(fingerprint, threshold=0.8)
+
+
+@pytest.mark.asyncio
+async def test_lsh__containment_of_large_documents():
+    config = _minhash.find_optimal_config(0.75, 0.05, 0.05, containment=True)
+    lsh = _minhash.LSH(config, storage=await storage.InMemoryStore().initialize())
+    fingerprint = storage.Fingerprint(np.arange(config.n_hashes, dtype=np.uint32))
+    # Far more tokens than the largest bounded partition, containing a large query
+    large_id = await lsh.insert(StoredDocument(fingerprint=fingerprint), n_tokens=1_000_000)
+    query = fingerprint + 1000
+    query[:: config.rows_per_band] = fingerprint[:: config.rows_per_band]  # 1st value per tree
+    results = await lsh.query(query, threshold=0.9, n_tokens=100_000)
+    assert [d.id_ for d in results] == [large_id]
+
+
+@pytest.mark.asyncio
+async def test_lsh__containment__remove_by_id():
+    class CountingStore(storage.InMemoryStore):
+        """Store which counts the bucket removals."""
+
+        removals = 0
+
+        async def remove_id_from_bucket(self, bucket_id, document_hash, document_id):
+            self.removals += 1
+            await super().remove_id_from_bucket(bucket_id, document_hash, document_id)
+
+    config = _minhash.find_optimal_config(0.75, 0.05, 0.05, containment=True)
+    backend = await CountingStore().initialize()
+    lsh = _minhash.LSH(config, storage=backend)
+    fingerprint = storage.Fingerprint(np.arange(config.n_hashes, dtype=np.uint32))
+    doc_id = await lsh.insert(StoredDocument(fingerprint=fingerprint), n_tokens=100)
+    removed = await lsh.remove_by_id(doc_id)
+    assert removed is not None and removed.n_tokens == 100
+    # Only the buckets of the size partition of the document
+    assert backend.removals == len(lsh.bucket_keys(fingerprint, n_tokens=100))
+    assert not await lsh.query(fingerprint, threshold=0.8, n_tokens=100)
+
+
 @pytest.mark.asyncio
 async def test_lsh__insert_invalid_document():
     """Test error handling of insert()."""
@@ -152,6 +428,66 @@ async def test_lsh__remove_by_id__missing_fingerprint():
         await lsh.remove_by_id(index, check_if_exists=True)
 
 
+async def _lsh_with_hot_bucket(bucket_cap):
+    """Create an LSH with 10 documents in the first bucket of fingerprint [1, 2]."""
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=2, n_bands=2, rows_per_band=1),
+        storage=await storage.InMemoryStore().initialize(),
+        bucket_cap=bucket_cap,
+    )
+    for i in range(10):
+        await lsh.insert(
+            StoredDocument(document=str(i), fingerprint=storage.Fingerprint(np.array([1, 10 + i])))
+        )
+    return lsh
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "policy, n_results",
+    [
+        (_minhash.OversizedBucketPolicy.Skip, 0),
+        (_minhash.OversizedBucketPolicy.Sample, 3),
+        (_minhash.OversizedBucketPolicy.Truncate, 3),
+    ],
+)
+async def test_lsh__bucket_cap(policy, n_results):
+    lsh = await _lsh_with_hot_bucket(_minhash.BucketCap(max_size=3, policy=policy))
+    result = await lsh.query(storage.Fingerprint(np.array([1, 99])))
+    assert len(result) == n_results
+    # Small buckets are not affected
+    result = await lsh.query(storage.Fingerprint(np.array([1, 15])))
+    assert "5" in [r.document for r in result]
+    assert lsh.bucket_cap_stats() == _minhash.BucketCapStats(
+        capped=2, stop_list_hits=0, stop_list_size=0
+    )
+
+
+@pytest.mark.asyncio
+async def test_lsh__bucket_cap__stop_list():
+    lsh = await _lsh_with_hot_bucket(
+        _minhash.BucketCap(max_size=20, stop_list_threshold=10, stop_list_max_size=1)
+    )
+    result = await lsh.query(storage.Fingerprint(np.array([1, 99])))
+    assert len(result) == 10
+    assert len(await lsh.query(storage.Fingerprint(np.array([1, 99])))) == 0
+    assert lsh.bucket_cap_stats() == _minhash.BucketCapStats(
+        capped=0, stop_list_hits=1, stop_list_size=1
+    )
+
+    # Removing a document takes the bucket off the stop-list
+    await lsh.remove_by_id(list(result)[0].id_, check_if_exists=True)
+    assert len(await lsh.query(storage.Fingerprint(np.array([1, 99])))) == 9
+    assert lsh.bucket_cap_stats().stop_list_size == 0
+
+
+def test_bucket_cap__invalid():
+    with pytest.raises(ValueError):
+        _minhash.BucketCap(max_size=0)
+    with pytest.raises(ValueError):
+        _minhash.BucketCap(max_size=1, stop_list_threshold=0)
+
+
 @pytest.mark.parametrize(
     "j, fn, fp, expected",
     [
@@ -197,3 +533,128 @@ def test_find_optimal_config(j, fn, fp, expected) -> None:  # pylint: disable=mi
         _rust.false_positive_probability(j, b=cfg.n_bands, r=cfg.rows_per_band),
     )
     assert cfg == expected
+
+
+@pytest.mark.asyncio
+async def test_lsh__max_concurrency():
+    class CountingStore(storage.InMemoryStore):
+        """Store which records the maximum number of concurrent bucket calls."""
+
+        def __init__(self):
+            super().__init__()
+            self.running = 0
+            self.max_running = 0
+
+        async def add_document_to_bucket(self, bucket_id, document_hash, document_id):
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            await asyncio.sleep(0)
+            await super().add_document_to_bucket(bucket_id, document_hash, document_id)
+            self.running -= 1
+
+    backend = await CountingStore().initialize()
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=8, n_bands=8, rows_per_band=1),
+        storage=backend,
+        max_concurrency=3,
+    )
+    fingerprints = [storage.Fingerprint(np.arange(i, i + 8)) for i in range(10)]
+    await asyncio.gather(*(lsh.insert(StoredDocument(fingerprint=f)) for f in fingerprints))
+    assert backend.max_running == 3
+    assert len(await lsh.query(fingerprints[0])) == 1
+
+    with pytest.raises(ValueError):
+        _minhash.LSH(_minhash.MinhashLshConfig(1, 1, 1), backend, max_concurrency=0)
+
+
+@pytest.mark.asyncio
+async def test_lsh__max_concurrency__pending_tasks():
+    class CountingStore(storage.InMemoryStore):
+        """Store which records the maximum number of tasks while a bucket call runs."""
+
+        def __init__(self):
+            super().__init__()
+            self.max_tasks = 0
+
+        async def query_ids_from_bucket(self, bucket_id, document_hash):
+            self.max_tasks = max(self.max_tasks, len(asyncio.all_tasks()))
+            await asyncio.sleep(0)
+            return await super().query_ids_from_bucket(bucket_id, document_hash)
+
+    backend = await CountingStore().initialize()
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=32, n_bands=32, rows_per_band=1),
+        storage=backend,
+        max_concurrency=3,
+    )
+    fingerprints = [storage.Fingerprint(np.arange(i, i + 32)) for i in range(20)]
+    await asyncio.gather(*(lsh.query_ids(f) for f in fingerprints))
+    # The test itself, one task per gathered query and at most 3 storage calls, instead of one
+    # pending task per band and query
+    assert backend.max_tasks <= 1 + len(fingerprints) + 3
+
+
+@pytest.mark.asyncio
+async def test_lsh__insert_if_not_similar():
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=4, n_bands=2, rows_per_band=2, probe_rows=1),
+        storage=await storage.InMemoryStore().initialize(),
+    )
+    fingerprint = storage.Fingerprint(np.array([1, 2, 3, 4], dtype=np.uint32))
+    first = await lsh.insert_if_not_similar(StoredDocument(fingerprint=fingerprint))
+    assert first.inserted
+    second = await lsh.insert_if_not_similar(StoredDocument(fingerprint=fingerprint.copy()))
+    assert second == _minhash.InsertResult(first.document_id, False)
+    # Found only in a probed bucket
+    query = storage.Fingerprint(np.array([9, 2, 3, 9], dtype=np.uint32))
+    probes = storage.Fingerprint(np.array([1, 5, 5, 4], dtype=np.uint32))
+    probed = await lsh.insert_if_not_similar(StoredDocument(fingerprint=query), probes=probes)
+    assert probed == _minhash.InsertResult(first.document_id, False)
+    # A candidate which fails the validation doesn't prevent the insert
+    rejected = await lsh.insert_if_not_similar(
+        StoredDocument(fingerprint=fingerprint.copy()), is_similar=lambda doc: False
+    )
+    assert rejected.inserted
+    assert len(await lsh.query(fingerprint)) == 2
+    with pytest.raises(ValueError):
+        await lsh.insert_if_not_similar(StoredDocument())
+
+
+@pytest.mark.asyncio
+async def test_lsh__insert_if_not_similar__concurrent():
+    class SlowStore(storage.InMemoryStore):
+        """Store which gives other tasks the chance to run between lookup and insert."""
+
+        async def query_ids_from_bucket(self, bucket_id, document_hash):
+            await asyncio.sleep(0.001)
+            return await super().query_ids_from_bucket(bucket_id, document_hash)
+
+    lsh = _minhash.LSH(
+        _minhash.MinhashLshConfig(n_hashes=8, n_bands=4, rows_per_band=2),
+        storage=await SlowStore().initialize(),
+    )
+    fingerprint = storage.Fingerprint(np.arange(8, dtype=np.uint32))
+    similar = fingerprint.copy()
+    similar[7] = 100  # Shares 3 of 4 bands
+    unrelated = fingerprint + 50
+    docs = [fingerprint, similar, fingerprint.copy(), unrelated]
+    results = await asyncio.gather(
+        *(lsh.insert_if_not_similar(StoredDocument(fingerprint=f)) for f in docs)
+    )
+    assert [r.inserted for r in results] == [True, False, False, True]
+    assert {r.document_id for r in results[:3]} == {results[0].document_id}
+    assert lsh._key_locks._locks == {}
+
+
+@pytest.mark.parametrize("size_partitions", [0, _minhash.CONTAINMENT_PARTITIONS])
+def test_lsh__lookup_keys_of_forest(size_partitions):
+    config = _minhash.find_optimal_config(
+        0.75, 0.05, 0.05, forest_trees=4, containment=bool(size_partitions)
+    )
+    lsh = _minhash.LSH(config, storage=storage.InMemoryStore())
+    fingerprint = storage.Fingerprint(np.arange(config.n_hashes, dtype=np.uint32))
+    keys = lsh.bucket_keys(fingerprint, n_tokens=20)
+    for threshold in (0.3, 0.75, 0.95):
+        assert lsh._lookup_keys(fingerprint, None, None, threshold, 20, keys) == lsh.query_keys(
+            fingerprint, threshold=threshold, n_tokens=20
+        )
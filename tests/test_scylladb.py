@@ -483,6 +483,30 @@ async def test_scylladb_store__add_documents_to_bucket_and_query(session_mock):
     assert sorted(await storage.query_ids_from_bucket(bucket_id=1, document_hash=20)) == [20, 21]
 
 
+@pytest.mark.asyncio
+async def test_scylladb_store__iter_buckets(monkeypatch, session_mock):
+    monkeypatch.setattr(narrow_down.scylladb, "SCAN_SEGMENTS", 1)
+    session_mock.add_mock_response(
+        "INSERT INTO <keyspace>.<table_prefix>buckets(bucket,hash,doc_id) VALUES (1,20,20);", []
+    )
+    session_mock.add_mock_response(
+        "INSERT INTO <keyspace>.<table_prefix>buckets(bucket,hash,doc_id) VALUES (1,20,21);", []
+    )
+    session_mock.add_mock_response(
+        "SELECT bucket, hash, doc_id FROM <keyspace>.<table_prefix>buckets "
+        "WHERE token(bucket, hash) >= -9223372036854775808 "
+        "AND token(bucket, hash) <= 9223372036854775807;",
+        [row(bucket=1, hash=20, doc_id=20), row(bucket=1, hash=20, doc_id=21)],
+    )
+    storage = await narrow_down.scylladb.ScyllaDBStore(
+        session_mock, session_mock.test_keyspace, session_mock.table_prefix
+    ).initialize()
+    await storage.add_document_to_bucket(bucket_id=1, document_hash=20, document_id=20)
+    await storage.add_document_to_bucket(bucket_id=1, document_hash=20, document_id=21)
+    assert [b async for b in storage.iter_buckets()] == [(1, 20, [20, 21])]
+    assert [b async for b in storage.iter_buckets(min_size=3)] == []
+
+
 @pytest.mark.asyncio
 async def test_scylladb_store__remove_document__given_id(session_mock):
     session_mock.add_mock_response(
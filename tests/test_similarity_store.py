@@ -1,9 +1,14 @@
 """Tests for `narrow_down.similarity_store`."""
 # pylint: disable=unused-argument
+import asyncio
+import concurrent.futures
+
+import numpy as np
 import pytest
 
 import narrow_down.storage
-from narrow_down.similarity_store import SimilarityStore
+from narrow_down import _minhash, similarity_store
+from narrow_down.similarity_store import BucketCap, OversizedBucketPolicy, SimilarityStore
 from narrow_down.sqlite import SQLiteStore
 from narrow_down.storage import StorageLevel, StoredDocument
 
@@ -114,6 +119,23 @@ async def test_similarity_store__query_empty_result_with_validation(monkeypatch)
     assert results == [StoredDocument(id_=1, document="")]
 
 
+@pytest.mark.asyncio
+async def test_similarity_store__query_top_n_candidate_without_document(monkeypatch):
+    async def fake_query_top_n(n, *args, **kwargs):
+        return [
+            StoredDocument(id_=1, document=None),
+            StoredDocument(id_=2, document="ABC"),
+        ][:n]
+
+    simstore = await SimilarityStore.create(
+        storage_level=StorageLevel.Document, tokenize="char_ngrams(1)"
+    )
+    monkeypatch.setattr(simstore._lsh, "query_top_n", fake_query_top_n)
+
+    results = await simstore.query_top_n(n=2, document="ABC", validate=True)
+    assert results == [StoredDocument(id_=2, document="ABC")]
+
+
 @pytest.mark.asyncio
 @pytest.mark.parametrize(
     "validate",
@@ -340,3 +362,583 @@ async def test_similarity_store__remove_by_id__key_error():
     results = await simstore.query(sample_doc)
 
     assert len(results) == 1
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__query_from_shared_memory_store(tmp_path):
+    shared_file = str(tmp_path / "store.shm")
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(storage=storage, storage_level=StorageLevel.Document)
+    doc_id = await simstore.insert("Some example document")
+    storage.to_shared_file(shared_file)
+
+    shared_simstore = await SimilarityStore.load_from_storage(
+        narrow_down.storage.SharedMemoryStore(shared_file)
+    )
+    results = await shared_simstore.query("Some example document")
+
+    assert [(r.id_, r.document) for r in results] == [(doc_id, "Some example document")]
+    with pytest.raises(narrow_down.storage.ReadOnlyStorage):
+        await shared_simstore.insert("Another document")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compression", ["lz4", "zstd", "zstd(19)"])
+@pytest.mark.parametrize("with_dictionary", [False, True])
+async def test_similarity_store__insert_reload_and_query_compressed(compression, with_dictionary):
+    dictionary = (
+        narrow_down.storage.train_compression_dictionary(
+            [f"Some example document number {i}" for i in range(100)], max_size=1024
+        )
+        if with_dictionary
+        else None
+    )
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Full,
+        compression=compression,
+        compression_dictionary=dictionary,
+    )
+    doc_id = await simstore.insert("Some example document", data="payload")
+    assert await storage.query_setting("compression") == compression
+
+    reloaded = await SimilarityStore.load_from_storage(
+        narrow_down.storage.InMemoryStore.deserialize(storage.serialize())
+    )
+    results = await reloaded.query("Some example document")
+
+    assert [(r.id_, r.document, r.data) for r in results] == [
+        (doc_id, "Some example document", "payload")
+    ]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__compression_dictionary_without_compression():
+    with pytest.raises(ValueError, match="requires a compression"):
+        await SimilarityStore.create(compression_dictionary=b"dictionary")
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__query_cache():
+    simstore = await SimilarityStore.create(
+        storage_level=StorageLevel.Fingerprint, query_cache_size=10
+    )
+    doc_id = await simstore.insert("Some example document")
+
+    assert [r.id_ for r in await simstore.query("Some example document")] == [doc_id]
+    assert [r.id_ for r in await simstore.query("Some example document")] == [doc_id]
+    assert [r.id_ for r in await simstore.query_top_n(1, "Some example document")] == [doc_id]
+    stats = simstore.query_cache_stats()
+    assert (stats.hits, stats.misses, stats.size) == (1, 2, 2)
+
+    await simstore.insert("Some completely unrelated text")
+    assert simstore.query_cache_stats().invalidations == 0
+
+    doc_id2 = await simstore.insert("Some example document")
+    assert {r.id_ for r in await simstore.query("Some example document")} == {doc_id, doc_id2}
+    assert simstore.query_cache_stats().invalidations == 2
+
+    await simstore.remove_by_id(doc_id)
+    assert [r.id_ for r in await simstore.query("Some example document")] == [doc_id2]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__query_cache_disabled():
+    simstore = await SimilarityStore.create()
+    assert simstore.query_cache_stats() is None
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__fingerprint_cache():
+    simstore = await SimilarityStore.create(
+        storage_level=StorageLevel.Document, fingerprint_cache_size=10
+    )
+    assert await simstore.query("Some example document") == []
+    doc_id = await simstore.insert("Some example document")
+    results = await simstore.query("Some example document")
+
+    assert [r.id_ for r in results] == [doc_id]
+    stats = simstore.fingerprint_cache_stats()
+    assert (stats.hits, stats.misses, stats.size) == (2, 1, 1)
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__bucket_cap():
+    simstore = await SimilarityStore.create(
+        storage_level=StorageLevel.Document,
+        bucket_cap=BucketCap(max_size=2, policy=OversizedBucketPolicy.Skip),
+    )
+    assert simstore.bucket_cap_stats().capped == 0
+    for _ in range(3):
+        await simstore.insert("Accept all cookies to continue")
+    assert await simstore.query("Accept all cookies to continue") == []
+    assert simstore.bucket_cap_stats().capped > 0
+
+    reloaded = await SimilarityStore.load_from_storage(simstore._storage)
+    assert len(await reloaded.query("Accept all cookies to continue")) == 3
+    assert reloaded.bucket_cap_stats() is None
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__max_concurrency():
+    simstore = await SimilarityStore.create(storage_level=StorageLevel.Document, max_concurrency=2)
+    docs = [f"Document number {i} with some text" for i in range(20)]
+    ids = await asyncio.gather(*(simstore.insert(doc) for doc in docs))
+    results = await asyncio.gather(*(simstore.query(doc) for doc in docs))
+    assert [[r.id_ for r in result] for result in results] == [[i] for i in ids]
+
+    with pytest.raises(ValueError):
+        await SimilarityStore.create(max_concurrency=0)
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__query_ids_and_iter_query():
+    simstore = await SimilarityStore.create(storage_level=StorageLevel.Document)
+    id1 = await simstore.insert("Some example document about cats and dogs")
+    await simstore.insert("Completely unrelated text on another topic")
+
+    ids, band_hits = await simstore.query_ids("Some example document about cats and dogs")
+    assert ids.tolist() == [id1]
+    assert band_hits.tolist() == [simstore._lsh_config.n_bands]
+    results = [r async for r in simstore.iter_query("Some example document about cats and dogs")]
+    assert [r.id_ for r in results] == [id1]
+    assert [r async for r in simstore.iter_query("Nothing similar in here at all")] == []
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__iter_query_fetches_lazily():
+    storage = narrow_down.storage.InMemoryStore()
+    fetched = []
+    query_documents = storage.query_documents
+
+    async def recording_query_documents(document_ids):
+        fetched.append(list(document_ids))
+        return await query_documents(document_ids)
+
+    storage.query_documents = recording_query_documents
+    simstore = await SimilarityStore.create(storage=storage, storage_level=StorageLevel.Document)
+    for _ in range(5):
+        await simstore.insert("The same document again and again")
+
+    async for _ in simstore.iter_query("The same document again and again", batch_size=2):
+        break
+    assert [len(ids) for ids in fetched] == [2]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_level", [StorageLevel.Minimal, StorageLevel.Document])
+async def test_similarity_store__exists_similar(storage_level):
+    simstore = await SimilarityStore.create(storage_level=storage_level)
+    assert not await simstore.exists_similar("Some example document about cats and dogs")
+    await simstore.insert("Some example document about cats and dogs", exact_part="a")
+    assert await simstore.exists_similar(
+        "Some example document about cats and dogs", exact_part="a"
+    )
+    assert not await simstore.exists_similar(
+        "Some example document about cats and dogs", exact_part="b"
+    )
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__query_top_n_ids():
+    simstore = await SimilarityStore.create(storage_level=StorageLevel.Minimal)
+    id1 = await simstore.insert("Some example document about cats and dogs")
+    id2 = await simstore.insert("Some example document about cats and mice")
+    await simstore.insert("Completely unrelated text on another topic")
+
+    result = await simstore.query_top_n_ids(2, "Some example document about cats and dogs")
+    assert result.ids.tolist()[0] == id1
+    assert set(result.ids.tolist()) <= {id1, id2}
+    assert list(result.band_hits) == sorted(result.band_hits, reverse=True)
+    assert len((await simstore.query_top_n_ids(1, "Some example document")).ids) <= 1
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__one_permutation_engine():
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(
+        storage=storage, storage_level=StorageLevel.Document, fingerprint_engine="one_permutation"
+    )
+    doc_id = await simstore.insert("Some example document about cats and dogs")
+    await simstore.insert("Completely unrelated text on another topic")
+    results = await simstore.query("Some example document about cats and dogs")
+    assert [r.id_ for r in results] == [doc_id]
+
+    reloaded = await SimilarityStore.load_from_storage(storage)
+    assert reloaded._lsh_config.engine == "one_permutation"
+    results = await reloaded.query("Some example document about cats and dogs")
+    assert [r.id_ for r in results] == [doc_id]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__weighted_minhash_engine():
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Document,
+        tokenize="word_ngrams(1)",
+        similarity_threshold=0.7,
+        fingerprint_engine="weighted_minhash",
+    )
+    repeated = "cats and dogs " * 10 + "and birds"
+    doc_id = await simstore.insert(repeated)
+    # Same set of words, but very different frequencies
+    assert await simstore.query("cats and dogs and birds") == []
+    results = await simstore.query("cats and dogs " * 9 + "and birds")
+    assert [r.id_ for r in results] == [doc_id]
+
+    reloaded = await SimilarityStore.load_from_storage(storage)
+    assert reloaded._lsh_config.engine == "weighted_minhash"
+    results = await reloaded.query("cats and dogs " * 9 + "and birds")
+    assert [r.id_ for r in results] == [doc_id]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__simhash_engine():
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Fingerprint,
+        tokenize="char_ngrams(3)",
+        fingerprint_engine="simhash",
+    )
+    doc_id = await simstore.insert("Stainless steel kitchen knife, 20 cm")
+    await simstore.insert("Wireless optical mouse with USB receiver")
+    results = await simstore.query("Stainless steel kitchen knife, 20 cm")
+    assert [r.id_ for r in results] == [doc_id]
+    assert len(results[0].fingerprint) == 64
+
+    reloaded = await SimilarityStore.load_from_storage(storage)
+    assert reloaded._lsh_config.engine == "simhash"
+    assert [r.id_ for r in await reloaded.query("Stainless steel kitchen knife, 20 cm")] == [doc_id]
+    # The fingerprint bits are stored without loss, so documents can be removed
+    await reloaded.remove_by_id(doc_id)
+    assert await reloaded.query("Stainless steel kitchen knife, 20 cm") == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("engine", ["minhash", "simhash"])
+async def test_similarity_store__multi_probe(engine):
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Document,
+        similarity_threshold=0.5,
+        fingerprint_engine=engine,
+        max_probe_rows=2,
+        query_cache_size=10,
+    )
+    assert simstore._lsh_config.probe_rows > 0
+    doc_id = await simstore.insert("Some example document about cats and dogs")
+    await simstore.insert("Completely unrelated text on another topic")
+    for store in (simstore, await SimilarityStore.load_from_storage(storage)):
+        results = await store.query("Some example document about cats and dogs")
+        assert [r.id_ for r in results] == [doc_id]
+        results = await store.query_top_n(1, "Some example document about cats and dogs")
+        assert [r.id_ for r in results] == [doc_id]
+
+
+def _variant(n_shared: int) -> str:
+    """Document sharing n_shared of its 20 words with _variant(20)."""
+    return " ".join(
+        [f"word{i}" for i in range(n_shared)] + [f"other{i}" for i in range(20 - n_shared)]
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_class", [narrow_down.storage.InMemoryStore, SQLiteStore])
+async def test_similarity_store__lsh_forest(storage_class, tmp_path):
+    storage = (
+        SQLiteStore(str(tmp_path / "forest.db"))
+        if storage_class is SQLiteStore
+        else narrow_down.storage.InMemoryStore()
+    )
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Document,
+        tokenize="word_ngrams(1)",
+        similarity_threshold=0.7,
+        lsh_forest_trees=8,
+    )
+    ids = {n: await simstore.insert(_variant(n)) for n in (18, 14, 8)}  # Jaccard 0.82, 0.54, 0.25
+    query = " ".join(f"word{i}" for i in range(20))
+
+    assert [r.id_ for r in await simstore.query(query)] == [ids[18]]
+    assert [r.id_ for r in await simstore.query(query, threshold=0.5)] == [ids[18], ids[14]]
+    assert len(await simstore.query(query, threshold=0.2)) == 3
+    assert await simstore.query(query, threshold=0.9) == []
+    results = await simstore.query_top_n(2, query, validate=False)
+    assert [r.id_ for r in results] == [ids[18], ids[14]]
+    assert (await simstore.query_top_n_ids(1, query)).ids.tolist() == [ids[18]]
+
+    reloaded = await SimilarityStore.load_from_storage(storage)
+    assert reloaded._lsh_config.forest_depths == simstore._lsh_config.forest_depths
+    assert [r.id_ for r in await reloaded.query(query, threshold=0.5)] == [ids[18], ids[14]]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__query_threshold_without_forest():
+    simstore = await SimilarityStore.create(similarity_threshold=0.7)
+    await simstore.query("Some example document", threshold=0.7)
+    with pytest.raises(ValueError, match="LSH forest"):
+        await simstore.query("Some example document", threshold=0.5)
+    forest = await SimilarityStore.create(lsh_forest_trees=4)
+    with pytest.raises(ValueError, match="between 0 and 1"):
+        await forest.query("Some example document", threshold=1.5)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_class", [narrow_down.storage.InMemoryStore, SQLiteStore])
+async def test_similarity_store__containment(storage_class, tmp_path):
+    storage = (
+        SQLiteStore(str(tmp_path / "containment.db"))
+        if storage_class is SQLiteStore
+        else narrow_down.storage.InMemoryStore()
+    )
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Document,
+        tokenize="word_ngrams(1)",
+        similarity_threshold=0.8,
+        search_mode="containment",
+        query_cache_size=10,
+    )
+    snippet = " ".join(f"word{i}" for i in range(10))
+    # Containment of the snippet 1.0, 0.7 and 0.0, but Jaccard similarity at most 0.5
+    ids = {
+        n: await simstore.insert(
+            " ".join([f"word{i}" for i in range(n)] + [f"other{i}" for i in range(20 - n)])
+        )
+        for n in (10, 7, 0)
+    }
+
+    assert [r.id_ for r in await simstore.query(snippet)] == [ids[10]]
+    assert [r.id_ for r in await simstore.query(snippet, threshold=0.6)] == [ids[10], ids[7]]
+    assert await simstore.exists_similar(snippet)
+    results = await simstore.query_top_n(5, snippet, threshold=0.6)
+    assert [r.id_ for r in results] == [ids[10], ids[7]]
+
+    reloaded = await SimilarityStore.load_from_storage(storage)
+    assert reloaded._lsh_config.size_partitions == _minhash.CONTAINMENT_PARTITIONS
+    assert [r.id_ for r in await reloaded.query(snippet, threshold=0.6)] == [ids[10], ids[7]]
+
+
+async def _duplicates_store(**kwargs):
+    simstore = await SimilarityStore.create(
+        tokenize="word_ngrams(1)", similarity_threshold=0.7, **kwargs
+    )
+    ids = []
+    for topic in ("cats", "dogs", "birds"):
+        base = [f"{topic}{i}" for i in range(20)]
+        for variant in range(3 if topic == "cats" else 2 if topic == "dogs" else 1):
+            ids.append(await simstore.insert(" ".join(base[variant:])))
+    return simstore, ids
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "executor_class",
+    [None, concurrent.futures.ThreadPoolExecutor, concurrent.futures.ProcessPoolExecutor],
+)
+async def test_similarity_store__find_duplicate_clusters(executor_class):
+    simstore, ids = await _duplicates_store(storage_level=StorageLevel.Document)
+    if executor_class is None:
+        clusters = [c async for c in simstore.find_duplicate_clusters(batch_size=1)]
+    else:
+        with executor_class(max_workers=2) as executor:
+            clusters = [
+                c async for c in simstore.find_duplicate_clusters(executor=executor, batch_size=1)
+            ]
+    assert clusters == [ids[:3], ids[3:5]]
+    pairs = sorted({p async for p in simstore.iter_duplicate_pairs()})
+    assert pairs == [(ids[0], ids[1]), (ids[0], ids[2]), (ids[1], ids[2]), (ids[3], ids[4])]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__find_duplicate_clusters__validation():
+    simstore, ids = await _duplicates_store(storage_level=StorageLevel.Document, lsh_forest_trees=8)
+    # Documents 0 and 2 have a Jaccard similarity of 0.9, but are connected via document 1
+    pairs = [p async for p in simstore.iter_duplicate_pairs(threshold=0.92)]
+    assert (ids[0], ids[2]) not in pairs
+    clusters = [c async for c in simstore.find_duplicate_clusters(threshold=0.92)]
+    assert clusters == [ids[:3], ids[3:5]]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_class", [narrow_down.storage.InMemoryStore, SQLiteStore])
+async def test_similarity_store__find_duplicate_clusters__without_documents(
+    storage_class, tmp_path
+):
+    storage = (
+        SQLiteStore(str(tmp_path / "duplicates.db"))
+        if storage_class is SQLiteStore
+        else narrow_down.storage.InMemoryStore()
+    )
+    simstore, ids = await _duplicates_store(storage=storage, lsh_forest_trees=8)
+    clusters = [c async for c in simstore.find_duplicate_clusters()]
+    assert clusters == [ids[:3], ids[3:5]]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__find_duplicate_clusters__containment():
+    simstore = await SimilarityStore.create(search_mode="containment")
+    with pytest.raises(ValueError, match="containment"):
+        async for _ in simstore.find_duplicate_clusters():
+            pass
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_level", [StorageLevel.Minimal, StorageLevel.Document])
+@pytest.mark.parametrize(
+    "executor_class",
+    [None, concurrent.futures.ThreadPoolExecutor, concurrent.futures.ProcessPoolExecutor],
+)
+async def test_similarity_store__dedup(storage_level, executor_class):
+    simstore = await SimilarityStore.create(
+        storage_level=storage_level, tokenize="word_ngrams(1)", similarity_threshold=0.7
+    )
+    existing_id = await simstore.insert(_variant(20))
+    texts = [_variant(19), "Some example document about cats and dogs", _variant(20)]
+    texts.append("Some example document about cats and dogs too")
+
+    if executor_class is None:
+        results = [r async for r in simstore.dedup(texts, batch_size=2)]
+    else:
+        with executor_class(max_workers=2) as executor:
+            results = [r async for r in simstore.dedup(texts, executor=executor, batch_size=2)]
+
+    assert [r.text for r in results] == texts
+    assert [r.is_duplicate for r in results] == [True, False, True, True]
+    assert results[0].cluster_id == results[2].cluster_id == existing_id
+    assert results[3].cluster_id == results[1].cluster_id != existing_id
+    assert len(await simstore.query("Some example document about cats and dogs")) == 1
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__dedup__async_iterable():
+    simstore = await SimilarityStore.create(storage_level=StorageLevel.Document)
+
+    async def texts():
+        for text in ["a b c d e f", "x y z", "a b c d e f"]:
+            yield text
+
+    results = [r async for r in simstore.dedup(texts(), batch_size=1)]
+    assert [r.is_duplicate for r in results] == [False, False, True]
+    assert results[2].cluster_id == results[0].cluster_id
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("storage_level", [StorageLevel.Minimal, StorageLevel.Document])
+async def test_similarity_store__insert_if_not_similar(storage_level):
+    simstore = await SimilarityStore.create(
+        storage_level=storage_level,
+        tokenize="word_ngrams(1)",
+        similarity_threshold=0.7,
+        query_cache_size=10,
+    )
+    first = await simstore.insert_if_not_similar(_variant(20), data="first")
+    assert first.inserted
+    assert [r.id_ for r in await simstore.query(_variant(19))] == [first.document_id]
+
+    assert await simstore.insert_if_not_similar(_variant(19)) == (first.document_id, False)
+    other = await simstore.insert_if_not_similar(_variant(20), exact_part="other")
+    assert other.inserted
+    assert not (await simstore.insert_if_not_similar(_variant(19), exact_part="other")).inserted
+    assert await simstore.query("Some example document") == []
+    unrelated = await simstore.insert_if_not_similar("Some example document", document_id=42)
+    assert unrelated == (42, True)
+    # The cached query result is invalidated by the insert
+    assert [r.id_ for r in await simstore.query("Some example document")] == [42]
+    results = await asyncio.gather(
+        *(simstore.insert_if_not_similar(f"Another example text {i % 2}") for i in range(6))
+    )
+    assert sum(r.inserted for r in results) == 2
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__insert_if_not_similar__containment():
+    simstore = await SimilarityStore.create(
+        storage_level=StorageLevel.Document,
+        tokenize="word_ngrams(1)",
+        similarity_threshold=0.6,
+        search_mode="containment",
+    )
+    large_id = (await simstore.insert_if_not_similar(_variant(20) + " " + _variant(0))).document_id
+    # Contained in the large document, but the large one isn't contained in it
+    assert await simstore.insert_if_not_similar(_variant(20)) == (large_id, False)
+    assert (await simstore.insert_if_not_similar(_variant(0) + " more words")).inserted is False
+    assert (await simstore.insert_if_not_similar("Some example document")).inserted
+
+
+def test_disjoint_sets():
+    sets = similarity_store._DisjointSets()
+    for pair in [(5, 6), (1, 2), (3, 4), (2, 3), (7, 7)]:
+        sets.union(*pair)
+    assert sets.find(1) == sets.find(4)
+    assert sets.find(1) != sets.find(5)
+    assert sets.groups() == [[1, 2, 3, 4], [5, 6], [7]]
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__unknown_search_mode():
+    with pytest.raises(ValueError, match="search mode"):
+        await SimilarityStore.create(search_mode="cosine")
+
+
+@pytest.mark.parametrize(
+    "query, candidate, expected",
+    [
+        ({"a", "b"}, {"a", "b", "c", "d"}, 1.0),
+        ({"a", "b"}, {"a", "c"}, 0.5),
+        (set(), {"a"}, 1.0),
+        ({"a": 2, "b": 2}, {"a": 1, "b": 3}, 3 / 4),
+    ],
+)
+def test_containment(query, candidate, expected):
+    assert similarity_store._containment(query, candidate) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize(
+    "s1, s2, expected",
+    [
+        ({"a": 2, "b": 1}, {"a": 1, "b": 1}, 2 / 3),
+        ({"a": 1}, {"b": 1}, 0.0),
+        ({}, {}, 1.0),
+    ],
+)
+def test_weighted_jaccard_similarity(s1, s2, expected):
+    assert similarity_store._jaccard_similarity(s1, s2) == pytest.approx(expected)
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__unknown_fingerprint_engine():
+    with pytest.raises(ValueError, match="Unknown fingerprint engine"):
+        await SimilarityStore.create(fingerprint_engine="other")
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__b_bit_fingerprints():
+    storage = narrow_down.storage.InMemoryStore()
+    simstore = await SimilarityStore.create(
+        storage=storage,
+        storage_level=StorageLevel.Fingerprint,
+        similarity_threshold=0.5,
+        fingerprint_bits=2,
+    )
+    id1 = await simstore.insert("a b c d e f g h i j k l m n o p")
+    id2 = await simstore.insert("a b c d e f g h i j k l m n o x")
+    results = await simstore.query_top_n(2, "a b c d e f g h i j k l m n o p")
+    assert [r.id_ for r in results] == [id1, id2]
+    assert results[0].fingerprint.dtype == np.uint8
+
+    reloaded = await SimilarityStore.load_from_storage(storage)
+    assert reloaded._lsh_config.fingerprint_bits == 2
+    with pytest.raises(narrow_down.storage.TooLowStorageLevel):
+        await reloaded.remove_by_id(id1)
+
+
+@pytest.mark.asyncio
+async def test_similarity_store__invalid_fingerprint_bits():
+    with pytest.raises(ValueError, match="fingerprint bits"):
+        await SimilarityStore.create(fingerprint_bits=16)
@@ -175,6 +175,18 @@ async def test_sqlite_store__add_documents_to_bucket_and_query__custom_partition
     assert sorted(await ims.query_ids_from_bucket(bucket_id=1, document_hash=20)) == [20, 21]
 
 
+@pytest.mark.parametrize("partitions", [1, 3, 100])
+@pytest.mark.asyncio
+async def test_sqlite_store__iter_buckets(partitions):
+    ims = await narrow_down.sqlite.SQLiteStore(":memory:", partitions=partitions).initialize()
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=10)
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=20, document_id=20)
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=20, document_id=21)
+    buckets = sorted([(b, h, sorted(ids)) async for b, h, ids in ims.iter_buckets()])
+    assert buckets == [(1, 10, [10]), (1, 20, [20, 21])]
+    assert [(b, h) async for b, h, _ in ims.iter_buckets(min_size=2)] == [(1, 20)]
+
+
 @pytest.mark.parametrize("partitions", [1, 3, 100])
 @pytest.mark.asyncio
 async def test_sqlite_store__remove_documents_from_bucket__custom_partitions(partitions):
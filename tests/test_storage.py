@@ -1,10 +1,22 @@
 """Tests for the `narrow_down.storage` module."""
+import asyncio
+import concurrent.futures
 import dataclasses
+import pickle
 
 import numpy as np
 import pytest
 
-from narrow_down.storage import Fingerprint, InMemoryStore, StorageLevel, StoredDocument
+from narrow_down._rust import Compressor
+from narrow_down.storage import (
+    Fingerprint,
+    InMemoryStore,
+    ReadOnlyStorage,
+    SharedMemoryStore,
+    StorageLevel,
+    StoredDocument,
+    train_compression_dictionary,
+)
 
 
 @pytest.mark.parametrize("data", [None, "", "user data"])
@@ -41,6 +53,80 @@ def test_stored_document_serialization(
             assert getattr(deserialized, field.name) is None
 
 
+@pytest.mark.parametrize("spec", ["lz4", "zstd", "zstd(9)"])
+@pytest.mark.parametrize("with_dictionary", [False, True])
+def test_stored_document_serialization__compressed(spec, with_dictionary):
+    samples = [f"Document number {i} with some shared content" for i in range(100)]
+    dictionary = train_compression_dictionary(samples, max_size=1024) if with_dictionary else None
+    compressor = Compressor(spec, dictionary)
+    document = StoredDocument(
+        document="Document number 1000 with some shared content",
+        exact_part="exact",
+        fingerprint=Fingerprint(np.array([1, 2, 3], dtype=np.uint32)),
+        data="data",
+    )
+    serialized = document.serialize(StorageLevel.Full, compressor)
+    assert serialized != document.serialize(StorageLevel.Full)
+    deserialized = StoredDocument.deserialize(serialized, id_=None, compressor=compressor)
+    assert deserialized.without("fingerprint") == document.without("fingerprint")
+    assert np.array_equal(deserialized.fingerprint, document.fingerprint)
+
+
+@pytest.mark.parametrize("bits", [1, 2, 4, 8])
+def test_stored_document_serialization__b_bit_fingerprint(bits):
+    fingerprint = Fingerprint(np.arange(1000, 1064, dtype=np.uint32) * 7919)
+    document = StoredDocument(exact_part="exact", fingerprint=fingerprint, data="data")
+    serialized = document.serialize(StorageLevel.Fingerprint, fingerprint_bits=bits)
+    assert len(serialized) < len(document.serialize(StorageLevel.Fingerprint)) / 3
+
+    expected = fingerprint & ((1 << bits) - 1)
+    deserialized = StoredDocument.deserialize(serialized, id_=1)
+    assert deserialized.fingerprint.dtype == np.uint8
+    assert (deserialized.fingerprint == expected).all()
+    assert deserialized.without("fingerprint") == StoredDocument(
+        id_=1, exact_part="exact", data="data"
+    )
+    (batch_deserialized,) = StoredDocument.deserialize_many([serialized], [1])
+    assert (batch_deserialized.fingerprint == expected).all()
+
+
+def test_stored_document_serialization__invalid_fingerprint_bits():
+    document = StoredDocument(fingerprint=Fingerprint(np.array([1, 2], dtype=np.uint32)))
+    with pytest.raises(ValueError):
+        document.serialize(StorageLevel.Fingerprint, fingerprint_bits=3)
+
+
+@pytest.mark.parametrize("storage_level", [StorageLevel.Minimal, StorageLevel.Full])
+@pytest.mark.parametrize("compressor", [None, Compressor("lz4")])
+def test_stored_document_deserialize_many(storage_level, compressor):
+    documents = [
+        StoredDocument(
+            id_=i,
+            document=f"document {i}",
+            exact_part=None if i % 2 else "exact",
+            fingerprint=Fingerprint(np.array([i, i + 1, i + 2], dtype=np.uint32)),
+            data=f"data {i}",
+        )
+        for i in range(5)
+    ]
+    serialized = [d.serialize(storage_level, compressor) for d in documents]
+    result = StoredDocument.deserialize_many(serialized, list(range(5)), compressor)
+    expected = [StoredDocument.deserialize(s, i, compressor) for i, s in enumerate(serialized)]
+    assert [r.without("fingerprint") for r in result] == [
+        e.without("fingerprint") for e in expected
+    ]
+    for r, e in zip(result, expected):  # noqa=B905
+        assert (r.fingerprint is None and e.fingerprint is None) or np.array_equal(
+            r.fingerprint, e.fingerprint
+        )
+    assert StoredDocument.deserialize_many([], []) == []
+
+
+def test_compressor__invalid_spec():
+    with pytest.raises(ValueError, match="Unknown compression"):
+        Compressor("gzip")
+
+
 def test_stored_document_without():
     document = StoredDocument(id_=5, document="abcd")
     assert document.without("document") == StoredDocument(id_=5)
@@ -49,6 +135,27 @@ def test_stored_document_without():
     assert document.without() is not document
 
 
+def test_stored_document_slots():
+    fingerprint = Fingerprint(np.array([1, 2, 3], dtype=np.uint32))
+    document = StoredDocument(id_=5, document="abcd", fingerprint=fingerprint)
+    assert not hasattr(document, "__dict__")
+    assert [f.name for f in dataclasses.fields(document)] == [
+        "id_",
+        "document",
+        "exact_part",
+        "fingerprint",
+        "data",
+        "n_tokens",
+    ]
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        document.id_ = 6  # type: ignore
+    assert document.without("document").fingerprint is fingerprint
+
+    restored = pickle.loads(pickle.dumps(document))  # noqa: S301  # Round trip of own data
+    assert restored.without("fingerprint") == document.without("fingerprint")
+    assert np.array_equal(restored.fingerprint, fingerprint)
+
+
 def test_stored_document_eq():
     document1 = StoredDocument(id_=5, document="abcd")
     document2 = StoredDocument(id_=5, document="abcd")
@@ -136,6 +243,26 @@ async def test_in_memory_store__add_documents_to_bucket_and_query():
     assert sorted(await ims.query_ids_from_bucket(bucket_id=1, document_hash=20)) == [20, 21]
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("dense_ids", [False, True])
+async def test_in_memory_store__iter_buckets(tmp_path, dense_ids):
+    ims = InMemoryStore(dense_ids=dense_ids)
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=10)
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=20, document_id=20)
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=20, document_id=21)
+    await ims.add_document_to_bucket(bucket_id=2, document_hash=20, document_id=20)
+    buckets = sorted([(b, h, sorted(ids)) async for b, h, ids in ims.iter_buckets()])
+    assert buckets == [(1, 10, [10]), (1, 20, [20, 21]), (2, 20, [20])]
+    assert [(b, h) async for b, h, _ in ims.iter_buckets(min_size=2)] == [(1, 20)]
+
+    shared_file = str(tmp_path / "buckets.shm")
+    ims.to_shared_file(shared_file)
+    shared_store = SharedMemoryStore(shared_file)
+    assert (
+        sorted([(b, h, sorted(ids)) async for b, h, ids in shared_store.iter_buckets()]) == buckets
+    )
+
+
 @pytest.mark.asyncio
 async def test_in_memory_store__remove_documents_from_bucket():
     ims = InMemoryStore()
@@ -155,6 +282,99 @@ async def test_in_memory_store__remove_documents_from_bucket():
     assert list(await ims.query_ids_from_bucket(bucket_id=1, document_hash=10)) == []
 
 
+@pytest.mark.asyncio
+async def test_in_memory_store__dense_ids__reuse_removed_ids():
+    ims = await InMemoryStore(dense_ids=True).initialize()
+    assert [await ims.insert_document(document=b"doc") for _ in range(3)] == [1, 2, 3]
+    await ims.remove_document(document_id=2)
+    assert await ims.insert_document(document=b"new doc") == 2
+    assert await ims.query_document(2) == b"new doc"
+    assert await ims.insert_document(document=b"doc") == 4
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store__dense_ids__fill_gaps_of_explicit_ids():
+    ims = await InMemoryStore(dense_ids=True).initialize()
+    assert await ims.insert_document(document=b"doc", document_id=3) == 3
+    assert await ims.insert_document(document=b"doc", document_id=1) == 1
+    assert [await ims.insert_document(document=b"doc") for _ in range(2)] == [2, 4]
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store__dense_ids__id_too_large():
+    ims = await InMemoryStore(dense_ids=True).initialize()
+    with pytest.raises(ValueError, match="dense IDs"):
+        await ims.insert_document(document=b"doc", document_id=2**32)
+    with pytest.raises(ValueError, match="dense IDs"):
+        await ims.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=2**32)
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store__dense_ids__max_id_gap():
+    ims = await InMemoryStore(dense_ids=True, max_id_gap=10).initialize()
+    assert await ims.insert_document(document=b"doc", document_id=10) == 10
+    with pytest.raises(ValueError, match="more than 10 IDs beyond"):
+        await ims.insert_document(document=b"doc", document_id=22)
+    with pytest.raises(ValueError, match="dense IDs"):
+        await ims.insert_document(document=b"doc", document_id=2**32 - 1)
+    assert await ims.insert_document(document=b"doc") == 1
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store__dense_ids__serialize():
+    ims = await InMemoryStore(dense_ids=True).initialize()
+    id_ = await ims.insert_document(document=b"doc")
+    await ims.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=id_)
+
+    ims2 = InMemoryStore.deserialize(ims.serialize())
+
+    assert ims2.rms.dense_ids
+    assert await ims2.query_document(id_) == b"doc"
+    assert list(await ims2.query_ids_from_bucket(bucket_id=1, document_hash=10)) == [id_]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("cache_size", [0, 1, 100])
+async def test_in_memory_store__spill_file(tmp_path, cache_size):
+    spill_file = tmp_path / "documents.bin"
+    ims = await InMemoryStore(spill_file=str(spill_file), cache_size=cache_size).initialize()
+    ids = [await ims.insert_document(document=f"document {i}".encode()) for i in range(10)]
+    await ims.insert_document(document=b"overwritten", document_id=ids[3])
+    await ims.remove_document(document_id=ids[5])
+
+    assert spill_file.stat().st_size > 0
+    assert await ims.query_document(ids[3]) == b"overwritten"
+    assert await ims.query_documents([ids[0], ids[1], ids[0]]) == [
+        b"document 0",
+        b"document 1",
+        b"document 0",
+    ]
+    with pytest.raises(KeyError):
+        await ims.query_document(ids[5])
+
+    ims2 = InMemoryStore.deserialize(ims.serialize())
+    assert await ims2.query_document(ids[9]) == b"document 9"
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store__spill_file__from_file(tmp_path):
+    ims = await InMemoryStore().initialize()
+    id_ = await ims.insert_document(document=b"doc")
+    ims.to_file(str(tmp_path / "store.msgpack"))
+
+    ims2 = InMemoryStore.from_file(
+        str(tmp_path / "store.msgpack"), spill_file=str(tmp_path / "documents.bin")
+    )
+
+    assert await ims2.query_document(id_) == b"doc"
+    assert await ims2.insert_document(document=b"doc2") == id_ + 1
+
+
+def test_in_memory_store__spill_file_and_dense_ids(tmp_path):
+    with pytest.raises(ValueError, match="cannot be combined"):
+        InMemoryStore(dense_ids=True, spill_file=str(tmp_path / "documents.bin"))
+
+
 @pytest.mark.asyncio
 async def test_in_memory_store__insert_query_document__close_and_reopen():
     """Adding a duplicate before to see if that's also handled."""
@@ -263,3 +483,92 @@ async def test_in_memory_store__from_file__deserialize(tmpdir):
     store2 = InMemoryStore.from_file(str(msgpck_file))
     with msgpck_file.open("rb") as f:
         assert store2.serialize() == InMemoryStore.deserialize(f.read()).serialize()
+
+
+@pytest.mark.asyncio
+async def test_in_memory_store__query_documents():
+    ims = InMemoryStore()
+    id1 = await ims.insert_document(document=b"abcd")
+    id2 = await ims.insert_document(document=b"efgh")
+    assert await ims.query_documents([id2, id1]) == [b"efgh", b"abcd"]
+    with pytest.raises(KeyError):
+        await ims.query_documents([id1, id2 + 1])
+
+
+def test_in_memory_store__parallel_threads():
+    """Read and write one store from multiple threads at the same time."""
+    ims = InMemoryStore()
+
+    def insert_and_query(thread_number):
+        async def f():
+            for i in range(200):
+                doc_id = thread_number * 1000 + i
+                await ims.insert_document(document=str(doc_id).encode(), document_id=doc_id)
+                await ims.add_document_to_bucket(bucket_id=1, document_hash=i, document_id=doc_id)
+                assert await ims.query_document(doc_id) == str(doc_id).encode()
+                assert doc_id in await ims.query_ids_from_bucket(bucket_id=1, document_hash=i)
+
+        asyncio.run(f())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(insert_and_query, range(8)))
+
+    for i in range(200):
+        assert sorted(asyncio.run(ims.query_ids_from_bucket(bucket_id=1, document_hash=i))) == [
+            t * 1000 + i for t in range(8)
+        ]
+
+
+@pytest.mark.asyncio
+async def test_shared_memory_store__query(tmp_path):
+    shared_file = str(tmp_path / "store.shm")
+
+    store = await InMemoryStore().initialize()
+    await store.insert_setting(key="k", value="155")
+    id_out = await store.insert_document(document=b"abcd efgh")
+    await store.insert_document(document=b"ijkl", document_id=1000)
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=10)
+    await store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=11)
+    await store.add_document_to_bucket(bucket_id=2, document_hash=10, document_id=12)
+    store.to_shared_file(shared_file)
+
+    shared_store = SharedMemoryStore(shared_file)
+    assert await shared_store.query_setting("k") == "155"
+    assert await shared_store.query_setting("x") is None
+    assert await shared_store.query_document(id_out) == b"abcd efgh"
+    assert await shared_store.query_documents([1000, id_out]) == [b"ijkl", b"abcd efgh"]
+    with pytest.raises(KeyError):
+        await shared_store.query_document(5)
+    with pytest.raises(KeyError):
+        await shared_store.query_documents([id_out, 5])
+    assert sorted(await shared_store.query_ids_from_bucket(bucket_id=1, document_hash=10)) == [
+        10,
+        11,
+    ]
+    assert list(await shared_store.query_ids_from_bucket(bucket_id=2, document_hash=10)) == [12]
+    assert list(await shared_store.query_ids_from_bucket(bucket_id=2, document_hash=11)) == []
+
+
+@pytest.mark.asyncio
+async def test_shared_memory_store__read_only(tmp_path):
+    shared_file = str(tmp_path / "store.shm")
+    (await InMemoryStore().initialize()).to_shared_file(shared_file)
+    shared_store = SharedMemoryStore(shared_file)
+
+    with pytest.raises(ReadOnlyStorage):
+        await shared_store.insert_setting(key="k", value="155")
+    with pytest.raises(ReadOnlyStorage):
+        await shared_store.insert_document(document=b"abcd efgh")
+    with pytest.raises(ReadOnlyStorage):
+        await shared_store.remove_document(1)
+    with pytest.raises(ReadOnlyStorage):
+        await shared_store.add_document_to_bucket(bucket_id=1, document_hash=10, document_id=10)
+    with pytest.raises(ReadOnlyStorage):
+        await shared_store.remove_id_from_bucket(bucket_id=1, document_hash=10, document_id=10)
+
+
+def test_shared_memory_store__invalid_file(tmp_path):
+    invalid_file = tmp_path / "invalid.shm"
+    invalid_file.write_bytes(b"not a store")
+    with pytest.raises(ValueError):
+        SharedMemoryStore(str(invalid_file))
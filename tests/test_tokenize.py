@@ -26,6 +26,19 @@ def test_word_ngrams(s, n, expected):
     assert _tokenize.word_ngrams(s, n) == expected
 
 
+@pytest.mark.parametrize(
+    "s, n, expected",
+    [
+        ("", 1, {}),
+        ("two words", 3, {"two words": 1}),
+        ("a b a b a", 1, {"a": 3, "b": 2}),
+        ("a b a b a", 2, {"a b": 2, "b a": 2}),
+    ],
+)
+def test_count_word_ngrams(s, n, expected):
+    assert _tokenize.count_word_ngrams(s, n) == expected
+
+
 @pytest.mark.parametrize("n", [1, 3, 5])
 def test_word_ngrams__benchmark(benchmark, sample_sentences_french, n):
     def f():